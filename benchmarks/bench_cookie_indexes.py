@@ -0,0 +1,162 @@
+"""
+Query plans and timings of the cookie lookup paths on a synthetic sqlite
+database, before (old query paths, no account / (category, queries_weight)
+indexes) and after (hash lookup, indexes added by revgrokapi.migrations).
+
+    python -m benchmarks.bench_cookie_indexes --cookies 100000
+
+Each case prints the EXPLAIN QUERY PLAN of the SQL tortoise generates and the
+median time of `--repeat` runs.
+"""
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import fire
+from tortoise import Tortoise
+from tortoise.functions import Sum
+
+from revgrokapi.migrations import INDEX_MIGRATIONS, run_migrations
+from revgrokapi.models.cookie_models import (Cookie, CookieQueries,
+                                             QueryCategory, hash_cookie)
+
+INSERT_BATCH_SIZE = 5000
+
+
+async def seed(cookies: int, cookie_chars: int):
+    connection = Tortoise.get_connection("default")
+    now = "2026-01-01 00:00:00"
+    rng = random.Random(0)
+    for start in range(0, cookies, INSERT_BATCH_SIZE):
+        ids = range(start + 1, min(cookies, start + INSERT_BATCH_SIZE) + 1)
+        cookie_rows = []
+        query_rows = []
+        for cookie_id in ids:
+            cookie = f"sso={cookie_id:08d}" + "x" * cookie_chars
+            cookie_rows.append(
+                [cookie_id, cookie, hash_cookie(cookie), "plus", f"user{cookie_id}@mock", now, now]
+            )
+            for category in QueryCategory:
+                # 大部分cookie额度已经用完, 和线上分布接近
+                weight = rng.randint(1, 100) if rng.random() < 0.2 else 0
+                query_rows.append([cookie_id, category.value, weight, now, now])
+        await connection.execute_many(
+            'INSERT INTO "cookie" (id, cookie, cookie_hash, cookie_type, account, '
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            cookie_rows,
+        )
+        await connection.execute_many(
+            'INSERT INTO "cookie_queries" (cookie_ref_id, category, queries_weight, '
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            query_rows,
+        )
+
+
+async def drop_added_indexes():
+    """删掉迁移会加的非唯一索引, 模拟加索引之前的库"""
+    connection = Tortoise.get_connection("default")
+    targets = {(table, columns) for _, table, columns, unique in INDEX_MIGRATIONS if not unique}
+    for table in {table for table, _ in targets}:
+        for index in await connection.execute_query_dict(f'PRAGMA index_list("{table}")'):
+            columns = await connection.execute_query_dict(f'PRAGMA index_info("{index["name"]}")')
+            columns = tuple(c["name"] for c in sorted(columns, key=lambda c: c["seqno"]))
+            if (table, columns) in targets:
+                await connection.execute_script(f'DROP INDEX "{index["name"]}"')
+
+
+async def explain(queryset) -> list:
+    connection = Tortoise.get_connection("default")
+    rows = await connection.execute_query_dict(
+        f"EXPLAIN QUERY PLAN {queryset.sql(params_inline=True)}"
+    )
+    return [row["detail"] for row in rows]
+
+
+async def measure(name: str, queryset, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await queryset
+        timings.append(time.perf_counter() - start)
+    print(f"  {name:<34} {statistics.median(timings) * 1000:9.2f} ms")
+    for detail in await explain(queryset):
+        print(f"      {detail}")
+
+
+def cases(target_cookie: str, target_account: str, indexed: bool):
+    category = QueryCategory.DEFAULT
+    if indexed:
+        lookup = Cookie.filter(cookie_hash=hash_cookie(target_cookie))
+        account = Cookie.filter(account=target_account)
+        candidates = CookieQueries.filter(
+            category=category, queries_weight__gt=0
+        ).values_list("cookie_ref_id", "queries_weight")
+        totals = (
+            CookieQueries.all()
+            .annotate(total=Sum("queries_weight"))
+            .group_by("category")
+            .values("category", "total")
+        )
+    else:
+        lookup = Cookie.filter(cookie__icontains=target_cookie)
+        account = Cookie.filter(account__icontains=target_account)
+        candidates = CookieQueries.filter(
+            category=category, queries_weight__gt=0
+        ).prefetch_related("cookie_ref")
+        # 旧的统计接口把每个类别的记录全部取出后在python中求和
+        totals = CookieQueries.filter(category=category)
+    return [
+        ("cookie lookup", lookup),
+        ("account lookup", account),
+        ("weighted candidates", candidates),
+        (
+            "cookies by weight",
+            CookieQueries.filter(category=category, queries_weight__gte=50).order_by(
+                "-queries_weight"
+            ),
+        ),
+        ("category totals", totals),
+    ]
+
+
+async def run(cookies: int, cookie_chars: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.sqlite3")
+        await Tortoise.init(
+            db_url=f"sqlite://{db_path}", modules={"models": ["revgrokapi.models"]}
+        )
+        try:
+            await Tortoise.generate_schemas()
+            start = time.perf_counter()
+            await seed(cookies, cookie_chars)
+            print(
+                f"seeded {cookies} cookies ({cookie_chars} chars) in "
+                f"{time.perf_counter() - start:.1f}s"
+            )
+            target_id = cookies // 2
+            target_cookie = f"sso={target_id:08d}" + "x" * cookie_chars
+            target_account = f"user{target_id}@mock"
+
+            await drop_added_indexes()
+            print("before (old query paths, no account/category indexes):")
+            for name, queryset in cases(target_cookie, target_account, indexed=False):
+                await measure(name, queryset, repeat)
+
+            await run_migrations()
+            await Tortoise.get_connection("default").execute_script("ANALYZE")
+            print("after (hash lookup, indexes from revgrokapi.migrations):")
+            for name, queryset in cases(target_cookie, target_account, indexed=True):
+                await measure(name, queryset, repeat)
+        finally:
+            await Tortoise.close_connections()
+
+
+def main(cookies: int = 100_000, cookie_chars: int = 1000, repeat: int = 5):
+    asyncio.run(run(cookies, cookie_chars, repeat))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
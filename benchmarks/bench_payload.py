@@ -0,0 +1,65 @@
+"""
+Compare the legacy chat payload construction (dict rebuild + update + json
+encode, as curl_cffi does for `json=`) with the precomputed ChatPayloadTemplate.
+
+    python -m benchmarks.bench_payload
+"""
+import json
+import time
+
+from revgrokapi.revgrok.utils import (get_chat_payload_template,
+                                      get_default_chat_payload,
+                                      get_default_headers)
+
+
+def legacy_render(prompt: str, model: str = "grok-3") -> bytes:
+    payload = get_default_chat_payload()
+    payload.update(
+        {
+            "modelName": model,
+            "message": prompt,
+            "isReasoning": False,
+            "deepsearchPreset": "",
+        }
+    )
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def template_render(prompt: str, model: str = "grok-3") -> bytes:
+    return get_chat_payload_template(model, False, "", "").render(prompt)
+
+
+def legacy_headers(cookie: str, user_agent: str) -> dict:
+    return dict(get_default_headers.__wrapped__(cookie, user_agent))
+
+
+def timeit(func, *args, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    print(f"{'prompt':>16} {'legacy ms':>10} {'template ms':>12} {'legacy KB':>10} {'template KB':>12}")
+    for label, unit in (("ascii", "hello world. "), ("cjk", "你好，世界。")):
+        for size in (1_000, 100_000, 1_000_000, 8_000_000):
+            prompt = (unit * (size // len(unit) + 1))[:size]
+            assert json.loads(legacy_render(prompt)) == json.loads(template_render(prompt))
+            repeat = max(3, 2_000_000 // size)
+            legacy = timeit(legacy_render, prompt, repeat=repeat)
+            template = timeit(template_render, prompt, repeat=repeat)
+            print(
+                f"{label + ' ' + str(size):>16} {legacy * 1000:>10.3f} {template * 1000:>12.3f}"
+                f" {len(legacy_render(prompt)) / 1024:>10.1f} {len(template_render(prompt)) / 1024:>12.1f}"
+            )
+
+    cookie = "sso=" + "x" * 3000
+    user_agent = "Mozilla/5.0"
+    legacy = timeit(legacy_headers, cookie, user_agent, repeat=100_000)
+    cached = timeit(get_default_headers, cookie, user_agent, repeat=100_000)
+    print(f"headers: legacy {legacy * 1e6:.2f}us, cached {cached * 1e6:.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Memory held per 10k cookies by the different in-memory representations of the
+cookie pool, on a synthetic sqlite database, and the time to pick one cookie.
+
+    python -m benchmarks.bench_pool_memory --cookies 50000 --cookie_chars 1000
+
+before: Tortoise model instances, as the rate-limit sweep loaded the pool and
+the old `CookieQueries.get_cookies_by_weight` returned it (prefetched Cookie
+models), and the old weighted pick that read every (cookie id, weight) row
+from the database; both are reproduced here as baselines. after: `CookieRecord`s (__slots__, hot columns only) and the
+array-backed `revgrokapi.pool.CookiePool`. Memory is what tracemalloc still
+sees allocated while the result is alive, after garbage collection.
+"""
+import asyncio
+import gc
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import fire
+from loguru import logger
+from tortoise import Tortoise
+
+from benchmarks.bench_cookie_indexes import seed
+from revgrokapi.models.cookie_models import (Cookie, CookieQueries,
+                                             QueryCategory)
+from revgrokapi.pool import CookiePool
+
+PER_COOKIES = 10_000
+
+
+async def settle() -> int:
+    """数据库连接会保留最近一次查询读出的行, 先执行一个空查询把它们释放掉"""
+    await Cookie.filter(id=0).values_list("id", flat=True)
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def retained(load) -> int:
+    """load()返回的对象仍然存活时多占用的内存"""
+    before = await settle()
+    result = await load()
+    size = await settle() - before
+    del result
+    return size
+
+
+async def load_models():
+    return await Cookie.all(), await CookieQueries.all()
+
+
+async def load_by_weight_models():
+    # 改动之前的get_cookies_by_weight: prefetch完整的Cookie模型
+    records = await CookieQueries.filter(
+        category=QueryCategory.DEFAULT, queries_weight__gte=0
+    ).prefetch_related("cookie_ref")
+    return [record.cookie_ref for record in records]
+
+
+async def select_from_db():
+    # 改动之前的get_random_weighted_cookie: 每次都读出所有(cookie id, 权重)再采样
+    rows = await CookieQueries.filter(
+        category=QueryCategory.DEFAULT, queries_weight__gt=0
+    ).values_list("cookie_ref_id", "queries_weight")
+    if not rows:
+        return None
+    cookie_ids = [cookie_id for cookie_id, _ in rows]
+    weights = [weight for _, weight in rows]
+    (cookie_id,) = random.choices(cookie_ids, weights=weights)
+    return await Cookie.get_or_none(id=cookie_id)
+
+
+async def load_records():
+    return await Cookie.get_records()
+
+
+async def load_pool():
+    pool = CookiePool()
+    await pool.load()
+    return pool
+
+
+async def time_selection(name: str, select, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await select()
+        timings.append(time.perf_counter() - start)
+    print(f"  {name:<44} {statistics.median(timings) * 1000:9.3f} ms")
+
+
+async def run(cookies: int, cookie_chars: int, selections: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.sqlite3")
+        await Tortoise.init(
+            db_url=f"sqlite://{db_path}", modules={"models": ["revgrokapi.models"]}
+        )
+        try:
+            await Tortoise.generate_schemas()
+            await seed(cookies, cookie_chars)
+            print(
+                f"seeded {cookies} cookies ({cookie_chars} chars), "
+                f"memory per {PER_COOKIES} cookies:"
+            )
+
+            tracemalloc.start()
+            cases = [
+                ("before: Cookie + CookieQueries models", load_models),
+                ("before: get_cookies_by_weight (prefetch)", load_by_weight_models),
+                ("after: CookieRecord list", load_records),
+                ("after: CookiePool arrays", load_pool),
+            ]
+            for name, load in cases:
+                size = await retained(load)
+                print(f"  {name:<44} {size * PER_COOKIES / cookies / 1024 / 1024:9.2f} MiB")
+            tracemalloc.stop()
+
+            pool = await load_pool()
+            print(f"pool: {pool.stats()['bytes_per_cookie']} bytes per cookie; pick one cookie:")
+
+            async def select_from_pool():
+                return await pool.fetch(pool.choose(QueryCategory.DEFAULT))
+
+            await time_selection(
+                "before: weighted pick from db", select_from_db, selections
+            )
+            await time_selection(
+                "after: CookiePool.choose + fetch", select_from_pool, selections
+            )
+        finally:
+            await Tortoise.close_connections()
+
+
+def main(cookies: int = 50_000, cookie_chars: int = 1000, selections: int = 50):
+    # 选择cookie时的debug日志会淹没结果
+    logger.remove()
+    asyncio.run(run(cookies, cookie_chars, selections))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
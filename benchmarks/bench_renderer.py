@@ -0,0 +1,103 @@
+"""
+Replay a recorded (or synthesized) deepsearch trace through the stream renderers.
+
+    python -m benchmarks.bench_renderer [trace.ndjson]
+
+`legacy_render` reproduces the per-token logic grok_chat used before the
+renderers (str(chunk_json) scans, json.loads on every "action_input" token).
+"""
+import json
+import sys
+import time
+
+from benchmarks.trace_utils import load_trace, synthesize_trace
+from revgrokapi.openai_api.stream_renderer import create_stream_renderer
+from revgrokapi.revgrok.events import GrokResponseEvent
+
+
+def parse(lines):
+    events = []
+    for line in lines:
+        chunk_json = json.loads(line)
+        token = chunk_json.get("result", {}).get("response", {}).get("token", "")
+        events.append((token, chunk_json))
+    return events
+
+
+def legacy_render(events, reasoning=False, deepresearch=True):
+    out = []
+    current_message_id = None
+    is_thinking = None
+    step_id = 1
+    tool_calls = 0
+    for chunk, chunk_json in events:
+        if "messageStepId" in str(chunk_json):
+            new_message_id = chunk_json["result"]["response"]["messageStepId"]
+            if new_message_id != current_message_id and chunk:
+                chunk = "\n---\n" + f"> `Step{step_id}`"
+                step_id += 1
+            current_message_id = new_message_id
+        if "isThinking" in str(chunk_json):
+            new_thinking_state = chunk_json["result"]["response"]["isThinking"]
+            if new_thinking_state and chunk == "\n":
+                chunk = "\n>"
+            if is_thinking and new_thinking_state is False and reasoning:
+                out.append("</think>")
+            is_thinking = new_thinking_state
+        if deepresearch:
+            if chunk.endswith("\n"):
+                chunk = chunk[:-1] + "\n>"
+            if "action_input" in chunk:
+                try:
+                    action_json = json.loads(chunk)
+                except ValueError:
+                    # 被拆开的工具调用json会在这里失败(线上则是异常后整体重试)
+                    out.append(chunk)
+                    continue
+                tool_calls += 1
+                action_params = ""
+                for k, v in action_json["action_input"].items():
+                    action_params += f"{k}: {v},"
+                chunk = f"\n  ***{action_json['action']} with {action_params}***"
+        if "modelResponse" in str(chunk_json) and deepresearch:
+            chunk = "\n" + chunk_json["result"]["response"]["modelResponse"]["message"]
+        out.append(chunk)
+    return out, tool_calls
+
+
+def render(events, reasoning_format):
+    renderer = create_stream_renderer(reasoning_format, reasoning=False, deepsearch=True)
+    out = renderer.start()
+    for token, chunk_json in events:
+        out.extend(renderer.feed(GrokResponseEvent.from_chunk(token, chunk_json)))
+    out.extend(renderer.finish())
+    return out, renderer.tool_call_count
+
+
+def bench(label, func, *args, repeat=5):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    if len(sys.argv) > 1:
+        lines = load_trace(sys.argv[1])
+    else:
+        lines = synthesize_trace()
+    events = parse(lines)
+    print(f"events: {len(events)}")
+
+    seconds, (_, tool_calls) = bench("legacy", legacy_render, events)
+    print(f"legacy      {seconds * 1000:8.2f} ms  {seconds / len(events) * 1e6:6.2f} us/event  (tool calls: {tool_calls})")
+    for reasoning_format in ("markdown", "structured"):
+        seconds, (_, tool_calls) = bench(reasoning_format, render, events, reasoning_format)
+        print(f"{reasoning_format:<11} {seconds * 1000:8.2f} ms  {seconds / len(events) * 1e6:6.2f} us/event  (tool calls: {tool_calls})")
+
+
+if __name__ == "__main__":
+    main()
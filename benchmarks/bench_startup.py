@@ -0,0 +1,133 @@
+"""
+Cold start budget of the gateway: `python -X importtime` of `main`, and the
+wall time from launching `python main.py` until `/api/v1/health/ready` answers.
+
+    python -m benchmarks.bench_startup --runs 5
+
+Each phase is run `--runs` times in fresh interpreters and the median is
+compared against its budget; the process exits non-zero when a budget is
+exceeded or when one of LAZY_MODULES is imported at startup (they must only be
+loaded on first use). The startup runs use a throwaway sqlite database.
+"""
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import fire
+
+# 启动时不应该导入的模块: 已删除的依赖, 或只在第一次使用时才导入
+LAZY_MODULES = ("numpy", "tiktoken", "tqdm", "fake_useragent", "httpx", "fire", "openai")
+IMPORT_BUDGET_MS = 600
+READY_BUDGET_MS = 1500
+READY_PATH = "/api/v1/health/ready"
+READY_POLL_INTERVAL_SECONDS = 0.01
+
+
+def parse_importtime(stderr: str):
+    """返回 [(模块, 自身us, 累计us, 深度)], 深度0是被直接导入的模块"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        head, cumulative_us, name = line.split("|")
+        self_us = head.split(":")[1]
+        # 名字前有一个空格, 每深一层多两个空格
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def measure_imports(module: str):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(READY_POLL_INTERVAL_SECONDS)
+    return False
+
+
+def measure_ready(port: int, db_dir: str, timeout: float) -> float:
+    env = {**os.environ, "DB_URL": f"sqlite://{os.path.join(db_dir, 'startup.sqlite3')}"}
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "--host", "127.0.0.1", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not wait_ready(f"http://127.0.0.1:{port}{READY_PATH}", process, timeout):
+            raise RuntimeError(f"gateway not ready after {timeout}s (exit code {process.poll()})")
+        return time.perf_counter() - start
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(
+    runs: int = 5,
+    module: str = "main",
+    top: int = 15,
+    import_budget_ms: float = IMPORT_BUDGET_MS,
+    ready_budget_ms: float = READY_BUDGET_MS,
+    port: int = 3699,
+    ready_timeout: float = 30,
+    skip_ready: bool = False,
+):
+    ok = True
+    samples = [measure_imports(module) for _ in range(runs)]
+    totals = [next(row[2] for row in rows if row[0] == module) / 1000 for rows in samples]
+    import_ms = statistics.median(totals)
+    print(f"import {module}: median {import_ms:.0f} ms (budget {import_budget_ms:.0f} ms)")
+    # 顶层依赖按累计耗时排序, 取中位数那次的结果
+    rows = samples[totals.index(sorted(totals)[len(totals) // 2])]
+    heaviest = sorted((row for row in rows if row[3] <= 1), key=lambda row: -row[2])
+    for name, _, cumulative_us, depth in heaviest[:top]:
+        print(f"  {'  ' * depth}{name:<48} {cumulative_us / 1000:8.1f} ms")
+    imported = {row[0].split(".")[0] for row in rows}
+    eager = [name for name in LAZY_MODULES if name in imported]
+    if eager:
+        ok = False
+        print(f"  imported at startup, should be lazy: {', '.join(eager)}")
+    if import_ms > import_budget_ms:
+        ok = False
+
+    if not skip_ready:
+        with tempfile.TemporaryDirectory() as db_dir:
+            ready = [measure_ready(port, db_dir, ready_timeout) for _ in range(runs)]
+        ready_ms = statistics.median(ready) * 1000
+        print(
+            f"launch -> ready: median {ready_ms:.0f} ms, max {max(ready) * 1000:.0f} ms "
+            f"(budget {ready_budget_ms:.0f} ms)"
+        )
+        if ready_ms > ready_budget_ms:
+            ok = False
+
+    print("within budget" if ok else "OVER BUDGET")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
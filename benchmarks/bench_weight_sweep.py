@@ -0,0 +1,114 @@
+"""
+Database cost of writing one rate-limit sweep back as cookie weights: the old
+per-cookie path (get_or_create + save per category) against
+CookieQueries.bulk_update_rate_limits in batches of SWEEP_WRITE_BATCH_SIZE.
+
+    python -m benchmarks.bench_weight_sweep --cookies 2000
+
+Runs on a temporary sqlite database and prints statements executed and wall
+time for a first sweep (rows created) and a second sweep where only
+`--changed` of the weights moved.
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import fire
+from tortoise import Tortoise
+
+from revgrokapi.models.cookie_models import (Cookie, CookieQueries,
+                                             QueryCategory, hash_cookie)
+from revgrokapi.periodic_checks.rate_limit_probe import SWEEP_WRITE_BATCH_SIZE
+
+class StatementCounter:
+    """用sqlite的trace回调统计执行的语句数(含BEGIN/COMMIT, executemany按参数组计)"""
+
+    def __init__(self, connection):
+        # tortoise的SqliteClient持有的aiosqlite连接
+        self._sqlite = connection._connection
+        self.count = 0
+
+    def _trace(self, statement: str):
+        self.count += 1
+
+    async def __aenter__(self):
+        await self._sqlite.set_trace_callback(self._trace)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._sqlite.set_trace_callback(None)
+
+
+async def legacy_write(cookies, rate_limits):
+    """改动前每个cookie的写法: 每个类别get_or_create后save"""
+    for cookie in cookies:
+        for category_name, data in rate_limits[cookie.id].items():
+            record = await CookieQueries.get_or_create(cookie, QueryCategory(category_name))
+            record.queries_weight = data["remainingQueries"]
+            record.window_size_seconds = data["windowSizeSeconds"]
+            await record.save()
+
+
+async def bulk_write(cookies, rate_limits):
+    ids = [cookie.id for cookie in cookies]
+    for start in range(0, len(ids), SWEEP_WRITE_BATCH_SIZE):
+        batch = {cookie_id: rate_limits[cookie_id] for cookie_id in ids[start : start + SWEEP_WRITE_BATCH_SIZE]}
+        await CookieQueries.bulk_update_rate_limits(batch)
+
+
+def make_rate_limits(cookies, rng, previous=None, changed=1.0):
+    result = {}
+    for cookie in cookies:
+        result[cookie.id] = {}
+        for category in QueryCategory:
+            if previous is None or rng.random() < changed:
+                remaining = rng.randint(1, 100)
+            else:
+                remaining = previous[cookie.id][category.value]["remainingQueries"]
+            result[cookie.id][category.value] = {"remainingQueries": remaining, "windowSizeSeconds": 7200}
+    return result
+
+
+async def run_path(name, write, cookies_count, changed):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        await Tortoise.init(
+            db_url=f"sqlite://{os.path.join(tmp_dir, 'sweep.sqlite3')}",
+            modules={"models": ["revgrokapi.models"]},
+        )
+        try:
+            await Tortoise.generate_schemas()
+            await Cookie.bulk_create(
+                [
+                    Cookie(cookie=f"sso={i}", cookie_hash=hash_cookie(f"sso={i}"), cookie_type="plus", account=f"user{i}")
+                    for i in range(cookies_count)
+                ]
+            )
+            cookies = await Cookie.all()
+            rng = random.Random(0)
+            first = make_rate_limits(cookies, rng)
+            second = make_rate_limits(cookies, rng, previous=first, changed=changed)
+            connection = Tortoise.get_connection("default")
+            for label, rate_limits in (("first sweep", first), (f"{changed:.0%} changed", second)):
+                async with StatementCounter(connection) as counter:
+                    start = time.perf_counter()
+                    await write(cookies, rate_limits)
+                    elapsed = time.perf_counter() - start
+                print(f"  {name:<7} {label:<14} {counter.count:>7} statements {elapsed * 1000:9.1f} ms")
+        finally:
+            await Tortoise.close_connections()
+
+
+async def run(cookies: int, changed: float):
+    print(f"{cookies} cookies x {len(QueryCategory)} categories, batch {SWEEP_WRITE_BATCH_SIZE}")
+    await run_path("legacy", legacy_write, cookies, changed)
+    await run_path("bulk", bulk_write, cookies, changed)
+
+
+def main(cookies: int = 2000, changed: float = 0.1):
+    asyncio.run(run(cookies, changed))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
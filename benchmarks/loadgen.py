@@ -0,0 +1,205 @@
+"""
+Load generator for the OpenAI compatible chat endpoint.
+
+    python -m benchmarks.loadgen --concurrency 32 --requests 500 \
+        --gateway_pid $(pgrep -f "main.py" | head -1)
+
+Reports time to first token, end-to-end latency percentiles, token throughput
+and (when --gateway_pid is given, Linux only) gateway CPU time per streamed
+token. `--seed_cookies N` uploads N fake cookies and refreshes their weights
+first, which is all the gateway needs when pointed at benchmarks/mock_grok.py.
+"""
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import fire
+import httpx
+
+CHAT_PATH = "/api/v1/openai/v1/chat/completions"
+
+
+@dataclass
+class RequestResult:
+    ok: bool
+    ttft: Optional[float] = None
+    latency: float = 0.0
+    tokens: int = 0
+    error: str = ""
+
+
+@dataclass
+class LoadReport:
+    results: List[RequestResult] = field(default_factory=list)
+    wall_seconds: float = 0.0
+    cpu_seconds: Optional[float] = None
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def read_process_cpu_seconds(pid: int) -> Optional[float]:
+    """从 /proc/<pid>/stat 读取进程的 utime+stime"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = int(fields[11]) + int(fields[12])
+        return ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+async def run_one(
+    client: httpx.AsyncClient, api_key: str, model: str, prompt: str
+) -> RequestResult:
+    payload = {
+        "model": model,
+        "stream": True,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    start = time.perf_counter()
+    result = RequestResult(ok=False)
+    try:
+        async with client.stream(
+            "POST",
+            CHAT_PATH,
+            json=payload,
+            headers={"Authorization": f"Bearer {api_key}"},
+        ) as response:
+            if response.status_code != 200:
+                result.error = f"HTTP {response.status_code}"
+                await response.aread()
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data: {"):
+                    continue
+                delta = json.loads(line[6:])["choices"][0]["delta"]
+                text = delta.get("content") or delta.get("reasoning_content")
+                if not text:
+                    continue
+                if text.startswith("[ERROR] "):
+                    result.error = text
+                    return result
+                if result.ttft is None:
+                    result.ttft = time.perf_counter() - start
+                result.tokens += 1
+        result.ok = True
+    except Exception as e:
+        result.error = repr(e)
+    finally:
+        result.latency = time.perf_counter() - start
+    return result
+
+
+async def seed_cookies(client: httpx.AsyncClient, count: int):
+    lines = " ".join(f"loadgen{i}@mock----pw----mock-sso-{i}" for i in range(count))
+    await client.post(
+        "/api/v1/cookie/batch_upload",
+        params={"cookie": lines, "cookie_type": "plus", "account": "loadgen"},
+    )
+    response = await client.get("/api/v1/cookie/stats/refresh", params={"force": True})
+    job_id = response.json()["job"]["job_id"]
+    # 刷新在后台进行, 等它结束再开始压测
+    while True:
+        job = (await client.get(f"/api/v1/cookie/stats/refresh/{job_id}")).json()
+        if job["finished_at"] is not None:
+            break
+        await asyncio.sleep(0.2)
+
+
+async def run_load(
+    base_url: str,
+    api_key: str,
+    model: str,
+    concurrency: int,
+    requests: int,
+    prompt_chars: int,
+    gateway_pid: Optional[int],
+    seed: int,
+) -> LoadReport:
+    prompt = ("benchmark prompt " * (prompt_chars // 17 + 1))[:prompt_chars]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    report = LoadReport()
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=httpx.Timeout(600.0), limits=limits
+    ) as client:
+        if seed:
+            await seed_cookies(client, seed)
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for _ in range(requests):
+            queue.put_nowait(None)
+
+        async def worker():
+            while True:
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                report.results.append(await run_one(client, api_key, model, prompt))
+
+        cpu_before = read_process_cpu_seconds(gateway_pid) if gateway_pid else None
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        report.wall_seconds = time.perf_counter() - start
+        cpu_after = read_process_cpu_seconds(gateway_pid) if gateway_pid else None
+        if cpu_before is not None and cpu_after is not None:
+            report.cpu_seconds = cpu_after - cpu_before
+    return report
+
+
+def print_report(report: LoadReport):
+    ok = [r for r in report.results if r.ok]
+    failed = [r for r in report.results if not r.ok]
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    latencies = [r.latency for r in ok]
+    tokens = sum(r.tokens for r in ok)
+    per_request_rates = [r.tokens / (r.latency - r.ttft) for r in ok if r.ttft and r.latency > r.ttft]
+
+    print(f"requests: {len(report.results)} ok: {len(ok)} failed: {len(failed)}")
+    print(f"wall time: {report.wall_seconds:.2f}s  throughput: {len(ok) / report.wall_seconds:.2f} req/s, {tokens / report.wall_seconds:.1f} tokens/s")
+    print(f"ttft     p50: {percentile(ttfts, 50) * 1000:8.1f} ms  p99: {percentile(ttfts, 99) * 1000:8.1f} ms")
+    print(f"latency  p50: {percentile(latencies, 50) * 1000:8.1f} ms  p99: {percentile(latencies, 99) * 1000:8.1f} ms")
+    if per_request_rates:
+        print(f"per-request tokens/s p50: {percentile(per_request_rates, 50):.1f}")
+    if report.cpu_seconds is not None and tokens:
+        print(f"gateway cpu: {report.cpu_seconds:.2f}s  {report.cpu_seconds / tokens * 1e6:.1f} us/token")
+    for error in sorted({r.error for r in failed})[:5]:
+        print(f"error: {error[:200]}")
+
+
+def main(
+    base_url: str = "http://127.0.0.1:3648",
+    api_key: str = "sk-poe-api-dfascvu2",
+    model: str = "grok-3",
+    concurrency: int = 16,
+    requests: int = 200,
+    prompt_chars: int = 2000,
+    gateway_pid: Optional[int] = None,
+    seed_cookies: int = 0,
+):
+    report = asyncio.run(
+        run_load(
+            base_url,
+            api_key,
+            model,
+            concurrency,
+            requests,
+            prompt_chars,
+            gateway_pid,
+            seed_cookies,
+        )
+    )
+    print_report(report)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,255 @@
+"""
+Local stand-in for grok.com, serving the endpoints GrokClient talks to with the
+same NDJSON framing.
+
+    python -m benchmarks.mock_grok --port 9000 --tokens_per_second 200
+    GROK_BASE_URL=http://127.0.0.1:9000 python main.py
+
+Responses are synthesized (reasoning requests get thinking tokens, deepsearch
+requests get steps and split tool calls) or replayed from a recorded trace
+(`--trace path.ndjson`). Cloudflare challenges and upstream errors can be
+injected with `--cf_challenge_rate` / `--error_rate`, a slow first line (to
+exercise hedging) with `--slow_first_byte_rate` / `--slow_first_byte_delay`,
+and a mid-answer stall (idle timeouts) with `--stall_rate` / `--stall_seconds`.
+Cookies containing `--invalid_cookie_marker` get a 401 from the rate-limit
+endpoint, like an expired sso token. New conversations start with a
+conversation id line and end with the response id, and
+`/conversations/{id}/responses` continues them (same sso cookie, known parent
+response), streaming the unnested line shape grok uses there; conversations
+only live in the mock's memory.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import fire
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+
+from benchmarks.trace_utils import load_trace, synthesize_trace
+from revgrokapi.utils.cookie_utils import extract_cookie_value
+
+CF_CHALLENGE_HTML = """<!DOCTYPE html><html><head><title>Just a moment...</title></head>
+<body><div id="challenge-running"></div></body></html>"""
+
+
+@dataclass
+class MockGrokConfig:
+    tokens_per_second: float = 200.0
+    first_byte_delay: float = 0.05
+    # 按这个概率把首行延迟换成slow_first_byte_delay, 模拟首token的长尾
+    slow_first_byte_rate: float = 0.0
+    slow_first_byte_delay: float = 5.0
+    # 按这个概率在回答中途停住stall_seconds, 模拟卡住的上游
+    stall_rate: float = 0.0
+    stall_seconds: float = 120.0
+    answer_tokens: int = 300
+    thinking_tokens: int = 200
+    deepsearch_steps: int = 20
+    cf_challenge_rate: float = 0.0
+    error_rate: float = 0.0
+    remaining_queries: int = 100
+    window_size_seconds: int = 7200
+    # cookie中包含这个字符串时rate limit接口返回401, 模拟过期/被封的cookie
+    invalid_cookie_marker: Optional[str] = None
+    # 每张生成图片的大小(字节), payload中打开enableImageGeneration时才会返回图片
+    image_bytes: int = 256 * 1024
+    trace: Optional[str] = None
+
+
+def _response_line(**response) -> bytes:
+    return (json.dumps({"result": {"response": response}}, ensure_ascii=False) + "\n").encode()
+
+
+def _conversation_line(conversation_id: str) -> bytes:
+    return (json.dumps({"result": {"conversation": {"conversationId": conversation_id}}}) + "\n").encode()
+
+
+def _unnest(line: bytes) -> bytes:
+    """继续对话时上游的行没有response这一层: {"result": {"token": ...}}"""
+    data = json.loads(line)
+    result = data.get("result")
+    if isinstance(result, dict) and isinstance(result.get("response"), dict):
+        result.update(result.pop("response"))
+    return (json.dumps(data, ensure_ascii=False) + "\n").encode()
+
+
+def create_app(config: MockGrokConfig) -> FastAPI:
+    app = FastAPI()
+    trace_lines: Optional[List[bytes]] = None
+    if config.trace:
+        trace_lines = [(line + "\n").encode() for line in load_trace(config.trace)]
+    stats = {
+        "chats": 0,
+        "challenges": 0,
+        "errors": 0,
+        "rate_limit_probes": 0,
+        "invalid_cookie_probes": 0,
+        "uploads": 0,
+        "slow_first_bytes": 0,
+        "stalls": 0,
+        "conversations": 0,
+        "follow_ups": 0,
+        "follow_up_errors": 0,
+    }
+    # 对话id -> {"sso": 创建对话的账号, "responses": 对话中的回复id}
+    conversations: Dict[str, dict] = {}
+
+    def build_lines(payload: dict) -> List[bytes]:
+        if trace_lines is not None:
+            return trace_lines
+        if payload.get("deepsearchPreset"):
+            lines = synthesize_trace(
+                steps=config.deepsearch_steps,
+                tokens_per_step=max(1, config.thinking_tokens // max(1, config.deepsearch_steps)),
+                answer_tokens=config.answer_tokens,
+                deepsearch=True,
+                seed=random.randrange(1 << 30),
+            )
+            return [(line + "\n").encode() for line in lines]
+        lines = []
+        if payload.get("enableImageGeneration") and payload.get("returnImageBytes"):
+            for index in range(payload.get("imageGenerationCount", 1)):
+                image_id = f"img-{random.randrange(1 << 30)}"
+                for progress in (25, 50, 100):
+                    image = {"imageId": image_id, "imageIndex": index, "progress": progress}
+                    if progress == 100:
+                        raw = b"\x89PNG\r\n\x1a\n" + random.randbytes(config.image_bytes)
+                        image["imageBytes"] = base64.b64encode(raw).decode()
+                    lines.append(_response_line(streamingImageGenerationResponse=image))
+        if payload.get("isReasoning"):
+            for _ in range(config.thinking_tokens):
+                lines.append(_response_line(token="think ", isThinking=True, messageStepId=1))
+        for index in range(config.answer_tokens):
+            lines.append(
+                _response_line(token=f"tok{index} ", isThinking=False, messageStepId=2)
+            )
+        return lines
+
+    async def stream(lines: List[bytes]):
+        if random.random() < config.slow_first_byte_rate:
+            stats["slow_first_bytes"] += 1
+            await asyncio.sleep(config.slow_first_byte_delay)
+        else:
+            await asyncio.sleep(config.first_byte_delay)
+        start = time.perf_counter()
+        interval = 1.0 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        stall_at = len(lines) // 2 if random.random() < config.stall_rate else -1
+        for index, line in enumerate(lines):
+            if index == stall_at:
+                stats["stalls"] += 1
+                await asyncio.sleep(config.stall_seconds)
+            if interval:
+                delay = start + index * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield line
+
+    @app.get("/")
+    async def home():
+        response = HTMLResponse("<html><body>grok mock</body></html>")
+        response.set_cookie("cf_clearance", f"mock-{random.randrange(1 << 30)}")
+        return response
+
+    def reject():
+        """按配置的概率返回Cloudflare挑战或额度用完"""
+        if random.random() < config.cf_challenge_rate:
+            stats["challenges"] += 1
+            return HTMLResponse(CF_CHALLENGE_HTML, status_code=403)
+        if random.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(
+                {"error": {"code": 8, "message": "Too many requests", "details": []}},
+                status_code=429,
+            )
+        return None
+
+    def new_response(conversation_id: str) -> bytes:
+        response_id = f"resp-{random.randrange(1 << 30)}"
+        conversations[conversation_id]["responses"].add(response_id)
+        return _response_line(token="", isThinking=False, isSoftStop=True, responseId=response_id)
+
+    @app.post("/rest/app-chat/conversations/new")
+    async def new_conversation(request: Request):
+        payload = json.loads(await request.body())
+        stats["chats"] += 1
+        rejected = reject()
+        if rejected is not None:
+            return rejected
+        stats["conversations"] += 1
+        conversation_id = f"conv-{random.randrange(1 << 30)}"
+        conversations[conversation_id] = {
+            "sso": extract_cookie_value(request.headers.get("cookie", ""), "sso"),
+            "responses": set(),
+        }
+        lines = [
+            _conversation_line(conversation_id),
+            *build_lines(payload),
+            new_response(conversation_id),
+        ]
+        return StreamingResponse(stream(lines), media_type="application/json")
+
+    @app.post("/rest/app-chat/conversations/{conversation_id}/responses")
+    async def continue_conversation(conversation_id: str, request: Request):
+        payload = json.loads(await request.body())
+        stats["chats"] += 1
+        conversation = conversations.get(conversation_id)
+        if (
+            conversation is None
+            or conversation["sso"] != extract_cookie_value(request.headers.get("cookie", ""), "sso")
+            or payload.get("parentResponseId") not in conversation["responses"]
+        ):
+            stats["follow_up_errors"] += 1
+            return JSONResponse(
+                {"error": {"code": 5, "message": "Conversation not found", "details": []}},
+                status_code=404,
+            )
+        rejected = reject()
+        if rejected is not None:
+            return rejected
+        stats["follow_ups"] += 1
+        lines = [_unnest(line) for line in [*build_lines(payload), new_response(conversation_id)]]
+        return StreamingResponse(stream(lines), media_type="application/json")
+
+    @app.post("/rest/app-chat/upload-file")
+    async def upload_file(request: Request):
+        payload = json.loads(await request.body())
+        stats["uploads"] += 1
+        digest = hashlib.sha256(payload["content"].encode()).hexdigest()
+        return {"fileMetadataId": f"file-{digest[:24]}", "fileName": payload["fileName"]}
+
+    @app.post("/rest/rate-limits")
+    async def rate_limits(request: Request):
+        stats["rate_limit_probes"] += 1
+        marker = config.invalid_cookie_marker
+        if marker and marker in request.headers.get("cookie", ""):
+            stats["invalid_cookie_probes"] += 1
+            return JSONResponse(
+                {"error": {"code": 16, "message": "Unauthenticated", "details": []}},
+                status_code=401,
+            )
+        return {
+            "windowSizeSeconds": config.window_size_seconds,
+            "remainingQueries": config.remaining_queries,
+        }
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        return stats
+
+    return app
+
+
+def serve(host: str = "127.0.0.1", port: int = 9000, **kwargs):
+    config = MockGrokConfig(**kwargs)
+    uvicorn.run(create_app(config), host=host, port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    fire.Fire(serve)
@@ -0,0 +1,67 @@
+"""
+Helpers for recorded upstream traces: NDJSON files with one upstream line per
+row, exactly as `/rest/app-chat/conversations/new` streams them.
+"""
+import json
+import random
+from pathlib import Path
+from typing import List
+
+
+def load_trace(path: Path) -> List[str]:
+    with Path(path).open("r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def save_trace(path: Path, lines: List[str]):
+    with Path(path).open("w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(line + "\n")
+
+
+def _line(**response) -> str:
+    return json.dumps({"result": {"response": response}}, ensure_ascii=False)
+
+
+def synthesize_trace(
+    steps: int = 200,
+    tokens_per_step: int = 40,
+    answer_tokens: int = 400,
+    deepsearch: bool = True,
+    seed: int = 0,
+) -> List[str]:
+    """生成一条类似deepsearch/reasoning的上游trace: 多个思考step(含被拆开的工具调用json), 最后是答案"""
+    rng = random.Random(seed)
+    words = ["grok", "搜索", "result", "analysis", "数据", "model", "video", "\n"]
+    lines = []
+    for step in range(1, steps + 1):
+        for _ in range(tokens_per_step):
+            lines.append(
+                _line(token=rng.choice(words) + " ", isThinking=True, messageStepId=step)
+            )
+        if deepsearch and step % 3 == 0:
+            tool_call = json.dumps(
+                {
+                    "action": "web_search",
+                    "action_input": {"query": f"step {step} query", "num_results": 10},
+                }
+            )
+            # 工具调用json被拆成几段token发送
+            for start in range(0, len(tool_call), 17):
+                lines.append(
+                    _line(
+                        token=tool_call[start:start + 17],
+                        isThinking=True,
+                        messageStepId=step,
+                    )
+                )
+    answer = []
+    for _ in range(answer_tokens):
+        token = rng.choice(words) + " "
+        answer.append(token)
+        lines.append(_line(token=token, isThinking=False, messageStepId=steps + 1))
+    if deepsearch:
+        lines.append(
+            _line(token="", isThinking=False, modelResponse={"message": "".join(answer)})
+        )
+    return lines
@@ -1,37 +1,50 @@
 import argparse
-import os
 
-import fire
 import uvicorn
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
 
 from revgrokapi.configs import LOG_DIR
+from revgrokapi.drain import FORCE_CLOSE_TIMEOUT_SECONDS, DrainingServer
 from revgrokapi.lifespan import lifespan
 from revgrokapi.middlewares.register_middlewares import register_middleware
 from revgrokapi.router import router
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--host", default="0.0.0.0", help="host")
-parser.add_argument("--port", default=3648, help="port")
-args = parser.parse_args()
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 3648
+
 logger.add(LOG_DIR / "log_file.log", rotation="1 week")  # 每周轮换一次文件
 
 app = FastAPI(lifespan=lifespan)
 app = register_middleware(app)
 
 
-def start_server(port=args.port, host=args.host):
+def start_server(port=DEFAULT_PORT, host=DEFAULT_HOST):
     logger.info(f"Starting server at {host}:{port}")
     app.include_router(router)
-    config = uvicorn.Config(app, host=host, port=port)
-    server = uvicorn.Server(config=config)
+    config = uvicorn.Config(
+        app,
+        host=host,
+        port=port,
+        timeout_graceful_shutdown=FORCE_CLOSE_TIMEOUT_SECONDS,
+    )
+    # 收到SIGTERM后先排空进行中的流式响应, 见 revgrokapi/drain.py
+    server = DrainingServer(config=config)
     try:
         server.run()
     finally:
         logger.info("Server shutdown.")
 
 
+def parse_args(argv=None):
+    # 只在作为脚本运行时解析参数, 导入main(测试/基准)时不读取sys.argv
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=DEFAULT_HOST, help="host")
+    parser.add_argument("--port", default=DEFAULT_PORT, type=int, help="port")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    fire.Fire(start_server)
+    args = parse_args()
+    start_server(port=args.port, host=args.host)
@@ -15,14 +15,117 @@ USE_TOKEN_SHORTEN = True
 DATA_DIR = ROOT / "data"
 
 DB_PATH = DATA_DIR / "db.sqlite3"
-DB_URL = f"sqlite://{DB_PATH}"
+DB_URL = os.environ.get("DB_URL", f"sqlite://{DB_PATH}")
+
+# 生成图片的本地存储目录(按内容hash命名)
+IMAGE_STORE_DIR = DATA_DIR / "images"
+# 对外提供图片链接时使用的地址, 为空时使用请求中的地址
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "")
+
+# 自定义模型注册表, 见 revgrokapi/openai_api/model_registry.py
+MODEL_REGISTRY_PATH = DATA_DIR / "models.json"
+
+# 运行时可热更新的配置, 见 revgrokapi/runtime_settings.py
+RUNTIME_SETTINGS_PATH = DATA_DIR / "settings.json"
+# 多久检查一次配置文件是否被修改
+RUNTIME_SETTINGS_WATCH_INTERVAL_SECONDS = 2
 
 POE_OPENAI_LIKE_API_KEY = "sk-poe-api-dfascvu2"
+# 管理接口(api key管理、用量查询等)使用的key; 没有设置(或和上面共享的key相同)时管理接口关闭
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY", "")
+API_KEY_USAGE_FLUSH_INTERVAL_SECONDS = 30
+# 按cookie/模型的小时用量汇总: 写库间隔和保留天数
+USAGE_FLUSH_INTERVAL_SECONDS = 30
+USAGE_RETENTION_DAYS = int(os.environ.get("USAGE_RETENTION_DAYS", 90))
+
+# pdf/docx等文档解析使用的进程数
+PROCESS_POOL_WORKERS = int(
+    os.environ.get("PROCESS_POOL_WORKERS", min(4, os.cpu_count() or 1))
+)
+# 按内容hash缓存的文档解析结果条数
+DOCUMENT_TEXT_CACHE_SIZE = 256
+
+# 请求耗时追踪, 见 revgrokapi/tracing
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "1") != "0"
+# 保留最近多少个请求的trace, 用于查询最慢的请求
+TRACE_BUFFER_SIZE = 512
+# 安装了opentelemetry时是否同时导出到OpenTelemetry
+TRACING_OTEL_EXPORT = os.environ.get("TRACING_OTEL_EXPORT", "0") == "1"
 
 GROK_CLIENT_LIMIT_CHECKS_INTERVAL_MINUTES = 1 * 60
+# 每个cookie复用的GrokClient(curl session)的最大数量
+GROK_CLIENT_POOL_SIZE = 1024
+# rate limit探测结果的缓存时间, 期间重复的刷新直接使用缓存
+RATE_LIMIT_PROBE_TTL_SECONDS = 5 * 60
+# 同时探测的cookie数量
+RATE_LIMIT_PROBE_CONCURRENCY = 10
+# 额度用完但不知道窗口长度时, 多久之后重新探测
+WINDOW_RECOVERY_FALLBACK_SECONDS = 15 * 60
+# 窗口结束时探测失败, 多久之后重试
+WINDOW_RECOVERY_RETRY_SECONDS = 60
+# 内存中的cookie池(id和各类别权重)多久从数据库重新加载一次, 同步其他worker写入的权重
+COOKIE_POOL_RELOAD_SECONDS = 60
+# 连续这么多次探测都返回401/403的cookie被隔离, 不再参与选择和常规刷新
+COOKIE_QUARANTINE_THRESHOLD = int(os.environ.get("COOKIE_QUARANTINE_THRESHOLD", 3))
+# 隔离的cookie每隔这么久复查一次, 恢复有效的重新启用
+COOKIE_QUARANTINE_RECHECK_HOURS = 6
 
 PROXIES = {}
 
+# 代理池, 逗号分隔, 如 http://127.0.0.1:7890,socks5://10.0.0.2:1080; 为空时所有请求使用PROXIES
+PROXY_POOL = [
+    proxy.strip() for proxy in os.environ.get("GROK_PROXIES", "").split(",") if proxy.strip()
+]
+# 代理健康检查间隔
+PROXY_HEALTH_CHECK_INTERVAL_SECONDS = 60
+# 单个代理的并发请求数达到这个值时视为满载, 分配新cookie时降低优先级
+PROXY_MAX_IN_FLIGHT = 64
+# cookie绑定到代理后至少保持这么久, 才会因为代理变慢/被挑战而迁移(代理不可用时立即迁移)
+PROXY_REBALANCE_MIN_SECONDS = 5 * 60
+
+# 上游流超时(首行/空闲/总时长)后cookie的选中权重减半, 惩罚按这个半衰期衰减
+COOKIE_HEALTH_HALF_LIFE_SECONDS = 10 * 60
+# 权重最多降到原来的这么多倍, 让被惩罚的cookie仍有机会被选中、恢复
+COOKIE_HEALTH_MIN_WEIGHT_FACTOR = 0.05
+
+# 对冲请求: 每个模型保留最近多少个首行延迟样本, 至少多少个样本才按百分位计算阈值
+HEDGE_TTFT_WINDOW = 512
+HEDGE_MIN_SAMPLES = 20
+# 对冲预算最多累积的令牌数, 限制长时间没有对冲后的突发
+HEDGE_BUDGET_MAX_BALANCE = 10
+# 对冲时最多尝试选几次cookie, 选不到和主请求不同的cookie就放弃对冲
+HEDGE_SELECT_ATTEMPTS = 3
+
+# batch接口(/v1/files, /v1/batches)的输入/输出文件目录, 见 revgrokapi/openai_api/batches.py
+BATCH_DIR = DATA_DIR / "batches"
+# 上传文件大小和单个batch请求数的上限(和openai一致)
+BATCH_MAX_FILE_BYTES = 200 * 1024 * 1024
+BATCH_MAX_REQUESTS = 50_000
+# 目前只支持24h, 超时未完成的请求写入错误文件
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_COMPLETION_WINDOW_SECONDS = 24 * 60 * 60
+# 执行期间每隔多久把进度写回数据库
+BATCH_PROGRESS_SAVE_INTERVAL_SECONDS = 5
+# 没有可用名额时多久重新检查一次(交互请求和可用cookie的变化没有通知)
+BATCH_THROTTLE_POLL_SECONDS = 0.5
+# 各类别可用cookie数的缓存时间
+BATCH_CAPACITY_CACHE_SECONDS = 30
+# 每次从输入文件读取的行数
+BATCH_READ_CHUNK_LINES = 500
+
+# 多轮会话(WebSocket /v1/chat/sessions), 见 revgrokapi/openai_api/chat_sessions.py
+# 服务端心跳间隔; 没有客户端消息也没有进行中的回复超过这么久就断开
+CHAT_SESSION_HEARTBEAT_SECONDS = 20
+CHAT_SESSION_IDLE_SECONDS = float(os.environ.get("CHAT_SESSION_IDLE_SECONDS", 10 * 60))
+# 同时保持的会话数上限, 每个会话保留的历史消息数上限
+CHAT_SESSION_MAX_SESSIONS = int(os.environ.get("CHAT_SESSION_MAX_SESSIONS", 1000))
+CHAT_SESSION_MAX_MESSAGES = 200
+
+# 收到SIGTERM后等待进行中的流式响应完成的最长时间, 超时后强制关闭
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("DRAIN_TIMEOUT_SECONDS", 10 * 60))
+# 排空开始后readiness先返回503这么久, 留给负载均衡摘除实例, 之后没有进行中的请求就退出
+DRAIN_READINESS_DELAY_SECONDS = float(os.environ.get("DRAIN_READINESS_DELAY_SECONDS", 0))
+
 
 # PROXIES = {
 #     "http": "http://127.0.0.1:7890",
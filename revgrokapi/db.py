@@ -2,6 +2,7 @@ from loguru import logger
 from tortoise import Tortoise
 
 from revgrokapi.configs import DB_URL
+from revgrokapi.migrations import run_migrations
 
 # lifespan.py
 
@@ -9,4 +10,10 @@ from revgrokapi.configs import DB_URL
 async def init_db():
     await Tortoise.init(db_url=DB_URL, modules={"models": ["revgrokapi.models"]})
     await Tortoise.generate_schemas()
+    await run_migrations()
     logger.info(f"Tortoise-ORM started, database connected: {DB_URL}")
+
+
+async def close_db():
+    await Tortoise.close_connections()
+    logger.info("Tortoise-ORM connections closed")
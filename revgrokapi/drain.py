@@ -0,0 +1,110 @@
+"""
+revgrokapi/drain.py
+
+Graceful shutdown. Uvicorn stops listening and gives open connections only a
+short grace period as soon as it gets SIGTERM, which cuts off long SSE streams.
+`DrainingServer` first drains instead: readiness turns 503 and new chats are
+rejected, while streams already admitted keep running until they finish or
+`DRAIN_TIMEOUT_SECONDS` passes. Only then does the usual uvicorn shutdown run,
+followed by the lifespan shutdown that flushes pending writes and closes the
+pooled sessions. A second signal skips the wait.
+"""
+import asyncio
+import time
+from types import FrameType
+from typing import Optional
+
+import uvicorn
+from loguru import logger
+
+from revgrokapi.configs import (DRAIN_READINESS_DELAY_SECONDS,
+                                DRAIN_TIMEOUT_SECONDS)
+from revgrokapi.quota import admission_controller
+
+# 排空结束后uvicorn关闭时, 仍未结束的连接最多再等这么久
+FORCE_CLOSE_TIMEOUT_SECONDS = 5
+DRAIN_POLL_INTERVAL_SECONDS = 0.5
+
+
+class DrainState:
+    __slots__ = ("started_at", "finished_at")
+
+    def __init__(self):
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def draining(self) -> bool:
+        return admission_controller.draining
+
+    def stats(self) -> dict:
+        return {
+            "draining": self.draining,
+            "in_flight": admission_controller.in_flight,
+            "started_at": self.started_at,
+            "timeout_seconds": DRAIN_TIMEOUT_SECONDS,
+        }
+
+
+drain_state = DrainState()
+
+
+async def drain(timeout: float = DRAIN_TIMEOUT_SECONDS) -> bool:
+    """停止接收新请求并等待进行中的请求完成, 返回是否在超时前全部完成"""
+    admission_controller.start_draining()
+    drain_state.started_at = time.time()
+    logger.info(
+        f"Draining: {admission_controller.in_flight} requests in flight, "
+        f"waiting up to {timeout:.0f}s"
+    )
+    await asyncio.sleep(DRAIN_READINESS_DELAY_SECONDS)
+    deadline = time.monotonic() + timeout
+    while admission_controller.in_flight > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(DRAIN_POLL_INTERVAL_SECONDS)
+    drain_state.finished_at = time.time()
+    remaining = admission_controller.in_flight
+    if remaining:
+        logger.warning(f"Drain timed out with {remaining} requests still in flight")
+    else:
+        logger.info(
+            f"Drained in {drain_state.finished_at - drain_state.started_at:.1f}s"
+        )
+    return remaining == 0
+
+
+class DrainingServer(uvicorn.Server):
+    """第一次SIGTERM/SIGINT先排空再退出, 第二次立即进入uvicorn的正常关闭"""
+
+    def __init__(self, config: uvicorn.Config):
+        super().__init__(config)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._drain_task: Optional[asyncio.Task] = None
+
+    async def serve(self, sockets=None):
+        self._loop = asyncio.get_running_loop()
+        await super().serve(sockets)
+
+    def handle_exit(self, sig: int, frame: Optional[FrameType]) -> None:
+        if self._loop is None or self.should_exit:
+            super().handle_exit(sig, frame)
+        elif self._drain_task is None:
+            # 信号处理函数里不能直接操作事件循环
+            self._loop.call_soon_threadsafe(self._start_drain, sig)
+        else:
+            self._loop.call_soon_threadsafe(self._stop_drain)
+            super().handle_exit(sig, frame)
+
+    def _start_drain(self, sig: int):
+        if self._drain_task is None and not self.should_exit:
+            self._drain_task = asyncio.create_task(self._drain_then_exit(sig))
+
+    def _stop_drain(self):
+        logger.warning("Second signal received, stop draining")
+        self._drain_task.cancel()
+
+    async def _drain_then_exit(self, sig: int):
+        try:
+            await drain()
+        finally:
+            if not self.should_exit:
+                super().handle_exit(sig, None)
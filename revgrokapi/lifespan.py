@@ -3,23 +3,60 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from loguru import logger
 
-from revgrokapi.db import init_db
+from revgrokapi.db import close_db, init_db
+from revgrokapi.openai_api.batches import batch_runner
+from revgrokapi.openai_api.chat_sessions import chat_session_manager
 from revgrokapi.periodic_checks.limit_sheduler import LimitScheduler
+from revgrokapi.periodic_checks.rate_limit_probe import rate_limit_prober
+from revgrokapi.periodic_checks.window_recovery import \
+    window_recovery_scheduler
+from revgrokapi.pool import cookie_pool
+from revgrokapi.quota import api_key_manager, usage_accounting
+from revgrokapi.revgrok import grok_client_pool, proxy_pool
+from revgrokapi.runtime_settings import runtime_settings
+from revgrokapi.utils.async_task_utils import shutdown_process_pool
+from revgrokapi.utils.auth_utils import admin_api_key
 from revgrokapi.utils.time_zone_utils import set_cn_time_zone
 
 # from rev_claude.client.client_manager import ClientManager
 
+# 停机时等待进行中的额度刷新写完权重的最长时间
+REFRESH_SHUTDOWN_TIMEOUT_SECONDS = 10
+
 
 async def on_startup():
     logger.info("Lifespan Starting up")
     set_cn_time_zone()
     await init_db()
+    await api_key_manager.load()
+    await runtime_settings.start()
+    if admin_api_key() is None:
+        logger.warning("ADMIN_API_KEY is not set, admin endpoints are disabled")
+    # 启动时的刷新和之后的请求都从内存中的cookie池选择
+    await cookie_pool.load()
+    # 先注册恢复调度, 启动时的刷新结果才会被安排恢复
+    await window_recovery_scheduler.start()
+    await proxy_pool.start()
     await LimitScheduler.start()
+    # 上次停机时没执行完的batch继续执行
+    await batch_runner.start()
 
 
 async def on_shutdown():
     logger.info("Lifespan Shutting down")
+    # 先停掉会产生新写入的后台任务, 再把未落库的权重/用量写完, 最后关闭连接
+    await batch_runner.shutdown()
+    await chat_session_manager.shutdown()
     await LimitScheduler.shutdown()
+    await window_recovery_scheduler.shutdown()
+    await rate_limit_prober.shutdown(REFRESH_SHUTDOWN_TIMEOUT_SECONDS)
+    await proxy_pool.shutdown()
+    await runtime_settings.shutdown()
+    await api_key_manager.flush()
+    await usage_accounting.flush()
+    shutdown_process_pool()
+    await grok_client_pool.close_all()
+    await close_db()
 
 
 @asynccontextmanager
@@ -0,0 +1,256 @@
+"""
+revgrokapi/migrations.py
+
+`Tortoise.generate_schemas()` only creates missing tables, so columns and
+indexes added to existing models are applied here. Every migration is
+idempotent: a column or index is added only if the table does not have it
+yet, data backfills only touch rows that still need them, and constraints
+dropped from a model are removed only while they still exist.
+"""
+import re
+from typing import List, Tuple
+
+from loguru import logger
+from tortoise import Tortoise
+
+# 回填时每批处理的行数
+BACKFILL_BATCH_SIZE = 1000
+
+# (表, 列, 列定义)
+COLUMN_MIGRATIONS: List[Tuple[str, str, str]] = [
+    ("cookie_queries", "window_size_seconds", "INT NOT NULL DEFAULT 0"),
+    ("cookie_queries", "exhausted_at", "TIMESTAMP NULL"),
+    ("cookie", "cookie_hash", "VARCHAR(64) NULL"),
+    ("cookie", "status", "VARCHAR(16) NOT NULL DEFAULT 'active'"),
+    ("cookie", "invalid_count", "INT NOT NULL DEFAULT 0"),
+    ("cookie", "quarantined_at", "TIMESTAMP NULL"),
+]
+
+# (索引名, 表, 列, 是否唯一), 同样的列上已有索引时跳过(新库由generate_schemas创建)
+INDEX_MIGRATIONS: List[Tuple[str, str, Tuple[str, ...], bool]] = [
+    ("uid_cookie_cookie_hash", "cookie", ("cookie_hash",), True),
+    ("idx_cookie_account", "cookie", ("account",), False),
+    ("idx_cookie_status", "cookie", ("status",), False),
+    (
+        "idx_cookie_queries_category_weight",
+        "cookie_queries",
+        ("category", "queries_weight"),
+        False,
+    ),
+]
+
+
+async def _existing_columns(connection, table: str) -> set:
+    if connection.capabilities.dialect == "sqlite":
+        rows = await connection.execute_query_dict(f'PRAGMA table_info("{table}")')
+        return {row["name"] for row in rows}
+    rows = await connection.execute_query_dict(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = $1",
+        [table],
+    )
+    return {row["column_name"] for row in rows}
+
+
+async def _existing_indexes(connection, table: str) -> set:
+    """表上已有索引的列组合, 如 {("cookie_hash",), ("category", "queries_weight")}"""
+    if connection.capabilities.dialect == "sqlite":
+        indexes = await connection.execute_query_dict(f'PRAGMA index_list("{table}")')
+        result = set()
+        for index in indexes:
+            columns = await connection.execute_query_dict(
+                f'PRAGMA index_info("{index["name"]}")'
+            )
+            columns = sorted(columns, key=lambda column: column["seqno"])
+            result.add(tuple(column["name"] for column in columns))
+        return result
+    rows = await connection.execute_query_dict(
+        "SELECT i.relname AS index_name, a.attname AS column_name "
+        "FROM pg_class t "
+        "JOIN pg_index ix ON t.oid = ix.indrelid "
+        "JOIN pg_class i ON i.oid = ix.indexrelid "
+        "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(ix.indkey) "
+        "WHERE t.relname = $1 "
+        "ORDER BY i.relname, array_position(ix.indkey::int2[], a.attnum)",
+        [table],
+    )
+    columns_by_index = {}
+    for row in rows:
+        columns_by_index.setdefault(row["index_name"], []).append(row["column_name"])
+    return {tuple(columns) for columns in columns_by_index.values()}
+
+
+async def _unique_cookie_indexes(connection) -> List[dict]:
+    """cookie表上只含cookie列的唯一索引(旧版本的unique=True)"""
+    if connection.capabilities.dialect == "sqlite":
+        indexes = await connection.execute_query_dict('PRAGMA index_list("cookie")')
+        result = []
+        for index in indexes:
+            if not index["unique"]:
+                continue
+            columns = await connection.execute_query_dict(
+                f'PRAGMA index_info("{index["name"]}")'
+            )
+            if [column["name"] for column in columns] == ["cookie"]:
+                result.append(index)
+        return result
+    return await connection.execute_query_dict(
+        "SELECT i.relname AS name, con.conname AS constraint_name "
+        "FROM pg_class t "
+        "JOIN pg_index ix ON t.oid = ix.indrelid "
+        "JOIN pg_class i ON i.oid = ix.indexrelid "
+        "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(ix.indkey) "
+        "LEFT JOIN pg_constraint con ON con.conindid = ix.indexrelid "
+        "WHERE t.relname = 'cookie' AND ix.indisunique AND ix.indnatts = 1 "
+        "AND a.attname = 'cookie'"
+    )
+
+
+async def _rebuild_sqlite_cookie_table(connection):
+    """sqlite不能删除列约束生成的索引, 只能按去掉UNIQUE后的定义重建cookie表"""
+    rows = await connection.execute_query_dict(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'cookie'"
+    )
+    table_sql = rows[0]["sql"]
+    new_sql, replaced = re.subn(
+        r'([(,]\s*"cookie"\s+)VARCHAR\(\d+\)([^,]*?)\s+UNIQUE\b',
+        r"\1TEXT\2",
+        table_sql,
+        count=1,
+    )
+    if not replaced:
+        logger.warning("Migration: unexpected cookie table definition, keeping it")
+        return False
+    new_sql = re.sub(
+        r'^CREATE TABLE (IF NOT EXISTS )?"cookie"',
+        'CREATE TABLE "cookie__new"',
+        new_sql,
+        count=1,
+    )
+    columns = ", ".join(
+        f'"{row["name"]}"'
+        for row in await connection.execute_query_dict('PRAGMA table_info("cookie")')
+    )
+    # 显式创建的索引会随旧表一起删除, 重建后按原定义再建一次
+    index_sqls = [
+        row["sql"]
+        for row in await connection.execute_query_dict(
+            "SELECT sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = 'cookie' AND sql IS NOT NULL"
+        )
+    ]
+    # 删除旧表时cookie_queries的外键会级联删除, 重建期间先关掉外键检查
+    statements = [
+        "PRAGMA foreign_keys=OFF",
+        "BEGIN",
+        new_sql,
+        f'INSERT INTO "cookie__new" ({columns}) SELECT {columns} FROM "cookie"',
+        'DROP TABLE "cookie"',
+        'ALTER TABLE "cookie__new" RENAME TO "cookie"',
+        *index_sqls,
+        "COMMIT",
+        "PRAGMA foreign_keys=ON",
+    ]
+    try:
+        await connection.execute_script(";\n".join(statements) + ";")
+    except Exception:
+        await connection.execute_script("ROLLBACK; PRAGMA foreign_keys=ON;")
+        raise
+    return True
+
+
+async def drop_cookie_unique_constraint():
+    """cookie的唯一性由cookie_hash保证后, 去掉cookie列上旧的唯一约束并把列改为TEXT"""
+    from revgrokapi.models.cookie_models import Cookie
+
+    connection = Tortoise.get_connection("default")
+    if ("cookie_hash",) not in await _existing_indexes(connection, "cookie"):
+        return
+    if await Cookie.filter(cookie_hash__isnull=True).exists():
+        return
+    indexes = await _unique_cookie_indexes(connection)
+    if connection.capabilities.dialect == "sqlite":
+        if not indexes:
+            return
+        # origin为"c"的是CREATE INDEX建的, 其余("u")来自列上的UNIQUE
+        if any(index["origin"] != "c" for index in indexes):
+            if not await _rebuild_sqlite_cookie_table(connection):
+                return
+        else:
+            for index in indexes:
+                await connection.execute_script(f'DROP INDEX "{index["name"]}"')
+        logger.info("Migration: dropped unique index on cookie.cookie")
+        return
+
+    for index in indexes:
+        if index["constraint_name"]:
+            await connection.execute_script(
+                f'ALTER TABLE "cookie" DROP CONSTRAINT "{index["constraint_name"]}"'
+            )
+        else:
+            await connection.execute_script(f'DROP INDEX "{index["name"]}"')
+        logger.info(f"Migration: dropped unique index {index['name']} on cookie.cookie")
+    rows = await connection.execute_query_dict(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'cookie' AND column_name = 'cookie'"
+    )
+    if rows and rows[0]["data_type"] != "text":
+        await connection.execute_script('ALTER TABLE "cookie" ALTER COLUMN "cookie" TYPE TEXT')
+        logger.info("Migration: changed cookie.cookie to TEXT")
+
+
+async def backfill_cookie_hashes():
+    """给迁移前的cookie补上cookie_hash"""
+    from revgrokapi.models.cookie_models import Cookie, hash_cookie
+
+    total = 0
+    while True:
+        cookies = await Cookie.filter(cookie_hash__isnull=True).limit(BACKFILL_BATCH_SIZE)
+        if not cookies:
+            break
+        for cookie in cookies:
+            cookie.cookie_hash = hash_cookie(cookie.cookie)
+        await Cookie.bulk_update(cookies, fields=["cookie_hash"])
+        total += len(cookies)
+    if total:
+        logger.info(f"Migration: backfilled cookie_hash for {total} cookies")
+
+
+# 在加列之后、建索引之前执行(唯一索引需要先有数据)
+DATA_MIGRATIONS = [backfill_cookie_hashes]
+
+# 在建索引之后执行, 替代它们的索引已经存在
+POST_INDEX_MIGRATIONS = [drop_cookie_unique_constraint]
+
+
+async def run_migrations():
+    connection = Tortoise.get_connection("default")
+    columns_cache = {}
+    for table, column, definition in COLUMN_MIGRATIONS:
+        if table not in columns_cache:
+            columns_cache[table] = await _existing_columns(connection, table)
+        if column in columns_cache[table]:
+            continue
+        await connection.execute_script(
+            f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}'
+        )
+        columns_cache[table].add(column)
+        logger.info(f"Migration: added column {table}.{column}")
+
+    for migration in DATA_MIGRATIONS:
+        await migration()
+
+    indexes_cache = {}
+    for name, table, columns, unique in INDEX_MIGRATIONS:
+        if table not in indexes_cache:
+            indexes_cache[table] = await _existing_indexes(connection, table)
+        if columns in indexes_cache[table]:
+            continue
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        await connection.execute_script(
+            f'CREATE {"UNIQUE " if unique else ""}INDEX "{name}" ON "{table}" ({column_list})'
+        )
+        indexes_cache[table].add(columns)
+        logger.info(f"Migration: created index {name} on {table}({column_list})")
+
+    for migration in POST_INDEX_MIGRATIONS:
+        await migration()
@@ -1,2 +1,5 @@
+from revgrokapi.models.api_key_models import ApiKey
 from revgrokapi.models.base import CRUDBase
+from revgrokapi.models.batch_models import Batch, BatchFile
 from revgrokapi.models.cookie_models import Cookie, CookieQueries, CookieType
+from revgrokapi.models.usage_models import UsageHourly
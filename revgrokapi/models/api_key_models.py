@@ -0,0 +1,48 @@
+"""
+revgrokapi/models/api_key_models.py
+
+This file defines the tortoise based models for the api keys and their budgets.
+"""
+from typing import Any, Dict
+
+from tortoise import fields
+
+from revgrokapi.models.base import CRUDBase
+
+
+class ApiKey(CRUDBase):
+    key = fields.CharField(max_length=128, unique=True)
+    name = fields.CharField(max_length=254, default="")
+    is_active = fields.BooleanField(default=True)
+
+    # 令牌桶限速, 0 表示不限制
+    requests_per_minute = fields.IntField(default=0)
+    tokens_per_minute = fields.IntField(default=0)
+
+    # 总额度, 0 表示不限制
+    request_quota = fields.BigIntField(default=0)
+    token_quota = fields.BigIntField(default=0)
+
+    # 已用量, 由内存中的计数器周期性累加写入
+    used_requests = fields.BigIntField(default=0)
+    used_prompt_tokens = fields.BigIntField(default=0)
+    used_completion_tokens = fields.BigIntField(default=0)
+
+    class Meta:
+        table = "api_keys"
+
+    async def to_dict(self) -> Dict[str, Any]:
+        """Convert the model instance to a dictionary, similar to pydantic's model_dump."""
+        return {
+            "id": self.id,
+            "key": self.key,
+            "name": self.name,
+            "is_active": self.is_active,
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "request_quota": self.request_quota,
+            "token_quota": self.token_quota,
+            "used_requests": self.used_requests,
+            "used_prompt_tokens": self.used_prompt_tokens,
+            "used_completion_tokens": self.used_completion_tokens,
+        }
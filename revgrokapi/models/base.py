@@ -1,5 +1,6 @@
 # base.py
-from typing import Any, Dict, List, Optional, TypeVar
+from typing import (Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple,
+                    TypeVar)
 
 from pydantic import BaseModel
 from tortoise import Model, fields
@@ -36,6 +37,71 @@ class CRUDBase(Model):
             query = query.order_by(order_by)
         return await query.offset(skip).limit(limit)
 
+    @classmethod
+    def check_fields(cls, fields: Sequence[str]) -> List[str]:
+        """校验要投影的字段, 总是包含id(作为分页的游标)"""
+        unknown = [field for field in fields if field not in cls._meta.db_fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        return ["id", *[field for field in fields if field != "id"]]
+
+    @classmethod
+    async def get_page(
+        cls,
+        *,
+        cursor: Optional[int] = None,
+        limit: int = 100,
+        descending: bool = True,
+        fields: Optional[Sequence[str]] = None,
+        **filters,
+    ) -> Tuple[List[Any], Optional[int]]:
+        """按id的keyset分页, 不用offset, 翻到后面的页也只扫描limit条
+
+        参数:
+            cursor: 上一页返回的next_cursor, 第一页为None
+            fields: 只取这些字段, 返回dict而不是模型对象(避免加载大字段)
+
+        返回:
+            (记录, 下一页的cursor), 没有下一页时cursor为None
+        """
+        query = cls.filter(**filters)
+        if cursor is not None:
+            query = query.filter(id__lt=cursor) if descending else query.filter(id__gt=cursor)
+        # 多取一条用来判断是否还有下一页
+        query = query.order_by("-id" if descending else "id").limit(limit + 1)
+        if fields:
+            rows = await query.values(*cls.check_fields(fields))
+        else:
+            rows = await query
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = last["id"] if fields else last.id
+        return rows, next_cursor
+
+    @classmethod
+    async def iterate_batches(
+        cls,
+        batch_size: int = 1000,
+        fields: Optional[Sequence[str]] = None,
+        **filters,
+    ) -> AsyncIterator[List[Any]]:
+        """按id升序分批遍历全表, 每次只在内存中保留一批"""
+        cursor = None
+        while True:
+            rows, cursor = await cls.get_page(
+                cursor=cursor,
+                limit=batch_size,
+                descending=False,
+                fields=fields,
+                **filters,
+            )
+            if rows:
+                yield rows
+            if cursor is None:
+                return
+
     @classmethod
     async def get_count(cls, **filters) -> int:
         """获取记录总数"""
@@ -81,14 +147,19 @@ class CRUDBase(Model):
         skip: int = 0,
         limit: int = 100,
         order_by: str = "-id",
+        lookup: str = "icontains",
     ) -> List[ModelType]:
-        """搜索记录"""
+        """搜索记录
+
+        lookup默认icontains(子串匹配, 需要全表扫描), 字段有索引时可以用exact或startswith
+        """
         if not search_term or not search_fields:
             return await cls.get_multi(skip=skip, limit=limit, order_by=order_by)
 
         q_filters = Q()
         for field in search_fields:
-            q_filters |= Q(**{f"{field}__icontains": search_term})
+            key = field if lookup == "exact" else f"{field}__{lookup}"
+            q_filters |= Q(**{key: search_term})
 
         query = cls.filter(q_filters)
         if order_by:
@@ -0,0 +1,130 @@
+"""
+revgrokapi/models/batch_models.py
+
+This file defines the tortoise based models for OpenAI compatible files and
+batches (see revgrokapi/openai_api/batches.py). File contents live on disk
+under BATCH_DIR, the tables only keep their metadata and the batch progress.
+"""
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Optional
+
+from tortoise import fields
+
+from revgrokapi.models.base import CRUDBase
+
+
+class FilePurpose(str, Enum):
+    BATCH = "batch"
+    BATCH_OUTPUT = "batch_output"
+
+
+class BatchStatus(str, Enum):
+    VALIDATING = "validating"
+    FAILED = "failed"
+    IN_PROGRESS = "in_progress"
+    FINALIZING = "finalizing"
+    COMPLETED = "completed"
+    EXPIRED = "expired"
+    CANCELLING = "cancelling"
+    CANCELLED = "cancelled"
+
+
+# 还需要后台继续处理的状态, 重启后从这些状态恢复
+ACTIVE_BATCH_STATUSES = (
+    BatchStatus.VALIDATING,
+    BatchStatus.IN_PROGRESS,
+    BatchStatus.FINALIZING,
+    BatchStatus.CANCELLING,
+)
+
+
+def _timestamp(value: Optional[datetime]) -> Optional[int]:
+    return int(value.timestamp()) if value is not None else None
+
+
+class BatchFile(CRUDBase):
+    file_id = fields.CharField(max_length=64, unique=True)
+    # 上传者的api key, 只有上传者(和管理员)可以访问
+    api_key = fields.CharField(max_length=128, index=True)
+    filename = fields.CharField(max_length=254)
+    purpose = fields.CharEnumField(enum_type=FilePurpose, max_length=32)
+    # 输出文件在batch执行期间会不断变大, 结束时更新
+    bytes = fields.BigIntField(default=0)
+
+    class Meta:
+        table = "batch_files"
+
+    def to_openai(self, size: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "id": self.file_id,
+            "object": "file",
+            "bytes": self.bytes if size is None else size,
+            "created_at": _timestamp(self.created_at),
+            "filename": self.filename,
+            "purpose": self.purpose.value,
+            "status": "processed",
+        }
+
+
+class Batch(CRUDBase):
+    batch_id = fields.CharField(max_length=64, unique=True)
+    api_key = fields.CharField(max_length=128, index=True)
+    endpoint = fields.CharField(max_length=64)
+    input_file_id = fields.CharField(max_length=64)
+    # 输出/错误文件在创建batch时就分配好, 执行期间即可下载已经完成的部分
+    output_file_id = fields.CharField(max_length=64)
+    error_file_id = fields.CharField(max_length=64)
+    completion_window = fields.CharField(max_length=16)
+    status = fields.CharEnumField(
+        enum_type=BatchStatus, max_length=32, default=BatchStatus.VALIDATING, index=True
+    )
+    # 生成图片的链接使用的地址(创建batch的请求的base url)
+    base_url = fields.CharField(max_length=254, default="")
+
+    total = fields.IntField(default=0)
+    completed = fields.IntField(default=0)
+    failed = fields.IntField(default=0)
+
+    errors = fields.JSONField(null=True)
+    metadata = fields.JSONField(null=True)
+
+    expires_at = fields.DatetimeField(null=True)
+    in_progress_at = fields.DatetimeField(null=True)
+    finalizing_at = fields.DatetimeField(null=True)
+    completed_at = fields.DatetimeField(null=True)
+    failed_at = fields.DatetimeField(null=True)
+    expired_at = fields.DatetimeField(null=True)
+    cancelling_at = fields.DatetimeField(null=True)
+    cancelled_at = fields.DatetimeField(null=True)
+
+    class Meta:
+        table = "batches"
+
+    def to_openai(self) -> Dict[str, Any]:
+        return {
+            "id": self.batch_id,
+            "object": "batch",
+            "endpoint": self.endpoint,
+            "errors": self.errors,
+            "input_file_id": self.input_file_id,
+            "completion_window": self.completion_window,
+            "status": self.status.value,
+            "output_file_id": self.output_file_id,
+            "error_file_id": self.error_file_id,
+            "created_at": _timestamp(self.created_at),
+            "in_progress_at": _timestamp(self.in_progress_at),
+            "expires_at": _timestamp(self.expires_at),
+            "finalizing_at": _timestamp(self.finalizing_at),
+            "completed_at": _timestamp(self.completed_at),
+            "failed_at": _timestamp(self.failed_at),
+            "expired_at": _timestamp(self.expired_at),
+            "cancelling_at": _timestamp(self.cancelling_at),
+            "cancelled_at": _timestamp(self.cancelled_at),
+            "request_counts": {
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed,
+            },
+            "metadata": self.metadata,
+        }
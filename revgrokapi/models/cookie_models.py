@@ -3,12 +3,16 @@ revgrokapi/models/cookie_models.py
 
 This file defines the tortoise based models for the cookie to restore.
 """
+import hashlib
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from enum import Enum
-from typing import Any, Dict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-import numpy as np
-from loguru import logger
 from tortoise import fields
+from tortoise.expressions import F, Q
+from tortoise.functions import Sum
+from tortoise.transactions import in_transaction
 
 from revgrokapi.models.base import CRUDBase
 
@@ -19,10 +23,44 @@ class CookieType(str, Enum):  # 注意这里继承 str
     TEST = "test"
 
 
+class CookieStatus(str, Enum):
+    ACTIVE = "active"
+    # 多次探测都是401/403, 不参与选择和常规刷新, 只低频复查
+    QUARANTINED = "quarantined"
+
+
+def hash_cookie(cookie: str) -> str:
+    return hashlib.sha256(cookie.encode()).hexdigest()
+
+
+class CookieRecord:
+    """选择、探测时用到的cookie热字段, 代替完整的Cookie模型实例(没有时间字段和关联对象)"""
+
+    __slots__ = ("id", "cookie", "account", "cookie_type")
+    FIELDS = __slots__
+
+    def __init__(self, id: int, cookie: str, account: str, cookie_type: "CookieType"):
+        self.id = id
+        self.cookie = cookie
+        self.account = account
+        self.cookie_type = cookie_type
+
+    def __repr__(self):
+        return f"CookieRecord(id={self.id}, account={self.account!r})"
+
+
 class Cookie(CRUDBase):
-    cookie = fields.CharField(max_length=4000, unique=True)
+    # cookie可能有几KB, 唯一性和查找都通过定长的cookie_hash
+    cookie = fields.TextField()
+    cookie_hash = fields.CharField(max_length=64, unique=True)
     cookie_type = fields.CharEnumField(enum_type=CookieType, max_length=50)
-    account = fields.CharField(max_length=254)
+    account = fields.CharField(max_length=254, index=True)
+    # 索引由migrations创建: 对已有的表generate_schemas会在加列之前建索引,
+    # sqlite把不存在的列名当作字符串字面量, 建出来的索引是错的
+    status = fields.CharEnumField(enum_type=CookieStatus, max_length=16, default=CookieStatus.ACTIVE)
+    # 连续探测为失效的次数, 探测成功一次就清零
+    invalid_count = fields.IntField(default=0)
+    quarantined_at = fields.DatetimeField(null=True)
     # cookie = await Cookie.create_item(
     #     cookie="your_cookie_string",
     #     cookie_type=CookieType.PLUS,  # 使用枚举值
@@ -32,6 +70,98 @@ class Cookie(CRUDBase):
     # # 查询指定类型的 cookie
     # plus_cookies = await Cookie.get_multi(cookie_type=CookieType.PLUS)
 
+    async def save(self, *args, **kwargs):
+        self.cookie_hash = hash_cookie(self.cookie)
+        await super().save(*args, **kwargs)
+
+    @classmethod
+    async def get_by_cookie(cls, cookie: str) -> Optional["Cookie"]:
+        return await cls.get_or_none(cookie_hash=hash_cookie(cookie))
+
+    @classmethod
+    async def get_record(cls, cookie_id: int, **filters) -> Optional[CookieRecord]:
+        rows = await cls.filter(id=cookie_id, **filters).values_list(*CookieRecord.FIELDS)
+        return CookieRecord(*rows[0]) if rows else None
+
+    @classmethod
+    async def get_records(
+        cls, *args, order_by: str = "id", limit: Optional[int] = None, **filters
+    ) -> List[CookieRecord]:
+        """按条件读出CookieRecord, 只取需要的列, 不构造模型对象"""
+        query = cls.filter(*args, **filters).order_by(order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        return [CookieRecord(*row) for row in await query.values_list(*CookieRecord.FIELDS)]
+
+    @classmethod
+    async def existing_hashes(cls, cookies: Iterable[str]) -> set:
+        """返回已经存在的cookie的hash, 用于批量导入时去重"""
+        hashes = [hash_cookie(cookie) for cookie in cookies]
+        if not hashes:
+            return set()
+        return set(
+            await cls.filter(cookie_hash__in=hashes).values_list("cookie_hash", flat=True)
+        )
+
+    @classmethod
+    async def find_by_cookie_or_account(
+        cls, search_term: str, skip: int = 0, limit: int = 100, order_by: str = "-id"
+    ) -> List["Cookie"]:
+        """按完整的cookie(可省略"sso=")或账号精确查找, 走cookie_hash和account索引"""
+        query = cls.filter(
+            Q(account=search_term)
+            | Q(cookie_hash=hash_cookie(search_term))
+            | Q(cookie_hash=hash_cookie(f"sso={search_term}"))
+        )
+        if order_by:
+            query = query.order_by(order_by)
+        return await query.offset(skip).limit(limit)
+
+    @classmethod
+    async def record_validity(
+        cls, valid_ids: Iterable[int], invalid_ids: Iterable[int], threshold: int
+    ) -> List[int]:
+        """记录一批探测的有效性, 连续失效threshold次的cookie隔离并把权重置0, 返回新隔离的id"""
+        valid_ids, invalid_ids = list(valid_ids), list(invalid_ids)
+        quarantined: List[int] = []
+        async with in_transaction() as connection:
+            for start in range(0, len(valid_ids), WEIGHT_UPSERT_BATCH_SIZE):
+                await cls.filter(
+                    id__in=valid_ids[start : start + WEIGHT_UPSERT_BATCH_SIZE],
+                    invalid_count__gt=0,
+                ).using_db(connection).update(invalid_count=0)
+            for start in range(0, len(invalid_ids), WEIGHT_UPSERT_BATCH_SIZE):
+                batch = invalid_ids[start : start + WEIGHT_UPSERT_BATCH_SIZE]
+                await cls.filter(id__in=batch).using_db(connection).update(
+                    invalid_count=F("invalid_count") + 1
+                )
+                quarantined += await cls.filter(
+                    id__in=batch,
+                    status=CookieStatus.ACTIVE,
+                    invalid_count__gte=threshold,
+                ).using_db(connection).values_list("id", flat=True)
+            if quarantined:
+                now = datetime.now(timezone.utc)
+                for start in range(0, len(quarantined), WEIGHT_UPSERT_BATCH_SIZE):
+                    batch = quarantined[start : start + WEIGHT_UPSERT_BATCH_SIZE]
+                    await cls.filter(id__in=batch).using_db(connection).update(
+                        status=CookieStatus.QUARANTINED, quarantined_at=now
+                    )
+                    await CookieQueries.filter(cookie_ref_id__in=batch).using_db(
+                        connection
+                    ).update(queries_weight=0)
+        return quarantined
+
+    @classmethod
+    async def reactivate(cls, cookie_ids: Iterable[int]) -> int:
+        """解除隔离, 权重由随后的探测写入"""
+        cookie_ids = list(cookie_ids)
+        if not cookie_ids:
+            return 0
+        return await cls.filter(id__in=cookie_ids).update(
+            status=CookieStatus.ACTIVE, invalid_count=0, quarantined_at=None
+        )
+
     async def to_dict(self) -> Dict[str, Any]:
         """Convert the model instance to a dictionary, similar to pydantic's model_dump."""
         model_dict = {
@@ -39,6 +169,7 @@ class Cookie(CRUDBase):
             "cookie": self.cookie,
             "cookie_type": self.cookie_type.value if self.cookie_type else None,
             "account": self.account,
+            "status": self.status.value if self.status else None,
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
@@ -51,6 +182,26 @@ class QueryCategory(str, Enum):
     DEEPSEARCH = "DEEPSEARCH"
 
 
+# 批量写权重时每条 IN 查询/INSERT 语句包含的cookie/记录数, 不超过sqlite的参数个数限制
+WEIGHT_UPSERT_BATCH_SIZE = 500
+
+
+@dataclass
+class WeightChanges:
+    """批量写入权重的结果"""
+
+    # {cookie_id: {类别: (旧权重, 新权重)}}, 只包含权重变化的条目, 新建的记录旧权重为None
+    changed: Dict[int, Dict[str, Tuple[Optional[int], int]]] = field(default_factory=dict)
+    # {cookie_id: {类别: exhausted_at}}, 本次写入的所有类别, 额度未用完为None
+    exhausted: Dict[int, Dict[str, Optional[datetime]]] = field(default_factory=dict)
+    # 实际写入(新建或有字段变化)的记录数
+    written: int = 0
+
+    @property
+    def changed_count(self) -> int:
+        return sum(len(categories) for categories in self.changed.values())
+
+
 class CookieQueries(CRUDBase):
     # 关联到Cookie表的外键
     cookie_ref = fields.ForeignKeyField("models.Cookie", related_name="queries")
@@ -61,10 +212,18 @@ class CookieQueries(CRUDBase):
     # 查询权重
     queries_weight = fields.IntField(default=0)
 
+    # 上游rate limit的窗口长度, 额度用完后过了这么久才会恢复
+    window_size_seconds = fields.IntField(default=0)
+
+    # 最近一次发现额度用完的时间, 额度未用完时为空
+    exhausted_at = fields.DatetimeField(null=True)
+
     class Meta:
         table = "cookie_queries"
         # 确保cookie和category的组合是唯一的
         unique_together = (("cookie_ref", "category"),)
+        # 按类别筛选权重>0并按权重排序(选择cookie、统计)都走这个索引
+        indexes = (("category", "queries_weight"),)
 
     @classmethod
     async def get_or_create(
@@ -97,24 +256,138 @@ class CookieQueries(CRUDBase):
         返回:
             更新的CookieQueries记录数量
         """
-        updated_count = 0
+        changes = await cls.bulk_upsert_weights({cookie.id: weights})
+        return len(changes.exhausted.get(cookie.id, {}))
+
+    @classmethod
+    async def update_rate_limits(
+        cls, cookie: Cookie, rate_limits: Dict[str, Dict[str, Any]]
+    ) -> Dict[str, Optional[datetime]]:
+        """根据一个cookie的rate limit探测结果更新权重, 返回 {类别: exhausted_at}"""
+        changes = await cls.bulk_update_rate_limits({cookie.id: rate_limits})
+        return changes.exhausted.get(cookie.id, {})
 
-        # 先检查当前的权重
-        current_weights = await cls.get_weights(cookie)
+    @classmethod
+    async def bulk_upsert_weights(
+        cls, weights: Dict[int, Dict[str, int]]
+    ) -> WeightChanges:
+        """批量设置权重: {cookie_id: {类别: 权重}}, 不改变窗口长度和额度用完时间"""
+        return await cls._bulk_apply(
+            weights, lambda weight, current: {"queries_weight": weight}
+        )
+
+    @classmethod
+    async def bulk_update_rate_limits(
+        cls, rate_limits: Dict[int, Dict[str, Dict[str, Any]]]
+    ) -> WeightChanges:
+        """根据一批cookie的rate limit探测结果更新权重、窗口长度和额度用完的时间
 
-        for category_name, weight in weights.items():
-            try:
-                category = QueryCategory(category_name)
-                await cls.update_weight(cookie, category, weight)
-                updated_count += 1
-            except ValueError:
-                # 如果类别名称无效，跳过
-                continue
+        参数:
+            rate_limits: {cookie_id: {类别: {"remainingQueries": 0, "windowSizeSeconds": 7200, "error": ...}}}
+        """
+        now = datetime.now(timezone.utc)
+
+        def to_values(data: Dict[str, Any], current: Dict[str, Any]):
+            remaining = data.get("remainingQueries", 0)
+            exhausted_at = current["exhausted_at"]
+            # 探测出错时不知道窗口何时结束, 不记录用完时间
+            if remaining <= 0 and not data.get("error"):
+                exhausted_at = exhausted_at or now
+            elif remaining > 0:
+                exhausted_at = None
+            values = {"queries_weight": remaining, "exhausted_at": exhausted_at}
+            if data.get("windowSizeSeconds", 0):
+                values["window_size_seconds"] = data["windowSizeSeconds"]
+            return values
+
+        return await cls._bulk_apply(rate_limits, to_values)
+
+    @classmethod
+    async def _bulk_apply(
+        cls,
+        updates: Dict[int, Dict[str, Any]],
+        to_values: Callable[[Any, Dict[str, Any]], Dict[str, Any]],
+    ) -> WeightChanges:
+        """在一个事务中读出现有的值, 只把有变化的记录用 INSERT ... ON CONFLICT DO UPDATE 写回
 
-        # 检查更新后的权重
-        updated_weights = await cls.get_weights(cookie)
+        参数:
+            updates: {cookie_id: {类别: 数据}}
+            to_values: (数据, 当前的字段值) -> 要写入的字段, 未给出的字段保持不变
+        """
+        changes = WeightChanges()
+        defaults = {"queries_weight": 0, "window_size_seconds": 0, "exhausted_at": None}
+        async with in_transaction() as connection:
+            # 只取需要比较的列, 不构造模型对象
+            existing: Dict[Tuple[int, str], Dict[str, Any]] = {}
+            cookie_ids = list(updates)
+            for start in range(0, len(cookie_ids), WEIGHT_UPSERT_BATCH_SIZE):
+                rows = await cls.filter(
+                    cookie_ref_id__in=cookie_ids[start : start + WEIGHT_UPSERT_BATCH_SIZE]
+                ).using_db(connection).values_list("cookie_ref_id", "category", *defaults)
+                for cookie_id, category, *values in rows:
+                    category = category.value if isinstance(category, QueryCategory) else category
+                    existing[(cookie_id, category)] = dict(zip(defaults, values))
+
+            records = []
+            for cookie_id, categories in updates.items():
+                for category_name, data in categories.items():
+                    try:
+                        category = QueryCategory(category_name)
+                    except ValueError:
+                        # 如果类别名称无效，跳过
+                        continue
+                    current = existing.get((cookie_id, category.value))
+                    new = {**(current or defaults), **to_values(data, current or defaults)}
+                    changes.exhausted.setdefault(cookie_id, {})[category.value] = new["exhausted_at"]
+                    old_weight = current["queries_weight"] if current else None
+                    if old_weight != new["queries_weight"]:
+                        changes.changed.setdefault(cookie_id, {})[category.value] = (
+                            old_weight,
+                            new["queries_weight"],
+                        )
+                    if new != current:
+                        records.append(cls(cookie_ref_id=cookie_id, category=category, **new))
+
+            new_cookie_ids = {record.cookie_ref_id for record in records} - {
+                cookie_id for cookie_id, _ in existing
+            }
+            if new_cookie_ids:
+                # 探测期间被删除的cookie不能再插入记录(外键), 整批写入会失败
+                alive = set(
+                    await Cookie.filter(id__in=list(new_cookie_ids))
+                    .using_db(connection)
+                    .values_list("id", flat=True)
+                )
+                records = [
+                    record
+                    for record in records
+                    if record.cookie_ref_id not in new_cookie_ids or record.cookie_ref_id in alive
+                ]
+                for cookie_id in new_cookie_ids - alive:
+                    changes.changed.pop(cookie_id, None)
+                    changes.exhausted.pop(cookie_id, None)
+
+            if records:
+                await cls.bulk_create(
+                    records,
+                    batch_size=WEIGHT_UPSERT_BATCH_SIZE,
+                    on_conflict=("cookie_ref_id", "category"),
+                    update_fields=(*defaults, "updated_at"),
+                    using_db=connection,
+                )
+            changes.written = len(records)
+        return changes
 
-        return updated_count
+    @classmethod
+    async def mark_exhausted(cls, cookie_id: int, category: QueryCategory):
+        """对话时上游返回额度用完, 立即把权重置0, 返回更新后的记录"""
+        query_record = await cls.get_or_none(cookie_ref_id=cookie_id, category=category)
+        if query_record is None:
+            return None
+        query_record.queries_weight = 0
+        query_record.exhausted_at = datetime.now(timezone.utc)
+        await query_record.save()
+        return query_record
 
     @classmethod
     async def get_weight(cls, cookie: Cookie, category: QueryCategory):
@@ -134,62 +407,34 @@ class CookieQueries(CRUDBase):
         return result
 
     @classmethod
-    async def get_cookies_by_weight(
-        cls,
-        category: QueryCategory,
-        min_weight: int = 0,
-        cookie_type: CookieType = None,
-    ):
-        """获取指定类别下满足最小权重要求的cookie列表"""
-        filters = {"category": category, "queries_weight__gte": min_weight}
-
-        query = cls.filter(**filters)
-
+    async def total_weights(cls, cookie_type: CookieType = None) -> Dict[str, int]:
+        """各类别的权重总和(剩余查询数), 在数据库中聚合"""
+        query = cls.all()
         if cookie_type:
-            # 如果指定了cookie类型，需要联合查询Cookie表
             query = query.filter(cookie_ref__cookie_type=cookie_type)
-
-        # 获取满足条件的CookieQueries记录，并按权重降序排列
-        query_records = await query.order_by("-queries_weight").prefetch_related(
-            "cookie_ref"
+        rows = (
+            await query.annotate(total=Sum("queries_weight"))
+            .group_by("category")
+            .values("category", "total")
         )
-
-        # 返回关联的Cookie对象列表
-        return [record.cookie_ref for record in query_records]
+        totals = {category.value: 0 for category in QueryCategory}
+        for row in rows:
+            category = row["category"]
+            category = category.value if isinstance(category, QueryCategory) else category
+            totals[category] = int(row["total"] or 0)
+        return totals
 
     @classmethod
-    async def get_random_weighted_cookie(cls, category: QueryCategory) -> Cookie:
-        """根据权重概率随机选择一个cookie
-
-        使用numpy.random.choice基于权重进行概率采样，而不是简单选择权重最高的
-
-        参数:
-            category: 查询类别
-
-        返回:
-            随机选择的Cookie对象，如果没有符合条件的cookie则返回None
-        """
-
-        # 获取指定类别下所有有权重的记录
-        query_records = await cls.filter(
-            category=category, queries_weight__gt=0  # 确保只选择权重大于0的记录
-        ).prefetch_related("cookie_ref")
-
-        if not query_records:
-            return None
-
-        # 提取cookie和对应的权重
-        cookies = [record.cookie_ref for record in query_records]
-        weights = [record.queries_weight for record in query_records]
-
-        # 将权重归一化为概率分布
-        weights = np.array(weights, dtype=float)
-        weights = weights / weights.sum()
-
-        # 使用numpy的random.choice基于权重进行采样
-        selected_index = np.random.choice(len(cookies), p=weights)
-        selected_cookie_info = await cookies[selected_index].to_dict()
-        logger.debug(f"Selected cookie: \n{selected_cookie_info}")
-        logger.debug(f"Selected weight: {weights[selected_index]}")
+    async def get_weights_by_cookie_ids(
+        cls, cookie_ids: Iterable[int]
+    ) -> Dict[int, Dict[str, int]]:
+        """一次查询取出多个cookie的所有类别权重: {cookie_id: {类别: 权重}}"""
+        rows = await cls.filter(cookie_ref_id__in=list(cookie_ids)).values_list(
+            "cookie_ref_id", "category", "queries_weight"
+        )
+        result: Dict[int, Dict[str, int]] = {}
+        for cookie_id, category, weight in rows:
+            category = category.value if isinstance(category, QueryCategory) else category
+            result.setdefault(cookie_id, {})[category] = weight
+        return result
 
-        return cookies[selected_index]  # Cookie 返回的是这个类型的。
@@ -0,0 +1,149 @@
+"""
+revgrokapi/models/usage_models.py
+
+This file defines the tortoise based model for the hourly usage rollups written
+by revgrokapi/quota/usage_accounting.py. Requests are never written one by one:
+each row holds the totals of one (hour, cookie, category, model).
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from tortoise import fields
+from tortoise.functions import Sum
+from tortoise.transactions import in_transaction
+
+from revgrokapi.models.base import CRUDBase
+from revgrokapi.models.cookie_models import QueryCategory
+
+# 每条upsert语句写入的行数
+USAGE_UPSERT_BATCH_SIZE = 500
+# 累加的计数字段, usage_accounting在内存中按这些字段累加
+USAGE_COUNTER_FIELDS = (
+    "requests",
+    "errors",
+    "timeouts",
+    "cancelled",
+    "prompt_tokens",
+    "completion_tokens",
+    "ttft_count",
+    "ttft_ms_sum",
+    "duration_ms_sum",
+)
+
+
+class UsageHourly(CRUDBase):
+    # 小时的开始时间(UTC)
+    hour = fields.DatetimeField()
+    # 不做外键: cookie删除后它的历史用量仍然保留
+    cookie_id = fields.IntField(index=True)
+    category = fields.CharEnumField(enum_type=QueryCategory, max_length=50)
+    model = fields.CharField(max_length=128)
+
+    # 按结果分类的请求数, requests包含全部结果
+    requests = fields.BigIntField(default=0)
+    errors = fields.BigIntField(default=0)
+    timeouts = fields.BigIntField(default=0)
+    cancelled = fields.BigIntField(default=0)
+    prompt_tokens = fields.BigIntField(default=0)
+    completion_tokens = fields.BigIntField(default=0)
+    # 有首行的请求才计入首行延迟
+    ttft_count = fields.BigIntField(default=0)
+    ttft_ms_sum = fields.FloatField(default=0)
+    duration_ms_sum = fields.FloatField(default=0)
+
+    class Meta:
+        table = "usage_hourly"
+        # hour在最前, 按时间范围统计时可以直接用这个索引
+        unique_together = (("hour", "cookie_id", "category", "model"),)
+
+    @classmethod
+    async def bulk_accumulate(
+        cls, rows: Dict[Tuple[int, int, str, str], Dict[str, Any]]
+    ) -> int:
+        """把一批增量加到已有的行上(在数据库中累加), 返回写入的行数
+
+        参数:
+            rows: {(小时的时间戳, cookie_id, 类别, 模型): {计数字段: 增量}}
+        """
+        if not rows:
+            return 0
+        records: List[UsageHourly] = [
+            cls(
+                hour=datetime.fromtimestamp(hour, timezone.utc),
+                cookie_id=cookie_id,
+                category=QueryCategory(category),
+                model=model,
+                **{field: delta.get(field, 0) for field in USAGE_COUNTER_FIELDS},
+            )
+            for (hour, cookie_id, category, model), delta in rows.items()
+        ]
+        fields_map = cls._meta.fields_map
+        # 自增的id由数据库生成
+        columns = [
+            column for column in cls._meta.fields_db_projection if not fields_map[column].generated
+        ]
+        async with in_transaction() as connection:
+            if connection.capabilities.dialect == "sqlite":
+                parameters = ["?"] * len(columns)
+            else:
+                parameters = [f"${index + 1}" for index in range(len(columns))]
+            sql = cls._accumulate_sql(
+                [cls._meta.fields_db_projection[column] for column in columns], parameters
+            )
+            for start in range(0, len(records), USAGE_UPSERT_BATCH_SIZE):
+                await connection.execute_many(
+                    sql,
+                    [
+                        [
+                            fields_map[column].to_db_value(getattr(record, column), record)
+                            for column in columns
+                        ]
+                        for record in records[start : start + USAGE_UPSERT_BATCH_SIZE]
+                    ],
+                )
+        return len(records)
+
+    @classmethod
+    def _accumulate_sql(cls, columns: List[str], parameters: List[str]) -> str:
+        """INSERT ... ON CONFLICT DO UPDATE, 冲突时在数据库中把增量加到已有的计数上
+
+        多个worker同时写同一个键时不会互相覆盖(不在Python中读出再写回)
+        """
+        table = cls._meta.db_table
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        updates = [
+            f'"{field}" = "{table}"."{field}" + EXCLUDED."{field}"'
+            for field in USAGE_COUNTER_FIELDS
+        ]
+        updates.append('"updated_at" = EXCLUDED."updated_at"')
+        return (
+            f'INSERT INTO "{table}" ({column_list}) VALUES ({", ".join(parameters)}) '
+            f'ON CONFLICT ("hour", "cookie_id", "category", "model") '
+            f'DO UPDATE SET {", ".join(updates)}'
+        )
+
+    @classmethod
+    async def aggregate(
+        cls,
+        since: datetime,
+        group_by: Sequence[str],
+        order_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        **filters,
+    ) -> List[Dict[str, Any]]:
+        """按group_by汇总since之后的计数, 在数据库中求和, 返回 {分组字段..., 计数字段...}
+
+        order_by为计数字段名(降序), 例如 "requests"
+        """
+        # 注解的名字不能和字段重名
+        sums = {f"sum_{field}": Sum(field) for field in USAGE_COUNTER_FIELDS}
+        query = cls.filter(hour__gte=since, **filters).annotate(**sums).group_by(*group_by)
+        if order_by is not None:
+            query = query.order_by(f"-sum_{order_by}")
+        if limit is not None:
+            query = query.limit(limit)
+        rows = await query.values(*group_by, *sums)
+        for row in rows:
+            for field in USAGE_COUNTER_FIELDS:
+                row[field] = row.pop(f"sum_{field}") or 0
+        return rows
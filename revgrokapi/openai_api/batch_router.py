@@ -0,0 +1,221 @@
+from typing import Any, Dict, Optional
+
+from fastapi import APIRouter, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from revgrokapi.configs import (BATCH_COMPLETION_WINDOW, BATCH_DIR,
+                                BATCH_MAX_FILE_BYTES)
+from revgrokapi.models.batch_models import (ACTIVE_BATCH_STATUSES, Batch,
+                                            BatchFile, BatchStatus,
+                                            FilePurpose)
+from revgrokapi.openai_api.batches import (CHAT_COMPLETIONS_ENDPOINT,
+                                           batch_runner, file_path,
+                                           file_size, new_file_id)
+from revgrokapi.openai_api.openai_api_router import require_api_key
+from revgrokapi.quota import InvalidApiKeyError, api_key_manager
+from revgrokapi.utils.async_task_utils import submit_task2event_loop
+from revgrokapi.utils.auth_utils import is_admin_api_key
+from revgrokapi.utils.file_utils import SPOOL_CHUNK_SIZE
+
+router = APIRouter()
+
+
+class CreateBatchRequest(BaseModel):
+    input_file_id: str
+    endpoint: str = CHAT_COMPLETIONS_ENDPOINT
+    completion_window: str = BATCH_COMPLETION_WINDOW
+    metadata: Optional[Dict[str, Any]] = None
+
+
+def _is_admin(api_key: str) -> bool:
+    return is_admin_api_key(api_key)
+
+
+def authorize(authorization: Optional[str]) -> str:
+    """有效的api key或管理员key"""
+    api_key = require_api_key(authorization)
+    if _is_admin(api_key):
+        return api_key
+    try:
+        api_key_manager.get_state(api_key)
+    except InvalidApiKeyError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    return api_key
+
+
+def _check_owner(record, api_key: str, kind: str, record_id: str):
+    # 不属于自己的文件/batch按不存在处理
+    if record is None or (record.api_key != api_key and not _is_admin(api_key)):
+        raise HTTPException(status_code=404, detail=f"No such {kind}: {record_id}")
+
+
+async def _get_file(file_id: str, api_key: str) -> BatchFile:
+    batch_file = await BatchFile.get_or_none(file_id=file_id)
+    _check_owner(batch_file, api_key, "File", file_id)
+    return batch_file
+
+
+async def _get_batch(batch_id: str, api_key: str) -> Batch:
+    batch = await batch_runner.get(batch_id)
+    _check_owner(batch, api_key, "batch", batch_id)
+    return batch
+
+
+def _save_upload(source, path, limit: int) -> int:
+    """分块写入磁盘, 超过limit时删除已写入的部分并返回-1"""
+    size = 0
+    with path.open("wb") as target:
+        while chunk := source.read(SPOOL_CHUNK_SIZE):
+            size += len(chunk)
+            if size > limit:
+                break
+            target.write(chunk)
+    if size > limit:
+        path.unlink(missing_ok=True)
+        return -1
+    return size
+
+
+def _read_range(path, size: int):
+    """只读取前size字节, 执行中的batch的输出文件还在变大"""
+    if not size:
+        # 还没有结果时文件不存在
+        return
+    with path.open("rb") as f:
+        while size > 0:
+            chunk = f.read(min(SPOOL_CHUNK_SIZE, size))
+            if not chunk:
+                return
+            size -= len(chunk)
+            yield chunk
+
+
+@router.post("/v1/files")
+async def upload_file(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+    authorization: str = Header(None),
+):
+    """上传batch的输入文件(JSONL), 内容在创建batch时校验"""
+    api_key = authorize(authorization)
+    if purpose != FilePurpose.BATCH.value:
+        raise HTTPException(status_code=400, detail="Only purpose 'batch' is supported")
+    file_id = new_file_id()
+    await submit_task2event_loop(BATCH_DIR.mkdir, parents=True, exist_ok=True)
+    size = await submit_task2event_loop(
+        _save_upload, file.file, file_path(file_id), BATCH_MAX_FILE_BYTES
+    )
+    if size < 0:
+        raise HTTPException(
+            status_code=413, detail=f"File is larger than {BATCH_MAX_FILE_BYTES} bytes"
+        )
+    batch_file = await BatchFile.create(
+        file_id=file_id,
+        api_key=api_key,
+        filename=file.filename or f"{file_id}.jsonl",
+        purpose=FilePurpose.BATCH,
+        bytes=size,
+    )
+    return batch_file.to_openai()
+
+
+@router.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str, authorization: str = Header(None)):
+    batch_file = await _get_file(file_id, authorize(authorization))
+    return batch_file.to_openai(await submit_task2event_loop(file_size, file_path(file_id)))
+
+
+@router.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(file_id: str, authorization: str = Header(None)):
+    """下载文件; 执行中的batch返回已经完成的部分"""
+    await _get_file(file_id, authorize(authorization))
+    path = file_path(file_id)
+    size = await submit_task2event_loop(file_size, path)
+    return StreamingResponse(
+        _read_range(path, size),
+        media_type="application/jsonl",
+        headers={"Content-Length": str(size)},
+    )
+
+
+@router.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str, authorization: str = Header(None)):
+    batch_file = await _get_file(file_id, authorize(authorization))
+    in_use = await Batch.filter(
+        input_file_id=file_id, status__in=ACTIVE_BATCH_STATUSES
+    ).exists()
+    if in_use:
+        raise HTTPException(status_code=409, detail="File is used by a running batch")
+    await submit_task2event_loop(file_path(file_id).unlink, missing_ok=True)
+    await batch_file.delete()
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+@router.post("/v1/batches")
+async def create_batch(
+    request: CreateBatchRequest, raw_request: Request, authorization: str = Header(None)
+):
+    api_key = authorize(authorization)
+    if request.endpoint != CHAT_COMPLETIONS_ENDPOINT:
+        raise HTTPException(
+            status_code=400, detail=f"Only {CHAT_COMPLETIONS_ENDPOINT} is supported"
+        )
+    if request.completion_window != BATCH_COMPLETION_WINDOW:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Only completion_window '{BATCH_COMPLETION_WINDOW}' is supported",
+        )
+    input_file = await _get_file(request.input_file_id, api_key)
+    if input_file.purpose != FilePurpose.BATCH:
+        raise HTTPException(status_code=400, detail="input_file_id must have purpose 'batch'")
+    batch = await batch_runner.create(
+        api_key,
+        input_file,
+        request.endpoint,
+        request.completion_window,
+        request.metadata,
+        str(raw_request.base_url),
+    )
+    return batch.to_openai()
+
+
+@router.get("/v1/batches")
+async def list_batches(
+    limit: int = 20, after: Optional[str] = None, authorization: str = Header(None)
+):
+    api_key = authorize(authorization)
+    limit = max(1, min(limit, 100))
+    filters = {} if _is_admin(api_key) else {"api_key": api_key}
+    cursor = None
+    if after is not None:
+        cursor_batch = await _get_batch(after, api_key)
+        cursor = cursor_batch.id
+    batches, next_cursor = await Batch.get_page(cursor=cursor, limit=limit, **filters)
+    data = [batch_runner.live(batch).to_openai() for batch in batches]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": next_cursor is not None,
+    }
+
+
+@router.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, authorization: str = Header(None)):
+    batch = await _get_batch(batch_id, authorize(authorization))
+    return batch.to_openai()
+
+
+@router.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, authorization: str = Header(None)):
+    """已经完成的请求保留在输出文件中"""
+    batch = await _get_batch(batch_id, authorize(authorization))
+    if batch.status not in ACTIVE_BATCH_STATUSES or batch.status == BatchStatus.CANCELLING:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Cannot cancel a batch with status '{batch.status.value}'",
+        )
+    batch = await batch_runner.cancel(batch)
+    return batch.to_openai()
@@ -0,0 +1,625 @@
+"""
+revgrokapi/openai_api/batches.py
+
+Background execution of OpenAI-compatible batches (POST /v1/batches). The input
+is a JSONL file of /v1/chat/completions requests uploaded through /v1/files.
+Each line runs like a non-streaming chat completion, and its result is appended
+to the output (or error) JSONL as soon as it finishes. The partial output can be
+downloaded while the batch is still running.
+
+Batch requests are throttled so they never crowd out interactive traffic:
+
+- at most `batch_max_concurrency` batch requests run across all batches;
+- per model category, at most one per cookie with quota left, so the weighted
+  cookie selection spreads them over the pool instead of stacking them on one
+  account;
+- when `max_concurrent_requests` is set, a batch request only starts while the
+  server is below (1 - batch_interactive_reserve) of it. It then holds an
+  admission ticket like any other request. Nothing new starts while draining.
+
+The throttle polls instead of waiting on notifications, because interactive
+requests and cookie weights change without telling it. Progress is saved every
+few seconds. After a restart, active batches resume and skip the custom_ids
+already present in their output and error files.
+"""
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from fastapi import HTTPException
+from loguru import logger
+from pydantic import ValidationError
+
+from revgrokapi.configs import (BATCH_CAPACITY_CACHE_SECONDS,
+                                BATCH_COMPLETION_WINDOW_SECONDS, BATCH_DIR,
+                                BATCH_MAX_REQUESTS,
+                                BATCH_PROGRESS_SAVE_INTERVAL_SECONDS,
+                                BATCH_READ_CHUNK_LINES,
+                                BATCH_THROTTLE_POLL_SECONDS)
+from revgrokapi.models.batch_models import (ACTIVE_BATCH_STATUSES, Batch,
+                                            BatchFile, BatchStatus,
+                                            FilePurpose)
+from revgrokapi.models.cookie_models import CookieQueries, QueryCategory
+from revgrokapi.openai_api.model_registry import ModelSpec, model_registry
+from revgrokapi.openai_api.openai_api_router import (ERROR_PREFIX,
+                                                     collect_completion,
+                                                     prepare_chat)
+from revgrokapi.openai_api.schemas import ChatCompletionRequest
+from revgrokapi.openai_api.utils import grok_chat
+from revgrokapi.quota import (AdmissionTicket, InvalidApiKeyError,
+                              QuotaExceededError, RateLimitExceededError,
+                              ServerBusyError, UsageRecord,
+                              admission_controller, api_key_manager)
+from revgrokapi.runtime_settings import RuntimeSettings, runtime_settings
+from revgrokapi.utils.async_task_utils import submit_task2event_loop
+from revgrokapi.utils.token_utils import count_tokens
+
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+
+
+def new_file_id() -> str:
+    return f"file-{uuid4().hex}"
+
+
+def new_batch_id() -> str:
+    return f"batch_{uuid4().hex}"
+
+
+def file_path(file_id: str) -> Path:
+    return BATCH_DIR / f"{file_id}.jsonl"
+
+
+class BatchInputError(ValueError):
+    """输入文件格式错误, 整个batch失败"""
+
+    def __init__(self, code: str, message: str, line: Optional[int] = None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.line = line
+
+    def to_dict(self) -> Dict:
+        return {"code": self.code, "message": self.message, "param": None, "line": self.line}
+
+
+class BatchRequestError(Exception):
+    """单个请求失败, 写入错误文件"""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+# 以下文件操作都在线程池中执行
+def validate_input(path: Path, endpoint: str) -> int:
+    """检查输入文件的每一行, 返回请求数; 格式错误时抛出BatchInputError"""
+    custom_ids = set()
+    try:
+        f = path.open("rb")
+    except FileNotFoundError:
+        raise BatchInputError("missing_file", "The input file no longer exists.")
+    with f:
+        for line_no, raw in enumerate(f, 1):
+            if not raw.strip():
+                continue
+            try:
+                item = json.loads(raw)
+            except ValueError:
+                item = None
+            if not isinstance(item, dict):
+                raise BatchInputError(
+                    "invalid_json_line", "This line is not parseable as valid JSON.", line_no
+                )
+            custom_id = item.get("custom_id")
+            if not isinstance(custom_id, str) or not custom_id:
+                raise BatchInputError(
+                    "missing_required_parameter", "custom_id is required.", line_no
+                )
+            if custom_id in custom_ids:
+                raise BatchInputError(
+                    "duplicate_custom_id",
+                    "The custom_id for this request is a duplicate of another request.",
+                    line_no,
+                )
+            if item.get("method") != "POST":
+                raise BatchInputError("invalid_method", "method must be POST.", line_no)
+            if item.get("url") != endpoint:
+                raise BatchInputError(
+                    "invalid_url",
+                    f"The URL provided for this request does not match the batch endpoint {endpoint}.",
+                    line_no,
+                )
+            if not isinstance(item.get("body"), dict):
+                raise BatchInputError(
+                    "missing_required_parameter", "body must be a JSON object.", line_no
+                )
+            custom_ids.add(custom_id)
+            if len(custom_ids) > BATCH_MAX_REQUESTS:
+                raise BatchInputError(
+                    "too_many_requests",
+                    f"A batch can contain at most {BATCH_MAX_REQUESTS} requests.",
+                    line_no,
+                )
+    if not custom_ids:
+        raise BatchInputError("empty_file", "The input file contains no requests.")
+    return len(custom_ids)
+
+
+def read_requests(path: Path, offset: int, limit: int) -> Tuple[List[Dict], int]:
+    """从offset开始读取最多limit个请求, 返回(请求, 下一次的offset)"""
+    items = []
+    with path.open("rb") as f:
+        f.seek(offset)
+        while len(items) < limit:
+            raw = f.readline()
+            if not raw:
+                break
+            if raw.strip():
+                items.append(json.loads(raw))
+        return items, f.tell()
+
+
+def read_custom_ids(path: Path) -> Set[str]:
+    """结果文件中已经有的custom_id, 重启后跳过这些请求"""
+    custom_ids = set()
+    try:
+        with path.open("rb") as f:
+            for raw in f:
+                try:
+                    custom_ids.add(json.loads(raw)["custom_id"])
+                except (ValueError, KeyError, TypeError):
+                    # 停机时写了一半的行
+                    continue
+    except FileNotFoundError:
+        pass
+    return custom_ids
+
+
+def append_line(path: Path, line: str):
+    with path.open("a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def output_line(custom_id: str, body: Dict) -> str:
+    return json.dumps(
+        {
+            "id": f"batch_req_{uuid4().hex}",
+            "custom_id": custom_id,
+            "response": {"status_code": 200, "request_id": body["id"], "body": body},
+            "error": None,
+        },
+        ensure_ascii=False,
+    )
+
+
+def error_line(custom_id: str, code: str, message: str) -> str:
+    return json.dumps(
+        {
+            "id": f"batch_req_{uuid4().hex}",
+            "custom_id": custom_id,
+            "response": None,
+            "error": {"code": code, "message": message},
+        },
+        ensure_ascii=False,
+    )
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class BatchThrottle:
+    """batch请求的并发限制, 见模块说明"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.per_category: Dict[QueryCategory, int] = {}
+        # 类别 -> (有额度的cookie数, 查询时间)
+        self._capacity: Dict[QueryCategory, Tuple[int, float]] = {}
+        self.waits = 0
+
+    async def capacity(self, category: QueryCategory) -> int:
+        cached = self._capacity.get(category)
+        if cached is not None and time.monotonic() - cached[1] < BATCH_CAPACITY_CACHE_SECONDS:
+            return cached[0]
+        count = await CookieQueries.filter(category=category, queries_weight__gt=0).count()
+        self._capacity[category] = (count, time.monotonic())
+        return count
+
+    @staticmethod
+    def _interactive_headroom(settings: RuntimeSettings) -> bool:
+        limit = settings.max_concurrent_requests
+        if not limit:
+            return True
+        return admission_controller.in_flight < limit * (1 - settings.batch_interactive_reserve)
+
+    async def _try_acquire(self, category: QueryCategory) -> Optional[AdmissionTicket]:
+        settings = runtime_settings.current
+        if admission_controller.draining or self.in_flight >= settings.batch_max_concurrency:
+            return None
+        if not self._interactive_headroom(settings):
+            return None
+        # 没有可用cookie时仍然放行一个, 让请求按正常的重试失败而不是一直等到过期
+        if self.per_category.get(category, 0) >= max(1, await self.capacity(category)):
+            return None
+        try:
+            ticket = admission_controller.acquire()
+        except ServerBusyError:
+            return None
+        self.in_flight += 1
+        self.per_category[category] = self.per_category.get(category, 0) + 1
+        return ticket
+
+    async def acquire(
+        self, category: QueryCategory, stop: Callable[[], bool]
+    ) -> Optional[AdmissionTicket]:
+        """等到有名额为止; stop()为真时(取消、过期、停机)返回None"""
+        waited = False
+        while not stop():
+            ticket = await self._try_acquire(category)
+            if ticket is not None:
+                return ticket
+            if not waited:
+                self.waits += 1
+                waited = True
+            await asyncio.sleep(BATCH_THROTTLE_POLL_SECONDS)
+        return None
+
+    def release(self, category: QueryCategory, ticket: AdmissionTicket):
+        ticket.release()
+        self.in_flight -= 1
+        self.per_category[category] -= 1
+
+    def stats(self) -> Dict:
+        settings = runtime_settings.current
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": settings.batch_max_concurrency,
+            "interactive_reserve": settings.batch_interactive_reserve,
+            "per_category": {
+                category.value: count for category, count in self.per_category.items()
+            },
+            "waits": self.waits,
+        }
+
+
+class BatchJob:
+    """一个正在后台执行的batch"""
+
+    def __init__(self, batch: Batch):
+        self.batch = batch
+        self.task: Optional[asyncio.Task] = None
+        self.requests: Set[asyncio.Task] = set()
+        self.done: Set[str] = set()
+        self.write_lock = asyncio.Lock()
+        self.last_saved = time.monotonic()
+        self.cancelled = False
+
+    def expired(self) -> bool:
+        return self.batch.expires_at is not None and _now() >= self.batch.expires_at
+
+    def should_stop(self) -> bool:
+        return self.cancelled or self.expired()
+
+    def cancel_requests(self):
+        for task in self.requests:
+            task.cancel()
+
+
+class BatchRunner:
+    def __init__(self):
+        self.throttle = BatchThrottle()
+        self._jobs: Dict[str, BatchJob] = {}
+
+    async def start(self):
+        await submit_task2event_loop(BATCH_DIR.mkdir, parents=True, exist_ok=True)
+        batches = await Batch.filter(status__in=ACTIVE_BATCH_STATUSES).order_by("id")
+        for batch in batches:
+            self._spawn(batch)
+        if batches:
+            logger.info(f"Resumed {len(batches)} batches")
+
+    async def shutdown(self):
+        """停止执行, 保存进度; 状态保持不变, 重启后继续"""
+        jobs = list(self._jobs.values())
+        for job in jobs:
+            job.task.cancel()
+        await asyncio.gather(*(job.task for job in jobs), return_exceptions=True)
+        for job in jobs:
+            try:
+                await self._recount(job)
+                await job.batch.save(update_fields=["completed", "failed", "updated_at"])
+            except Exception as e:
+                logger.error(f"Failed to save batch {job.batch.batch_id} progress: {e}")
+
+    def _spawn(self, batch: Batch):
+        job = BatchJob(batch)
+        self._jobs[batch.batch_id] = job
+        job.task = asyncio.create_task(self._run(job))
+        job.task.add_done_callback(lambda _: self._jobs.pop(batch.batch_id, None))
+
+    async def get(self, batch_id: str) -> Optional[Batch]:
+        """执行中的batch返回内存中的对象(进度是最新的)"""
+        job = self._jobs.get(batch_id)
+        if job is not None:
+            return job.batch
+        return await Batch.get_or_none(batch_id=batch_id)
+
+    def live(self, batch: Batch) -> Batch:
+        job = self._jobs.get(batch.batch_id)
+        return job.batch if job is not None else batch
+
+    async def create(
+        self,
+        api_key: str,
+        input_file: BatchFile,
+        endpoint: str,
+        completion_window: str,
+        metadata: Optional[Dict] = None,
+        base_url: str = "",
+    ) -> Batch:
+        batch_id = new_batch_id()
+        output_file_id, error_file_id = new_file_id(), new_file_id()
+        for file_id, suffix in ((output_file_id, "output"), (error_file_id, "error")):
+            await BatchFile.create(
+                file_id=file_id,
+                api_key=api_key,
+                filename=f"{batch_id}_{suffix}.jsonl",
+                purpose=FilePurpose.BATCH_OUTPUT,
+            )
+        batch = await Batch.create(
+            batch_id=batch_id,
+            api_key=api_key,
+            endpoint=endpoint,
+            input_file_id=input_file.file_id,
+            output_file_id=output_file_id,
+            error_file_id=error_file_id,
+            completion_window=completion_window,
+            base_url=base_url,
+            metadata=metadata,
+            expires_at=_now() + timedelta(seconds=BATCH_COMPLETION_WINDOW_SECONDS),
+        )
+        self._spawn(batch)
+        return batch
+
+    async def cancel(self, batch: Batch) -> Batch:
+        """停止调度新请求并取消进行中的请求, 已经完成的结果保留"""
+        job = self._jobs.get(batch.batch_id)
+        if job is None:
+            await self._set_status(batch, BatchStatus.CANCELLING)
+            await self._set_status(batch, BatchStatus.CANCELLED)
+            return batch
+        job.cancelled = True
+        await self._set_status(job.batch, BatchStatus.CANCELLING)
+        job.cancel_requests()
+        return job.batch
+
+    @staticmethod
+    async def _set_status(batch: Batch, status: BatchStatus):
+        batch.status = status
+        # 每个状态都有对应的 <status>_at 字段
+        timestamp_field = f"{status.value}_at"
+        if timestamp_field in Batch._meta.fields_map:
+            setattr(batch, timestamp_field, _now())
+        await batch.save()
+
+    async def _run(self, job: BatchJob):
+        batch = job.batch
+        try:
+            if batch.status == BatchStatus.VALIDATING and not await self._validate(job):
+                return
+            job.cancelled = job.cancelled or batch.status == BatchStatus.CANCELLING
+            if batch.status == BatchStatus.IN_PROGRESS:
+                await self._execute(job)
+            await self._finish(job)
+        except asyncio.CancelledError:
+            job.cancel_requests()
+            await asyncio.gather(*job.requests, return_exceptions=True)
+            raise
+        except Exception as e:
+            logger.exception(f"Batch {batch.batch_id} failed: {e}")
+            batch.errors = {
+                "object": "list",
+                "data": [BatchInputError("internal_error", str(e)).to_dict()],
+            }
+            await self._set_status(batch, BatchStatus.FAILED)
+
+    async def _validate(self, job: BatchJob) -> bool:
+        batch = job.batch
+        try:
+            batch.total = await submit_task2event_loop(
+                validate_input, file_path(batch.input_file_id), batch.endpoint
+            )
+        except BatchInputError as e:
+            batch.errors = {"object": "list", "data": [e.to_dict()]}
+            await self._set_status(batch, BatchStatus.FAILED)
+            return False
+        if job.cancelled:
+            # 校验期间被取消, 状态已经是cancelling
+            return True
+        await self._set_status(batch, BatchStatus.IN_PROGRESS)
+        logger.info(f"Batch {batch.batch_id} started: {batch.total} requests")
+        return True
+
+    async def _recount(self, job: BatchJob):
+        """以结果文件为准重新计数"""
+        batch = job.batch
+        completed = await submit_task2event_loop(read_custom_ids, file_path(batch.output_file_id))
+        failed = await submit_task2event_loop(read_custom_ids, file_path(batch.error_file_id))
+        job.done = completed | failed
+        batch.completed, batch.failed = len(completed), len(failed)
+
+    async def _execute(self, job: BatchJob):
+        batch = job.batch
+        await self._recount(job)
+        input_path = file_path(batch.input_file_id)
+        offset = 0
+        while not job.should_stop():
+            items, offset = await submit_task2event_loop(
+                read_requests, input_path, offset, BATCH_READ_CHUNK_LINES
+            )
+            if not items:
+                break
+            for item in items:
+                if job.should_stop():
+                    break
+                if item["custom_id"] not in job.done:
+                    await self._schedule(job, item)
+        if job.expired() and not job.cancelled:
+            job.cancel_requests()
+        await asyncio.gather(*job.requests, return_exceptions=True)
+
+    async def _schedule(self, job: BatchJob, item: Dict):
+        custom_id = item["custom_id"]
+        try:
+            request = ChatCompletionRequest(**item["body"])
+        except ValidationError as e:
+            await self._write(
+                job, custom_id, error_line(custom_id, "invalid_request", str(e)), ok=False
+            )
+            return
+        model_spec = model_registry.resolve(request.model)
+        ticket = await self.throttle.acquire(model_spec.category, job.should_stop)
+        if ticket is None:
+            return
+        task = asyncio.create_task(self._execute_one(job, custom_id, request, model_spec, ticket))
+        job.requests.add(task)
+        task.add_done_callback(job.requests.discard)
+
+    async def _execute_one(
+        self,
+        job: BatchJob,
+        custom_id: str,
+        request: ChatCompletionRequest,
+        model_spec: ModelSpec,
+        ticket: AdmissionTicket,
+    ):
+        try:
+            try:
+                body = await self._chat(job.batch, request)
+            finally:
+                self.throttle.release(model_spec.category, ticket)
+        except BatchRequestError as e:
+            await self._write(job, custom_id, error_line(custom_id, e.code, e.message), ok=False)
+        except Exception as e:
+            logger.exception(f"Batch {job.batch.batch_id} request {custom_id} failed: {e}")
+            await self._write(job, custom_id, error_line(custom_id, "internal_error", str(e)), ok=False)
+        else:
+            await self._write(job, custom_id, output_line(custom_id, body), ok=True)
+
+    async def _chat(self, batch: Batch, request: ChatCompletionRequest) -> Dict:
+        if not request.messages:
+            raise BatchRequestError("invalid_request", "No messages provided.")
+        try:
+            model_spec, prompt, images = await prepare_chat(request)
+        except HTTPException as e:
+            raise BatchRequestError("invalid_request", str(e.detail))
+        prompt_tokens = await submit_task2event_loop(count_tokens, prompt)
+        key_state = await self._admit(batch.api_key, prompt_tokens)
+        usage = UsageRecord(model_spec.name, model_spec.category, prompt_tokens)
+        body = await collect_completion(
+            grok_chat(
+                model_spec, prompt, request.reasoning_format, images, batch.base_url, usage
+            ),
+            request.model,
+            prompt_tokens,
+            key_state,
+            usage=usage,
+        )
+        content = body["choices"][0]["message"]["content"]
+        if content.startswith(ERROR_PREFIX):
+            raise BatchRequestError("upstream_error", content[len(ERROR_PREFIX):])
+        return body
+
+    @staticmethod
+    async def _admit(api_key: str, prompt_tokens: int):
+        """超过速率时等待令牌恢复, 额度用完或key失效时这个请求失败"""
+        while True:
+            try:
+                return api_key_manager.admit(api_key, prompt_tokens)
+            except RateLimitExceededError as e:
+                await asyncio.sleep(max(e.retry_after, BATCH_THROTTLE_POLL_SECONDS))
+            except InvalidApiKeyError as e:
+                raise BatchRequestError("invalid_api_key", str(e))
+            except QuotaExceededError as e:
+                raise BatchRequestError("quota_exceeded", str(e))
+
+    async def _write(self, job: BatchJob, custom_id: str, line: str, ok: bool):
+        batch = job.batch
+        path = file_path(batch.output_file_id if ok else batch.error_file_id)
+        async with job.write_lock:
+            await submit_task2event_loop(append_line, path, line)
+        job.done.add(custom_id)
+        if ok:
+            batch.completed += 1
+        else:
+            batch.failed += 1
+        if time.monotonic() - job.last_saved >= BATCH_PROGRESS_SAVE_INTERVAL_SECONDS:
+            job.last_saved = time.monotonic()
+            await batch.save(update_fields=["completed", "failed", "updated_at"])
+
+    async def _write_expired(self, job: BatchJob):
+        """过期时没有执行的请求写入错误文件"""
+        input_path = file_path(job.batch.input_file_id)
+        offset = 0
+        while True:
+            items, offset = await submit_task2event_loop(
+                read_requests, input_path, offset, BATCH_READ_CHUNK_LINES
+            )
+            if not items:
+                return
+            for item in items:
+                custom_id = item["custom_id"]
+                if custom_id not in job.done:
+                    await self._write(
+                        job,
+                        custom_id,
+                        error_line(
+                            custom_id,
+                            "batch_expired",
+                            "This request could not be executed before the completion window expired.",
+                        ),
+                        ok=False,
+                    )
+
+    async def _finish(self, job: BatchJob):
+        batch = job.batch
+        await self._recount(job)
+        if job.cancelled:
+            status = BatchStatus.CANCELLED
+        else:
+            await self._set_status(batch, BatchStatus.FINALIZING)
+            if job.expired():
+                await self._write_expired(job)
+                status = BatchStatus.EXPIRED
+            else:
+                status = BatchStatus.COMPLETED
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            size = await submit_task2event_loop(file_size, file_path(file_id))
+            await BatchFile.filter(file_id=file_id).update(bytes=size)
+        await self._set_status(batch, status)
+        logger.info(
+            f"Batch {batch.batch_id} {status.value}: "
+            f"{batch.completed} completed, {batch.failed} failed of {batch.total}"
+        )
+
+    def stats(self) -> Dict:
+        return {
+            "active_batches": len(self._jobs),
+            "throttle": self.throttle.stats(),
+        }
+
+
+batch_runner = BatchRunner()
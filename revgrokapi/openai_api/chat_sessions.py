@@ -0,0 +1,212 @@
+"""
+revgrokapi/openai_api/chat_sessions.py
+
+Persistent multi-turn chat sessions served over a WebSocket
+(`/v1/chat/sessions` on the OpenAI router). One connection carries any number
+of turns: the session keeps the message history server-side together with a
+`ConversationBinding`. The cookie picked for the first turn stays pinned, and
+with it the pooled GrokClient, for as long as it keeps quota. Once the
+upstream stream has reported a conversation id, later turns send only the new
+messages into that grok conversation. If the pinned cookie becomes unusable,
+or continuing the conversation fails, the turn falls back to a new
+conversation that carries the full history, on the same cookie or on another
+one. Each turn goes through the same API key admission, global admission and
+usage accounting as /v1/chat/completions.
+
+The server sends a `heartbeat` event every CHAT_SESSION_HEARTBEAT_SECONDS and
+closes a session that has had no client message and no running turn for
+CHAT_SESSION_IDLE_SECONDS.
+"""
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from fastapi import WebSocket, WebSocketDisconnect, status
+from loguru import logger
+
+from revgrokapi.configs import (CHAT_SESSION_HEARTBEAT_SECONDS,
+                                CHAT_SESSION_IDLE_SECONDS,
+                                CHAT_SESSION_MAX_MESSAGES,
+                                CHAT_SESSION_MAX_SESSIONS)
+from revgrokapi.openai_api.schemas import ChatMessage
+from revgrokapi.openai_api.utils import ConversationBinding
+
+# 客户端已经断开时发送会抛出的异常
+SEND_ERRORS = (WebSocketDisconnect, RuntimeError, OSError)
+
+
+class SessionLimitError(Exception):
+    """同时保持的会话数已达上限"""
+
+
+class ChatSession:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        api_key: str,
+        model: str,
+        reasoning_format: Optional[str] = None,
+    ):
+        self.id = f"sess_{uuid4().hex}"
+        self.websocket = websocket
+        self.api_key = api_key
+        self.model = model
+        self.reasoning_format = reasoning_format
+        self.messages: List[ChatMessage] = []
+        self.binding = ConversationBinding()
+        self.created_at = time.time()
+        self.last_active = time.monotonic()
+        self.turns = 0
+        self.continued_turns = 0
+        self.turn_task: Optional[asyncio.Task] = None
+        # 回复的delta和心跳来自不同的task, 同一时刻只能有一个在写
+        self._send_lock = asyncio.Lock()
+        self.closed = False
+
+    @property
+    def busy(self) -> bool:
+        return self.turn_task is not None and not self.turn_task.done()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def idle_seconds(self) -> float:
+        return 0.0 if self.busy else time.monotonic() - self.last_active
+
+    def add_messages(self, messages: List[ChatMessage]):
+        self.messages.extend(messages)
+        if len(self.messages) > CHAT_SESSION_MAX_MESSAGES:
+            # 太早的消息只在新建对话时才会用到, 丢掉它们不影响续接中的上游对话
+            del self.messages[: len(self.messages) - CHAT_SESSION_MAX_MESSAGES]
+
+    async def send(self, event_type: str, **fields) -> bool:
+        """发送一个事件, 连接已经断开时返回False"""
+        if self.closed:
+            return False
+        text = json.dumps({"type": event_type, **fields}, ensure_ascii=False)
+        try:
+            async with self._send_lock:
+                await self.websocket.send_text(text)
+            return True
+        except SEND_ERRORS:
+            self.closed = True
+            return False
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE, reason: str = ""):
+        if self.closed:
+            return
+        self.closed = True
+        if self.busy:
+            self.turn_task.cancel()
+        try:
+            async with self._send_lock:
+                await self.websocket.close(code=code, reason=reason)
+        except SEND_ERRORS:
+            pass
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "model": self.model,
+            "reasoning_format": self.reasoning_format,
+            "created_at": self.created_at,
+            "turns": self.turns,
+            "messages": len(self.messages),
+            "continued_turns": self.continued_turns,
+        }
+
+
+class ChatSessionManager:
+    def __init__(
+        self,
+        max_sessions: int = CHAT_SESSION_MAX_SESSIONS,
+        heartbeat_seconds: float = CHAT_SESSION_HEARTBEAT_SECONDS,
+        idle_seconds: float = CHAT_SESSION_IDLE_SECONDS,
+    ):
+        self.max_sessions = max_sessions
+        self.heartbeat_seconds = heartbeat_seconds
+        self.idle_seconds = idle_seconds
+        self._sessions: Dict[str, ChatSession] = {}
+        self.opened = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.turns = 0
+        # 在上游同一个对话中继续的轮数, 以及固定的cookie不可用而换cookie的次数
+        self.continued_turns = 0
+        self.rebinds = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(
+        self,
+        websocket: WebSocket,
+        api_key: str,
+        model: str,
+        reasoning_format: Optional[str] = None,
+    ) -> ChatSession:
+        if len(self._sessions) >= self.max_sessions:
+            self.rejected += 1
+            raise SessionLimitError(f"Too many chat sessions ({self.max_sessions})")
+        session = ChatSession(websocket, api_key, model, reasoning_format)
+        self._sessions[session.id] = session
+        self.opened += 1
+        return session
+
+    def discard(self, session: ChatSession):
+        if self._sessions.pop(session.id, None) is not None:
+            self.rebinds += session.binding.rebinds
+
+    def record_turn(self, session: ChatSession):
+        session.turns += 1
+        self.turns += 1
+        if session.binding.continued:
+            session.continued_turns += 1
+            self.continued_turns += 1
+
+    async def heartbeat(self, session: ChatSession):
+        """定时发送心跳, 空闲超时后关闭会话; 随会话的连接一起结束"""
+        while not session.closed:
+            await asyncio.sleep(self.heartbeat_seconds)
+            if session.idle_seconds() >= self.idle_seconds:
+                self.evicted += 1
+                logger.info(f"Closing idle chat session {session.id}")
+                await session.send("session.closed", reason="idle timeout")
+                await session.close(reason="idle timeout")
+                return
+            if not await session.send("heartbeat", time=time.time()):
+                return
+
+    async def shutdown(self):
+        """停机时关闭所有会话, 进行中的回复在排空阶段已经结束或被放弃"""
+        sessions = list(self._sessions.values())
+        await asyncio.gather(
+            *[
+                session.close(status.WS_1001_GOING_AWAY, "server shutting down")
+                for session in sessions
+            ],
+            return_exceptions=True,
+        )
+        self._sessions.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self._sessions),
+            "busy": sum(1 for session in self._sessions.values() if session.busy),
+            "max_sessions": self.max_sessions,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+            "turns": self.turns,
+            "continued_turns": self.continued_turns,
+            "rebinds": self.rebinds + sum(
+                session.binding.rebinds for session in self._sessions.values()
+            ),
+            "heartbeat_seconds": self.heartbeat_seconds,
+            "idle_seconds": self.idle_seconds,
+        }
+
+
+chat_session_manager = ChatSessionManager()
@@ -0,0 +1,265 @@
+"""
+revgrokapi/openai_api/hedging.py
+
+Hedged chat requests for time-to-first-token tail latency. Some cookies or
+egress paths sit for seconds before the first NDJSON line. When hedging is on,
+a request whose first line has not arrived within the model's recent TTFT
+percentile (clamped to the min/max delay settings) starts a second request on
+a different cookie. Whichever yields a usable first line is streamed and the
+other is cancelled.
+
+Hedges are paid from a budget. Every request deposits `hedge_budget_ratio`
+tokens and every hedge withdraws one, so extra upstream requests never exceed
+that fraction of chat requests.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import (Any, AsyncIterator, Awaitable, Callable, Deque, Dict,
+                    Optional, Tuple)
+
+from loguru import logger
+
+from revgrokapi.configs import (HEDGE_BUDGET_MAX_BALANCE, HEDGE_MIN_SAMPLES,
+                                HEDGE_TTFT_WINDOW)
+from revgrokapi.runtime_settings import RuntimeSettings, runtime_settings
+
+# (上下文, 例如选中的cookie; 上游的流)
+Candidate = Tuple[Any, AsyncIterator]
+# 打开一个上游请求; 参数为None时打开主请求, 否则为主请求的上下文, 需要换一个cookie, 没有可换的返回None
+CandidateOpener = Callable[[Optional[Any]], Awaitable[Optional[Candidate]]]
+
+
+class TTFTTracker:
+    """每个模型最近的首行延迟, 用于计算对冲阈值"""
+
+    def __init__(self, window: int = HEDGE_TTFT_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, key: str, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, key: str, percentile: float) -> Optional[float]:
+        """样本数不足HEDGE_MIN_SAMPLES时返回None"""
+        samples = self._samples.get(key)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def threshold(self, key: str, settings: RuntimeSettings) -> float:
+        """首行超过这个时间还没到就对冲; 样本不足时使用最大值"""
+        value = self.percentile(key, settings.hedge_percentile)
+        if value is None:
+            return settings.hedge_max_delay_seconds
+        return min(
+            settings.hedge_max_delay_seconds, max(settings.hedge_min_delay_seconds, value)
+        )
+
+    def keys(self):
+        return list(self._samples)
+
+
+class HedgeBudget:
+    """每个请求存入ratio个令牌, 每次对冲取出一个, 对冲数不超过请求数的ratio"""
+
+    __slots__ = ("balance",)
+
+    def __init__(self):
+        self.balance = 0.0
+
+    def deposit(self, ratio: float):
+        self.balance = min(HEDGE_BUDGET_MAX_BALANCE, self.balance + ratio)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class ChatHedger:
+    def __init__(self):
+        self.tracker = TTFTTracker()
+        self.budget = HedgeBudget()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+        self.no_alternative = 0
+
+    async def hedge(
+        self,
+        key: str,
+        primary: Candidate,
+        open_candidate: CandidateOpener,
+        accept: Callable[[Any], bool] = lambda item: True,
+        on_reject: Optional[Callable[[Any, Any], Awaitable[None]]] = None,
+    ) -> Candidate:
+        """返回实际使用的(上下文, 流), 流中包含已经读到的第一项
+
+        accept判断第一项是否可用(例如不是错误), 不可用的一方在另一方还在等待时让位,
+        on_reject(上下文, 第一项)用于处理被丢弃的错误(例如标记额度用完).
+        """
+        settings = runtime_settings.current
+        if not settings.hedge_enabled:
+            return primary
+        self.requests += 1
+        self.budget.deposit(settings.hedge_budget_ratio)
+        primary_context, primary_stream = primary
+        start = time.perf_counter()
+        primary_task = asyncio.ensure_future(_first_item(primary))
+        threshold = self.tracker.threshold(key, settings)
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=threshold)
+        except BaseException:
+            # 等待期间被取消(客户端断开)
+            await _cancel(primary_task)
+            await _close(primary_stream)
+            raise
+        if done:
+            self._record(key, primary_task, accept, start)
+            return primary_context, _replay(primary_task, primary_stream)
+        if not self.budget.withdraw():
+            self.budget_denied += 1
+            return primary_context, _replay(
+                primary_task, primary_stream, record=(self, key, accept, start)
+            )
+
+        self.hedged += 1
+        logger.info(f"Hedging {key}: no first token after {threshold:.2f}s")
+        opened: list = []
+        backup_task = asyncio.ensure_future(
+            self._open_backup(open_candidate, primary_context, opened)
+        )
+        winner = None
+        try:
+            pending = {primary_task, backup_task}
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成时优先主请求; 主请求不可用时继续等对冲请求
+                for task in sorted(done, key=lambda task: task is not primary_task):
+                    if _usable(task, accept):
+                        winner = task
+                        break
+                    if task is backup_task:
+                        await self._discard(backup_task, on_reject)
+            if winner is None:
+                # 都不可用时按没有对冲处理, 主请求的错误交给调用方
+                winner = primary_task
+            if winner is backup_task:
+                self.hedge_wins += 1
+                # 主请求的首行延迟至少是这么久
+                self.tracker.record(key, time.perf_counter() - start)
+                if primary_task.done():
+                    await self._discard(primary_task, on_reject)
+            else:
+                self._record(key, primary_task, accept, start)
+        finally:
+            for task in (primary_task, backup_task):
+                if task is not winner:
+                    await _cancel(task)
+            if winner is not backup_task:
+                for _, stream in opened:
+                    await _close(stream)
+            if winner is not primary_task:
+                await _close(primary_stream)
+
+        if winner is backup_task:
+            context, stream, _ = backup_task.result()
+            return context, _replay(winner, stream)
+        return primary_context, _replay(primary_task, primary_stream)
+
+    async def _open_backup(self, open_candidate: CandidateOpener, primary_context, opened: list):
+        candidate = await open_candidate(primary_context)
+        if candidate is None:
+            self.no_alternative += 1
+            return None
+        opened.append(candidate)
+        return await _first_item(candidate)
+
+    def _record(self, key: str, task: asyncio.Future, accept, start: float):
+        if _usable(task, accept):
+            self.tracker.record(key, time.perf_counter() - start)
+
+    @staticmethod
+    async def _discard(task: asyncio.Future, on_reject):
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        context, stream, item = task.result()
+        await _close(stream)
+        if on_reject is not None:
+            try:
+                await on_reject(context, item)
+            except Exception as e:
+                logger.error(f"Failed to handle discarded hedge response: {e}")
+
+    def stats(self) -> Dict:
+        settings = runtime_settings.current
+        return {
+            "enabled": settings.hedge_enabled,
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            "no_alternative": self.no_alternative,
+            "budget_balance": round(self.budget.balance, 3),
+            "thresholds": {
+                key: round(self.tracker.threshold(key, settings), 3)
+                for key in self.tracker.keys()
+            },
+        }
+
+
+async def _first_item(candidate: Candidate):
+    context, stream = candidate
+    return context, stream, await stream.__anext__()
+
+
+def _usable(task: asyncio.Future, accept) -> bool:
+    if task.cancelled() or task.exception() is not None or task.result() is None:
+        return False
+    return accept(task.result()[2])
+
+
+async def _cancel(task: asyncio.Future):
+    if not task.done():
+        task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+
+
+async def _close(stream: AsyncIterator):
+    try:
+        await stream.aclose()
+    except Exception as e:
+        logger.debug(f"Failed to close hedged stream: {e}")
+
+
+async def _replay(task: asyncio.Future, stream: AsyncIterator, record=None):
+    """先给出已经读到(或正在读)的第一项, 再继续读原来的流"""
+    try:
+        try:
+            _, _, item = await task
+        except StopAsyncIteration:
+            return
+        if record is not None:
+            hedger, key, accept, start = record
+            hedger._record(key, task, accept, start)
+        yield item
+        async for item in stream:
+            yield item
+    finally:
+        if not task.done():
+            await _cancel(task)
+        await _close(stream)
+
+
+chat_hedger = ChatHedger()
@@ -0,0 +1,157 @@
+"""
+revgrokapi/openai_api/model_registry.py
+
+Declarative mapping from the model names exposed on the OpenAI compatible api to
+the upstream grok model and the behaviour of the request. Extra models can be
+added in `MODEL_REGISTRY_PATH` (a json list of ModelSpec fields) without code
+changes, e.g.:
+
+    [{"name": "grok-3-mini", "upstream_model": "grok-3-mini"}]
+"""
+import json
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping
+
+from loguru import logger
+
+from revgrokapi.configs import MODEL_REGISTRY_PATH
+from revgrokapi.models.cookie_models import QueryCategory
+from revgrokapi.utils.json_utils import load_json
+
+
+@dataclass(frozen=True, slots=True)
+class ModelSpec:
+    name: str
+    upstream_model: str = "grok-3"
+    category: QueryCategory = QueryCategory.DEFAULT
+    reasoning: bool = False
+    deepsearch: bool = False
+    # 直接覆盖到上游chat payload中的字段, 构造后为只读映射; 比较和hash用下面的JSON
+    payload_overrides: Mapping[str, Any] = field(default_factory=dict, compare=False)
+    # prompt的token预算, 0 表示不限制
+    max_prompt_tokens: int = 0
+    # 思考/deepsearch过程的输出方式: "markdown" 或 "structured"(reasoning_content)
+    reasoning_format: str = "markdown"
+    owned_by: str = "xai"
+    payload_overrides_json: str = field(init=False, repr=False, default="")
+
+    def __post_init__(self):
+        # 复制一份再冻结, 调用方之后修改传入的dict不影响这个spec
+        overrides_json = (
+            json.dumps(dict(self.payload_overrides), sort_keys=True)
+            if self.payload_overrides
+            else ""
+        )
+        object.__setattr__(self, "payload_overrides_json", overrides_json)
+        object.__setattr__(
+            self,
+            "payload_overrides",
+            MappingProxyType(json.loads(overrides_json) if overrides_json else {}),
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ModelSpec":
+        known = {f.name for f in fields(cls) if f.init}
+        unknown = set(data) - known
+        if unknown:
+            raise ValueError(f"Unknown model spec fields: {sorted(unknown)}")
+        data = dict(data)
+        if "category" in data:
+            data["category"] = QueryCategory(data["category"])
+        return cls(**data)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {f.name: getattr(self, f.name) for f in fields(self) if f.init}
+        data["category"] = self.category.value
+        data["payload_overrides"] = dict(self.payload_overrides)
+        return data
+
+
+DEFAULT_MODEL_SPECS = [
+    ModelSpec(name="grok-3"),
+    ModelSpec(
+        name="grok-3-reasoner",
+        category=QueryCategory.REASONING,
+        reasoning=True,
+    ),
+    ModelSpec(
+        name="grok-3-deepresearch",
+        category=QueryCategory.DEEPSEARCH,
+        deepsearch=True,
+    ),
+    ModelSpec(
+        name="grok-3-image",
+        payload_overrides={
+            "enableImageGeneration": True,
+            "returnImageBytes": True,
+            "enableImageStreaming": True,
+            "imageGenerationCount": 2,
+        },
+    ),
+]
+
+
+class ModelRegistry:
+    def __init__(self, specs: List[ModelSpec]):
+        self._specs: Dict[str, ModelSpec] = {}
+        for spec in specs:
+            self._specs[spec.name.lower()] = spec
+        self._models_response = self._build_models_response()
+
+    @classmethod
+    def load(cls, path: Path = MODEL_REGISTRY_PATH) -> "ModelRegistry":
+        """默认模型 + path中的自定义模型(同名时覆盖默认)"""
+        specs = list(DEFAULT_MODEL_SPECS)
+        if path.exists():
+            try:
+                specs.extend(ModelSpec.from_dict(item) for item in load_json(path))
+            except Exception as e:
+                logger.error(f"Failed to load model registry from {path}: {e}")
+        return cls(specs)
+
+    def _build_models_response(self) -> bytes:
+        data = [
+            {
+                "id": spec.name,
+                "object": "model",
+                "created": 0,
+                "owned_by": spec.owned_by,
+            }
+            for spec in self._specs.values()
+        ]
+        return json.dumps({"object": "list", "data": data}).encode("utf-8")
+
+    @staticmethod
+    def _fallback_spec(name: str) -> ModelSpec:
+        """未注册的模型名沿用之前按子串判断的行为"""
+        lowered = name.lower()
+        reasoning = "reasoner" in lowered
+        deepsearch = "deepresearch" in lowered
+        category = QueryCategory.DEFAULT
+        if reasoning:
+            category = QueryCategory.REASONING
+        elif deepsearch:
+            category = QueryCategory.DEEPSEARCH
+        return ModelSpec(
+            name=name, category=category, reasoning=reasoning, deepsearch=deepsearch
+        )
+
+    def resolve(self, name: str) -> ModelSpec:
+        spec = self._specs.get(name) or self._specs.get(name.lower())
+        if spec is None:
+            logger.debug(f"Model {name} is not registered, using fallback spec")
+            spec = self._fallback_spec(name)
+        return spec
+
+    def specs(self) -> List[ModelSpec]:
+        return list(self._specs.values())
+
+    @property
+    def models_response(self) -> bytes:
+        """预先序列化好的 /v1/models 响应体"""
+        return self._models_response
+
+
+model_registry = ModelRegistry.load()
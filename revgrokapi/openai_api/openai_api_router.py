@@ -1,16 +1,40 @@
 import asyncio
+import base64
 import json
 import time
 import uuid
+from typing import Optional
 from uuid import uuid4
 
-from fastapi import APIRouter, Header, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import (APIRouter, Header, HTTPException, Request, WebSocket,
+                     WebSocketDisconnect, status)
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from loguru import logger
+from pydantic import ValidationError
 
-from revgrokapi.configs import POE_OPENAI_LIKE_API_KEY
-from revgrokapi.openai_api.schemas import ChatCompletionRequest, ChatMessage
-from revgrokapi.openai_api.utils import grok_chat
+from revgrokapi.configs import IMAGE_STORE_DIR, USE_TOKEN_SHORTEN
+from revgrokapi.openai_api.chat_sessions import (ChatSession,
+                                                 SessionLimitError,
+                                                 chat_session_manager)
+from revgrokapi.openai_api.model_registry import ModelSpec, model_registry
+from revgrokapi.openai_api.schemas import (ChatCompletionRequest, ChatMessage,
+                                           ChatSessionTurn, ChatSessionUpdate,
+                                           ImageGenerationRequest)
+from revgrokapi.openai_api.stream_renderer import rendered_text
+from revgrokapi.openai_api.utils import (ImageAttachment,
+                                        extract_messages_and_images, grok_chat,
+                                        grok_generate_images)
+from revgrokapi.quota import (AdmissionTicket, ApiKeyState,
+                              InvalidApiKeyError, QuotaExceededError,
+                              RateLimitExceededError, ServerBusyError,
+                              UsageOutcome, UsageRecord, admission_controller,
+                              api_key_manager)
+from revgrokapi.tracing import Trace, finish_trace, span, start_trace
+from revgrokapi.utils.async_task_utils import submit_task2event_loop
+from revgrokapi.utils.auth_utils import extract_bearer_api_key
+from revgrokapi.utils.image_utils import build_image_url
+from revgrokapi.utils.token_utils import (count_tokens,
+                                         shorten_message_given_prompt_length)
 
 # from rev_claude.client.claude_router import (ClientManager,
 #                                              select_client_by_usage)
@@ -22,49 +46,244 @@ from revgrokapi.openai_api.utils import grok_chat
 #                                          summarize_a_title)
 # from utility import get_client_status
 
-# Add this constant at the top of the file after the imports
-VALID_API_KEY = POE_OPENAI_LIKE_API_KEY
-
 router = APIRouter()
 
+ERROR_PREFIX = "[ERROR] "
+
+
+def trace_headers(trace: Trace | None, server_timing: bool = False) -> dict:
+    if trace is None:
+        return {}
+    headers = {"X-Trace-Id": trace.trace_id}
+    if server_timing:
+        headers["Server-Timing"] = trace.server_timing()
+    return headers
+
+
+async def _record_completion_tokens(
+    key_state: ApiKeyState | None,
+    text: str,
+    usage: UsageRecord | None = None,
+    outcome: UsageOutcome = UsageOutcome.OK,
+) -> int:
+    completion_tokens = await submit_task2event_loop(count_tokens, text)
+    if key_state is not None:
+        api_key_manager.record_completion(key_state, completion_tokens)
+    if usage is not None:
+        usage.finish(completion_tokens, outcome)
+    return completion_tokens
 
-async def _async_resp_generator(original_generator, model: str):
+
+def _is_error_chunk(data) -> bool:
+    """重试全部失败时async_retry给出的错误"""
+    return isinstance(data, str) and data.startswith(ERROR_PREFIX)
+
+
+async def _async_resp_generator(
+    original_generator,
+    model: str,
+    key_state: ApiKeyState | None = None,
+    trace: Trace | None = None,
+    ticket: AdmissionTicket | None = None,
+    usage: UsageRecord | None = None,
+):
     i = 0
     response_text = ""
     first_chunk = True
-    async for data in original_generator:
-        response_text += data
-        chunk = {
-            "id": i,
-            "object": "chat.completion.chunk",
-            "created": time.time(),
-            "model": model,
-            "choices": [
-                {
-                    "delta": {
-                        "content": f"{data}",
-                        **(
-                            {"role": "assistant"} if first_chunk else {}
-                        ),  # 只在第一个chunk添加role
-                    }
-                }
-            ],
-        }
-        first_chunk = False
-
-        yield f"data: {json.dumps(chunk)}\n\n"
-        i += 1
-
-    yield f"data: {json.dumps({'choices':[{'index': 0, 'delta': {}, 'logprobs': None, 'finish_reason': 'stop'}]})}\n\n"
-    yield "data: [DONE]\n\n"
-
-
-async def streaming_message(request: ChatCompletionRequest, api_key: str = None):
-    # Add API key validation
-    if api_key != VALID_API_KEY:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
-    model = request.model
+    # 没有正常结束就是客户端中途断开
+    outcome = UsageOutcome.CANCELLED
+    errored = False
+    try:
+        async for data in original_generator:
+            errored = errored or _is_error_chunk(data)
+            response_text += rendered_text(data)
+            # structured格式下渲染结果本身就是delta
+            delta = dict(data) if isinstance(data, dict) else {"content": f"{data}"}
+            if first_chunk:
+                delta["role"] = "assistant"  # 只在第一个chunk添加role
+                if trace is not None:
+                    trace.attributes["ttft_ms"] = round(trace.duration * 1000, 3)
+            chunk = {
+                "id": i,
+                "object": "chat.completion.chunk",
+                "created": time.time(),
+                "model": model,
+                "choices": [{"delta": delta}],
+            }
+            first_chunk = False
+
+            # yield之后到恢复执行之间就是把数据写给客户端的时间
+            write_start = time.perf_counter()
+            yield f"data: {json.dumps(chunk)}\n\n"
+            if trace is not None:
+                trace.add_timing("sse_write", time.perf_counter() - write_start)
+            i += 1
+
+        outcome = UsageOutcome.ERROR if errored else UsageOutcome.OK
+        yield f"data: {json.dumps({'choices':[{'index': 0, 'delta': {}, 'logprobs': None, 'finish_reason': 'stop'}]})}\n\n"
+        yield "data: [DONE]\n\n"
+    except Exception:
+        outcome = UsageOutcome.ERROR
+        raise
+    finally:
+        if ticket is not None:
+            ticket.release()
+        # 客户端中途断开也要把已经生成的部分计入用量
+        if key_state is not None or usage is not None:
+            await _record_completion_tokens(key_state, response_text, usage, outcome)
+        finish_trace(trace)
+
+
+async def collect_completion(
+    original_generator,
+    model: str,
+    prompt_tokens: int,
+    key_state: ApiKeyState | None = None,
+    trace: Trace | None = None,
+    ticket: AdmissionTicket | None = None,
+    usage: UsageRecord | None = None,
+) -> dict:
+    """非流式请求: 收集完整的回复, 返回chat.completion响应体"""
+    content_parts = []
+    reasoning_parts = []
+    completion_tokens = 0
+    outcome = UsageOutcome.CANCELLED
+    errored = False
+    try:
+        async for data in original_generator:
+            errored = errored or _is_error_chunk(data)
+            if isinstance(data, dict):
+                content_parts.append(data.get("content", ""))
+                reasoning_parts.append(data.get("reasoning_content", ""))
+            else:
+                content_parts.append(data)
+        outcome = UsageOutcome.ERROR if errored else UsageOutcome.OK
+    except Exception:
+        outcome = UsageOutcome.ERROR
+        raise
+    finally:
+        if ticket is not None:
+            ticket.release()
+        completion_tokens = await _record_completion_tokens(
+            key_state, "".join(content_parts) + "".join(reasoning_parts), usage, outcome
+        )
+        finish_trace(trace)
+
+    message = {"role": "assistant", "content": "".join(content_parts)}
+    reasoning_content = "".join(reasoning_parts)
+    if reasoning_content:
+        message["reasoning_content"] = reasoning_content
+    return {
+        "id": f"chatcmpl-{uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+async def _collect_completion(
+    original_generator,
+    model: str,
+    prompt_tokens: int,
+    key_state: ApiKeyState | None = None,
+    trace: Trace | None = None,
+    ticket: AdmissionTicket | None = None,
+    usage: UsageRecord | None = None,
+):
+    """非流式请求: 带上Server-Timing返回完整的回复"""
+    body = await collect_completion(
+        original_generator, model, prompt_tokens, key_state, trace, ticket, usage
+    )
+    return JSONResponse(body, headers=trace_headers(trace, server_timing=True))
+
+
+def require_api_key(authorization: str | None) -> str:
+    api_key = extract_bearer_api_key(authorization)
+    # logger.debug(f"API key: {api_key}")
+    if not api_key:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid Authorization header. Format should be 'Bearer YOUR_API_KEY'",
+        )
+    return api_key
+
+
+async def admit_api_key(api_key: str, prompt: str) -> tuple[ApiKeyState, int]:
+    """校验api key的有效性、速率和额度, 只读内存不访问数据库; 返回(状态, prompt tokens)"""
+    prompt_tokens = await submit_task2event_loop(count_tokens, prompt)
+    try:
+        return api_key_manager.admit(api_key, prompt_tokens), prompt_tokens
+    except InvalidApiKeyError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except RateLimitExceededError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, round(e.retry_after)))},
+        )
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+
+def admit_request() -> AdmissionTicket:
+    """全局并发上限, 满了返回503让客户端稍后重试"""
+    try:
+        return admission_controller.acquire()
+    except ServerBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+
+async def admit(api_key: str, prompt: str) -> tuple[AdmissionTicket, ApiKeyState, int]:
+    """先占用并发名额再计入api key的用量, 503时不扣key的令牌和额度; key被拒绝时归还名额"""
+    ticket = admit_request()
+    try:
+        key_state, prompt_tokens = await admit_api_key(api_key, prompt)
+    except BaseException:
+        ticket.release()
+        raise
+    return ticket, key_state, prompt_tokens
+
+
+async def build_prompt(messages: list[ChatMessage], model_spec: ModelSpec) -> str:
+    message_dicts = [{"role": m.role, "content": m.content} for m in messages]
+    if USE_TOKEN_SHORTEN and model_spec.max_prompt_tokens:
+        message_dicts = await submit_task2event_loop(
+            shorten_message_given_prompt_length,
+            message_dicts,
+            model_spec.max_prompt_tokens,
+        )
+    return "\n".join(
+        [f"{message['role']}: {message['content']}" for message in message_dicts]
+    )
+
+
+async def prepare_chat(
+    request: ChatCompletionRequest,
+) -> tuple[ModelSpec, str, list[ImageAttachment]]:
+    """解析模型, 拆出图片附件并构建prompt; 消息内容无效时抛出HTTPException(400)"""
+    model_spec = model_registry.resolve(request.model)
+    try:
+        messages, images = await extract_messages_and_images(request.messages)
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid message content: {e}")
+    prompt = await build_prompt(messages, model_spec)
+    return model_spec, prompt, images
+
+
+async def streaming_message(
+    request: ChatCompletionRequest,
+    model_spec: ModelSpec,
+    prompt: str,
+    images: list[ImageAttachment] = (),
+    image_base_url: str = "",
+    usage: UsageRecord | None = None,
+):
     # Validate API key here if needed
     # done_data = build_sse_data(message="closed", id=conversation_id)
     # basic_clients = clients["basic_clients"]
@@ -78,10 +297,10 @@ async def streaming_message(request: ChatCompletionRequest, api_key: str = None)
     # conversation_id = str(uuid4())
     # attachments = []
     # files = []
-    messages = request.messages
     # messages, file_paths = await extract_messages_and_images(messages)
-    prompt = "\n".join([f"{message.role}: {message.content}" for message in messages])
-    return grok_chat(model, prompt)
+    return grok_chat(
+        model_spec, prompt, request.reasoning_format, images, image_base_url, usage
+    )
     # last_message = messages[-1]
     # request_model = request.model
     # if "r1" in request_model.lower():
@@ -131,38 +350,305 @@ async def streaming_message(request: ChatCompletionRequest, api_key: str = None)
     #         return title
 
 
+@router.get("/v1/models")
+async def list_models():
+    return Response(
+        content=model_registry.models_response, media_type="application/json"
+    )
+
+
 @router.post("/v1/chat/completions")
 async def chat_completions(
-    request: ChatCompletionRequest, authorization: str = Header(None)
+    request: ChatCompletionRequest,
+    raw_request: Request,
+    authorization: str = Header(None),
 ):
     if not request.messages:
         raise HTTPException(status_code=400, detail="No messages provided.")
 
     # logger.debug(f"authorization: {authorization}")
     # Extract API key from Authorization header
-    api_key = None
-    if authorization:
-        if authorization.startswith("Bearer"):
-            api_key = authorization.replace("Bearer", "").strip()
+    api_key = require_api_key(authorization)
 
-    # logger.debug(f"API key: {api_key}")
-    if not api_key:
-        raise HTTPException(
-            status_code=401,
-            detail="Invalid Authorization header. Format should be 'Bearer YOUR_API_KEY'",
+    trace = start_trace(
+        "chat.completions", model=request.model, stream=bool(request.stream)
+    )
+    ticket = None
+    try:
+        with span("prepare"):
+            model_spec, prompt, images = await prepare_chat(request)
+            ticket, key_state, prompt_tokens = await admit(api_key, prompt)
+
+        usage = UsageRecord(model_spec.name, model_spec.category, prompt_tokens)
+        resp_content = await streaming_message(
+            request, model_spec, prompt, images, str(raw_request.base_url), usage
         )
+    except BaseException as e:
+        if ticket is not None:
+            ticket.release()
+        if trace is not None:
+            trace.attributes["status_code"] = getattr(e, "status_code", 500)
+        finish_trace(trace)
+        raise
 
-    resp_content = await streaming_message(request, api_key=api_key)
     if request.stream:
         return StreamingResponse(
-            _async_resp_generator(resp_content, request.model),
+            _async_resp_generator(
+                resp_content, request.model, key_state, trace, ticket, usage
+            ),
             media_type="text/event-stream",
+            headers=trace_headers(trace),
         )
+    return await _collect_completion(
+        resp_content, request.model, prompt_tokens, key_state, trace, ticket, usage
+    )
 
-    return {
-        "id": uuid.uuid4(),
-        "object": "chat.completion",
-        "created": time.time(),
-        "model": request.model,
-        "choices": [{"message": ChatMessage(role="assistant", content="not implemented")}],
+
+@router.post("/v1/images/generations")
+async def image_generations(
+    request: ImageGenerationRequest,
+    raw_request: Request,
+    authorization: str = Header(None),
+):
+    api_key = require_api_key(authorization)
+    trace = start_trace("images.generations", model=request.model, n=request.n)
+    try:
+        model_spec = model_registry.resolve(request.model)
+        ticket, _, prompt_tokens = await admit(api_key, request.prompt)
+
+        image_names = []
+        usage = UsageRecord(model_spec.name, model_spec.category, prompt_tokens)
+        outcome = UsageOutcome.ERROR
+        try:
+            async for result in grok_generate_images(
+                model_spec, request.prompt, request.n, usage
+            ):
+                if _is_error_chunk(result):
+                    raise HTTPException(status_code=502, detail=result)
+                image_names.append(result)
+            outcome = UsageOutcome.OK
+        finally:
+            ticket.release()
+            usage.finish(0, outcome)
+
+        data = []
+        for image_name in image_names:
+            if request.response_format == "b64_json":
+                image_path = IMAGE_STORE_DIR / image_name
+                image_bytes = await submit_task2event_loop(image_path.read_bytes)
+                data.append({"b64_json": base64.b64encode(image_bytes).decode("ascii")})
+            else:
+                data.append(
+                    {"url": build_image_url(str(raw_request.base_url), image_name)}
+                )
+    finally:
+        finish_trace(trace)
+    return JSONResponse(
+        {"created": int(time.time()), "data": data},
+        headers=trace_headers(trace, server_timing=True),
+    )
+
+
+async def run_session_turn(
+    session: ChatSession, new_messages: list[ChatMessage], image_base_url: str
+):
+    """会话中的一轮: 和/v1/chat/completions一样准入和计量, 把delta逐个发给客户端"""
+    response_id = f"resp_{uuid4().hex}"
+    trace = start_trace("chat.session.turn", model=session.model, session_id=session.id)
+    try:
+        with span("prepare"):
+            model_spec, prompt, images = await prepare_chat(
+                ChatCompletionRequest(
+                    model=session.model,
+                    messages=[*session.messages, *new_messages],
+                    reasoning_format=session.reasoning_format,
+                )
+            )
+            # 能在上游对话中继续时只发送这一轮的消息
+            follow_up_messages, follow_up_images = await extract_messages_and_images(
+                new_messages
+            )
+            follow_up_prompt = await build_prompt(follow_up_messages, model_spec)
+            # 预计能续接上游对话时只按这一轮的消息计入, 没能续接时再补上完整历史的差额
+            expect_continue = bool(session.binding.conversation_id and session.binding.response_id)
+            ticket, key_state, prompt_tokens = await admit(
+                session.api_key, follow_up_prompt if expect_continue else prompt
+            )
+    except HTTPException as e:
+        if trace is not None:
+            trace.attributes["status_code"] = e.status_code
+        finish_trace(trace)
+        await session.send(
+            "error",
+            response_id=response_id,
+            error={"code": e.status_code, "message": e.detail},
+        )
+        return
+
+    usage = UsageRecord(model_spec.name, model_spec.category, prompt_tokens)
+    binding = session.binding
+    binding.new_turn(follow_up_prompt, follow_up_images)
+    content_parts = []
+    reasoning_parts = []
+    error = None
+    outcome = UsageOutcome.CANCELLED
+    try:
+        await session.send("response.created", response_id=response_id, model=session.model)
+        async for data in grok_chat(
+            model_spec,
+            prompt,
+            session.reasoning_format,
+            images,
+            image_base_url,
+            usage,
+            binding,
+        ):
+            if _is_error_chunk(data):
+                error = data[len(ERROR_PREFIX):]
+                continue
+            if isinstance(data, dict):
+                content_parts.append(data.get("content") or "")
+                reasoning_parts.append(data.get("reasoning_content") or "")
+                delta = dict(data)
+            else:
+                content_parts.append(data)
+                delta = {"content": data}
+            if not await session.send("response.delta", response_id=response_id, delta=delta):
+                # 客户端已经断开
+                break
+        else:
+            outcome = UsageOutcome.ERROR if error is not None else UsageOutcome.OK
+    except asyncio.CancelledError:
+        # response.cancel 或连接断开
+        pass
+    except Exception as e:
+        logger.exception(f"Chat session {session.id} turn failed")
+        outcome = UsageOutcome.ERROR
+        error = str(e)
+    finally:
+        ticket.release()
+
+    if expect_continue and binding.attempts and not binding.continued:
+        # 固定的cookie不可用或续接失败, 上游实际收到的是完整的历史
+        full_prompt_tokens = await submit_task2event_loop(count_tokens, prompt)
+        extra_tokens = max(0, full_prompt_tokens - prompt_tokens)
+        api_key_manager.record_prompt_tokens(key_state, extra_tokens)
+        prompt_tokens += extra_tokens
+        usage.prompt_tokens = prompt_tokens
+    content = "".join(content_parts)
+    completion_tokens = await _record_completion_tokens(
+        key_state, content + "".join(reasoning_parts), usage, outcome
+    )
+    if outcome == UsageOutcome.OK:
+        session.add_messages([*new_messages, ChatMessage(role="assistant", content=content)])
+    else:
+        # 上游对话里可能已经有了这一轮(或它的一部分), 和保存的历史不一致, 下一轮用完整历史新建对话
+        binding.forget_conversation()
+    chat_session_manager.record_turn(session)
+    session.touch()
+    if trace is not None:
+        trace.attributes["continued"] = binding.continued
+        trace.attributes["outcome"] = outcome.value
+    finish_trace(trace)
+
+    done = {
+        "response_id": response_id,
+        "status": {
+            UsageOutcome.OK: "completed",
+            UsageOutcome.CANCELLED: "cancelled",
+        }.get(outcome, "failed"),
+        "continued": binding.continued,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
     }
+    if error is not None:
+        done["error"] = {"message": error}
+    await session.send("response.done", **done)
+
+
+async def handle_session_event(session: ChatSession, event: dict, image_base_url: str):
+    event_type = event.get("type") if isinstance(event, dict) else None
+    if event_type == "ping":
+        await session.send("pong", time=time.time())
+    elif event_type == "session.update":
+        update = ChatSessionUpdate.model_validate(event.get("session") or {})
+        if update.model is not None:
+            session.model = update.model
+        if "reasoning_format" in update.model_fields_set:
+            session.reasoning_format = update.reasoning_format
+        await session.send("session.updated", session=session.to_dict())
+    elif event_type == "response.create":
+        turn = ChatSessionTurn.model_validate(event)
+        if session.busy:
+            await session.send(
+                "error",
+                error={"code": 409, "message": "A response is already in progress"},
+            )
+            return
+        session.turn_task = asyncio.create_task(
+            run_session_turn(session, turn.messages, image_base_url)
+        )
+    elif event_type == "response.cancel":
+        if session.busy:
+            session.turn_task.cancel()
+    else:
+        await session.send(
+            "error", error={"code": 400, "message": f"Unknown event type: {event_type}"}
+        )
+
+
+@router.websocket("/v1/chat/sessions")
+async def chat_session(
+    websocket: WebSocket,
+    model: str = "grok-3",
+    reasoning_format: Optional[str] = None,
+    api_key: Optional[str] = None,
+    authorization: str = Header(None),
+):
+    """多轮会话: 一个连接上连续发送多轮消息, 同一个cookie和上游对话, 协议见 chat_sessions.py
+
+    浏览器不能设置WebSocket的请求头, 也可以用 ?api_key= 传递api key
+    """
+    api_key = extract_bearer_api_key(authorization) or api_key
+    if admission_controller.draining:
+        await websocket.close(status.WS_1013_TRY_AGAIN_LATER, "Server is shutting down")
+        return
+    try:
+        if not api_key:
+            raise InvalidApiKeyError("Missing API key")
+        api_key_manager.get_state(api_key)
+        if reasoning_format is not None:
+            ChatSessionUpdate(reasoning_format=reasoning_format)
+        session = chat_session_manager.open(websocket, api_key, model, reasoning_format)
+    except (InvalidApiKeyError, SessionLimitError, ValidationError) as e:
+        await websocket.close(status.WS_1008_POLICY_VIOLATION, str(e)[:120])
+        return
+
+    await websocket.accept()
+    # 图片链接用http(s)的地址
+    image_base_url = str(
+        websocket.base_url.replace(scheme="https" if websocket.url.scheme == "wss" else "http")
+    )
+    heartbeat = asyncio.create_task(chat_session_manager.heartbeat(session))
+    try:
+        await session.send("session.created", session=session.to_dict())
+        while True:
+            text = await websocket.receive_text()
+            session.touch()
+            try:
+                await handle_session_event(session, json.loads(text), image_base_url)
+            except (ValueError, ValidationError) as e:
+                await session.send("error", error={"code": 400, "message": str(e)})
+    except (WebSocketDisconnect, RuntimeError, KeyError):
+        # 客户端断开, 或心跳任务因为空闲关闭了连接; 二进制帧没有text
+        pass
+    finally:
+        heartbeat.cancel()
+        session.closed = True
+        if session.busy:
+            session.turn_task.cancel()
+            await asyncio.wait([session.turn_task])
+        chat_session_manager.discard(session)
@@ -1,6 +1,6 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class ChatMessage(BaseModel):
@@ -14,3 +14,27 @@ class ChatCompletionRequest(BaseModel):
     max_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.1
     stream: Optional[bool] = False
+    # 覆盖模型默认的思考过程输出方式
+    reasoning_format: Optional[Literal["markdown", "structured"]] = None
+
+
+class ChatSessionUpdate(BaseModel):
+    """多轮会话的 session.update 事件, 对之后的轮次生效"""
+
+    model: Optional[str] = None
+    reasoning_format: Optional[Literal["markdown", "structured"]] = None
+
+
+class ChatSessionTurn(BaseModel):
+    """多轮会话的 response.create 事件, 只包含这一轮新增的消息"""
+
+    messages: List[ChatMessage] = Field(min_length=1)
+
+
+class ImageGenerationRequest(BaseModel):
+    prompt: str
+    model: str = "grok-3-image"
+    n: int = Field(default=1, ge=1, le=4)
+    response_format: Literal["url", "b64_json"] = "url"
+    # 上游不支持指定尺寸, 仅为兼容openai的请求格式
+    size: Optional[str] = None
@@ -0,0 +1,275 @@
+"""
+revgrokapi/openai_api/stream_renderer.py
+
+Incremental renderers turning the upstream grok event stream into what we send
+to the client. The shared state machine tracks steps, the thinking state and
+tool-call json that may be split over several tokens; subclasses decide the
+output format:
+
+- MarkdownStreamRenderer: plain text with <think> tags / blockquotes (the
+  original output of grok_chat).
+- StructuredStreamRenderer: OpenAI style delta dicts with `reasoning_content`,
+  `content` and `tool_calls`.
+"""
+import json
+from typing import Any, Dict, List, Optional, Union
+
+from revgrokapi.revgrok.events import GrokResponseEvent
+
+RenderedChunk = Union[str, Dict[str, Any]]
+
+MARKDOWN_FORMAT = "markdown"
+STRUCTURED_FORMAT = "structured"
+
+# 超过这个长度仍未闭合的 "{...", 不再当作工具调用, 原样输出
+MAX_TOOL_CALL_BUFFER = 16 * 1024
+
+
+class _JsonObjectBuffer:
+    """跨token累积一个json对象, 按括号深度(忽略字符串内部)判断何时闭合"""
+
+    __slots__ = ("parts", "length", "depth", "in_string", "escaped")
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.length = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> int:
+        """写入text, 返回对象闭合处之后的下标, 尚未闭合时返回-1"""
+        for index, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(text[: index + 1])
+                    self.length += index + 1
+                    return index + 1
+        self.parts.append(text)
+        self.length += len(text)
+        return -1
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+class StreamRenderer:
+    def __init__(self, reasoning: bool = False, deepsearch: bool = False):
+        self.reasoning = reasoning
+        self.deepsearch = deepsearch
+        self.is_thinking: Optional[bool] = None
+        self.current_step_id = None
+        self.step_count = 0
+        self.tool_call_count = 0
+        self._tool_buffer: Optional[_JsonObjectBuffer] = None
+
+    # 子类实现的输出 ------------------------------------------------------
+    def on_start(self) -> List[RenderedChunk]:
+        return []
+
+    def on_step(self, step_number: int) -> List[RenderedChunk]:
+        raise NotImplementedError
+
+    def on_thinking_end(self) -> List[RenderedChunk]:
+        return []
+
+    def on_text(self, text: str, thinking: bool) -> List[RenderedChunk]:
+        raise NotImplementedError
+
+    def on_tool_call(self, action: str, action_input: Dict[str, Any]) -> List[RenderedChunk]:
+        raise NotImplementedError
+
+    def on_model_response(self, message: str) -> List[RenderedChunk]:
+        return []
+
+    def on_image(self, url: str) -> List[RenderedChunk]:
+        return [f"\n![image]({url})\n"]
+
+    # 状态机 --------------------------------------------------------------
+    def start(self) -> List[RenderedChunk]:
+        return self.on_start()
+
+    def feed(self, event: GrokResponseEvent) -> List[RenderedChunk]:
+        out: List[RenderedChunk] = []
+        token = event.token
+
+        if event.is_thinking is not None:
+            if self.is_thinking and event.is_thinking is False:
+                out.extend(self._flush_tool_buffer())
+                out.extend(self.on_thinking_end())
+            self.is_thinking = event.is_thinking
+
+        if event.message_step_id is not None:
+            if event.message_step_id != self.current_step_id and token:
+                self.step_count += 1
+                out.extend(self.on_step(self.step_count))
+            self.current_step_id = event.message_step_id
+
+        if event.model_response is not None and self.deepsearch:
+            out.extend(self._flush_tool_buffer())
+            out.extend(self.on_model_response(event.model_response.get("message", "")))
+            return out
+
+        if token:
+            if self.deepsearch:
+                out.extend(self._feed_deepsearch_text(token))
+            else:
+                out.extend(self.on_text(token, bool(self.is_thinking)))
+        return out
+
+    def image(self, url: str) -> List[RenderedChunk]:
+        """生成好的图片(已经保存到本地), 需要异步保存所以不经过feed"""
+        out = self._flush_tool_buffer()
+        out.extend(self.on_image(url))
+        return out
+
+    def finish(self) -> List[RenderedChunk]:
+        return self._flush_tool_buffer()
+
+    def _feed_deepsearch_text(self, text: str) -> List[RenderedChunk]:
+        out: List[RenderedChunk] = []
+        thinking = bool(self.is_thinking)
+        while text:
+            if self._tool_buffer is None:
+                start = text.find("{")
+                if start < 0:
+                    out.extend(self.on_text(text, thinking))
+                    break
+                if start:
+                    out.extend(self.on_text(text[:start], thinking))
+                self._tool_buffer = _JsonObjectBuffer()
+                text = text[start:]
+
+            end = self._tool_buffer.feed(text)
+            if end < 0:
+                if self._tool_buffer.length > MAX_TOOL_CALL_BUFFER:
+                    out.extend(self._flush_tool_buffer())
+                break
+            out.extend(self._close_tool_buffer())
+            text = text[end:]
+        return out
+
+    def _close_tool_buffer(self) -> List[RenderedChunk]:
+        raw = self._tool_buffer.text()
+        self._tool_buffer = None
+        try:
+            action_json = json.loads(raw)
+        except ValueError:
+            action_json = None
+        if (
+            isinstance(action_json, dict)
+            and "action" in action_json
+            and isinstance(action_json.get("action_input"), dict)
+        ):
+            self.tool_call_count += 1
+            return self.on_tool_call(action_json["action"], action_json["action_input"])
+        return self.on_text(raw, bool(self.is_thinking))
+
+    def _flush_tool_buffer(self) -> List[RenderedChunk]:
+        """未闭合的缓冲区作为普通文本输出"""
+        if self._tool_buffer is None:
+            return []
+        raw = self._tool_buffer.text()
+        self._tool_buffer = None
+        return self.on_text(raw, bool(self.is_thinking))
+
+
+class MarkdownStreamRenderer(StreamRenderer):
+    def on_start(self):
+        if self.reasoning:
+            return ["\n>", "<think>"]
+        return []
+
+    def on_step(self, step_number: int):
+        return [f"\n---\n> `Step{step_number}`\n>"]
+
+    def on_thinking_end(self):
+        if self.reasoning:
+            return ["</think>", "\n\n"]
+        return []
+
+    def on_text(self, text: str, thinking: bool):
+        if self.deepsearch:
+            # deepsearch的输出整体放在引用块里
+            return [text.replace("\n", "\n>")]
+        if thinking and text == "\n":
+            return ["\n>"]
+        return [text]
+
+    def on_tool_call(self, action: str, action_input: Dict[str, Any]):
+        action_params = ",".join(f"{k}: {v}" for k, v in action_input.items())
+        return [f"\n  ***{action} with {action_params},***"]
+
+    def on_model_response(self, message: str):
+        return ["\n" + message]
+
+
+class StructuredStreamRenderer(StreamRenderer):
+    def __init__(self, reasoning: bool = False, deepsearch: bool = False):
+        super().__init__(reasoning, deepsearch)
+        self.has_content = False
+
+    def on_step(self, step_number: int):
+        return [{"reasoning_content": f"\n\n[Step {step_number}]\n"}]
+
+    def on_text(self, text: str, thinking: bool):
+        if thinking:
+            return [{"reasoning_content": text}]
+        self.has_content = True
+        return [{"content": text}]
+
+    def on_tool_call(self, action: str, action_input: Dict[str, Any]):
+        index = self.tool_call_count - 1
+        return [
+            {
+                "tool_calls": [
+                    {
+                        "index": index,
+                        "id": f"call_{index}",
+                        "type": "function",
+                        "function": {
+                            "name": action,
+                            "arguments": json.dumps(action_input, ensure_ascii=False),
+                        },
+                    }
+                ]
+            }
+        ]
+
+    def on_image(self, url: str):
+        self.has_content = True
+        return [{"content": f"\n![image]({url})\n"}]
+
+    def on_model_response(self, message: str):
+        # 最终答案已经以token形式输出过时不再重复
+        if self.has_content or not message:
+            return []
+        self.has_content = True
+        return [{"content": message}]
+
+
+def create_stream_renderer(
+    reasoning_format: str, reasoning: bool = False, deepsearch: bool = False
+) -> StreamRenderer:
+    if reasoning_format == STRUCTURED_FORMAT:
+        return StructuredStreamRenderer(reasoning, deepsearch)
+    return MarkdownStreamRenderer(reasoning, deepsearch)
+
+
+def rendered_text(chunk: RenderedChunk) -> str:
+    """渲染结果中的文本部分, 用于拼接response_text/统计token"""
+    if isinstance(chunk, str):
+        return chunk
+    return chunk.get("content", "") + chunk.get("reasoning_content", "")
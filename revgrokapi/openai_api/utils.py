@@ -1,20 +1,150 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import asyncio
+import base64
+import binascii
 import functools
-import json
+import hashlib
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Optional
 
 from fastapi import Request
 from loguru import logger
 
-from revgrokapi.models.cookie_models import (Cookie, CookieQueries, CookieType,
-                                             QueryCategory)
+from revgrokapi.configs import HEDGE_SELECT_ATTEMPTS
+from revgrokapi.openai_api.hedging import chat_hedger
+from revgrokapi.openai_api.model_registry import ModelSpec
 from revgrokapi.openai_api.schemas import ChatMessage
+from revgrokapi.openai_api.stream_renderer import create_stream_renderer
+from revgrokapi.pool import cookie_pool
+from revgrokapi.periodic_checks.window_recovery import \
+    window_recovery_scheduler
+from revgrokapi.quota.cookie_health import cookie_health
+from revgrokapi.quota.usage_accounting import UsageOutcome, UsageRecord
+from revgrokapi.revgrok.attachment_cache import attachment_cache
 from revgrokapi.revgrok.client import GrokClient
-from revgrokapi.utils.async_utils import async_retry
+from revgrokapi.revgrok.session_pool import grok_client_pool
+from revgrokapi.revgrok.events import GrokResponseEvent, TimeoutPhase
+from revgrokapi.runtime_settings import runtime_settings
+from revgrokapi.tracing import add_timing, span, traced
+from revgrokapi.utils.async_task_utils import submit_task2event_loop
+from revgrokapi.utils.async_utils import NonRetryableError, async_retry
+from revgrokapi.utils.file_utils import DocumentConverter
+from revgrokapi.utils.image_utils import build_image_url, save_image_b64
+
+DATA_URL_PATTERN = re.compile(r"^data:(?P<mime>[\w.+-]+/[\w.+-]+)?(?P<params>(;[^;,]*)*?);base64,", re.I)
+IMAGE_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/gif": "gif",
+    "image/webp": "webp",
+}
+
+
+@dataclass(frozen=True, slots=True)
+class ImageAttachment:
+    mime_type: str
+    # 原始的base64字符串, 上传接口直接使用, 不需要重新编码
+    content_b64: str
+    digest: str
+
+    @property
+    def file_name(self) -> str:
+        extension = IMAGE_EXTENSIONS.get(self.mime_type, "bin")
+        return f"{self.digest[:16]}.{extension}"
+
+
+@dataclass(slots=True)
+class ConversationBinding:
+    """多轮会话固定使用的cookie和上游对话, grok_chat在每一轮中读取并更新"""
+
+    cookie_id: Optional[int] = None
+    conversation_id: Optional[str] = None
+    response_id: Optional[str] = None
+    # 本轮能在上游对话中继续时只发送新的消息和图片, 否则发送完整的历史
+    follow_up_prompt: Optional[str] = None
+    follow_up_images: list = field(default_factory=list)
+    # 本轮已经尝试的次数; 重试时换cookie, 只有续接对话失败时保留cookie新建对话
+    attempts: int = 0
+    retry_same_cookie: bool = False
+    # 本轮实际是否在上游对话中继续
+    continued: bool = False
+    # 固定的cookie不可用、换成其他cookie的次数
+    rebinds: int = 0
+
+    @property
+    def can_continue(self) -> bool:
+        return bool(self.conversation_id and self.response_id) and self.follow_up_prompt is not None
+
+    def new_turn(self, follow_up_prompt: Optional[str], follow_up_images: list = ()):
+        self.follow_up_prompt = follow_up_prompt
+        self.follow_up_images = list(follow_up_images)
+        self.attempts = 0
+        self.retry_same_cookie = False
+        self.continued = False
+
+    def begin_attempt(self):
+        if self.attempts and not self.retry_same_cookie:
+            self.unpin()
+        self.retry_same_cookie = False
+        self.attempts += 1
+
+    def forget_conversation(self):
+        self.conversation_id = None
+        self.response_id = None
+
+    def unpin(self):
+        self.cookie_id = None
+        self.forget_conversation()
+
+    def bind(self, cookie_id: int, continued: bool):
+        """记录本轮使用的cookie; 没有续接时上游新建了对话, 之前的对话id作废"""
+        if self.cookie_id is not None and cookie_id != self.cookie_id:
+            self.rebinds += 1
+        self.cookie_id = cookie_id
+        self.continued = continued
+        if not continued:
+            self.forget_conversation()
+
+    def observe(self, event: GrokResponseEvent):
+        if event.conversation_id:
+            self.conversation_id = event.conversation_id
+        if event.response_id:
+            self.response_id = event.response_id
+
+
+def decode_image_url(url: str) -> ImageAttachment:
+    """解析 data:image/...;base64,... 形式的图片, 校验base64并计算内容hash(cpu密集, 在线程池中执行)"""
+    match = DATA_URL_PATTERN.match(url)
+    if match:
+        mime_type = (match.group("mime") or "image/png").lower()
+        content_b64 = url[match.end():]
+    else:
+        # 兼容直接传裸base64的客户端
+        mime_type = "image/png"
+        content_b64 = url
+    content_b64 = "".join(content_b64.split())
+    try:
+        raw = base64.b64decode(content_b64, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"Invalid base64 image: {e}")
+    if not raw:
+        raise ValueError("Empty image")
+    return ImageAttachment(
+        mime_type=mime_type,
+        content_b64=content_b64,
+        digest=hashlib.sha256(raw).hexdigest(),
+    )
+
 
+class NoAvailableCookieError(NonRetryableError):
+    """类别中没有可用的cookie, 重试前不会有新的cookie加入, 不再重试"""
 
-async def select_cookie_client(model: str):
+
+@traced("select_cookie_client")
+async def select_cookie_client(model_spec: ModelSpec):
     """
     目前还没实现， 基于负载均衡， 轮训的， 还有其他的。
     """
@@ -30,93 +160,225 @@ async def select_cookie_client(model: str):
     # logger.debug(f"cookie: {selected_cookie_info}")
     # return grok_client
     # 下面的目前有点问题
-    # 2. 负载均衡选取: async def get_random_weighted_cookie(cls, category: QueryCategory):
-    category = QueryCategory.DEFAULT
-    if "reasoner" in model.lower():
-        category = QueryCategory.REASONING
-    elif "deepresearch" in model.lower():
-        category = QueryCategory.DEEPSEARCH
+    # 2. 负载均衡选取: 在内存中的cookie池里按权重选id, 再只读出这一个cookie
+    with span("cookie.query", category=model_spec.category.value):
+        cookie_ref = None
+        # 选中的cookie可能在上次重新加载后被删除或隔离, fetch会把它移出池, 再选一次
+        for _ in range(2):
+            cookie_id = cookie_pool.choose(model_spec.category, cookie_health.weight_factors())
+            if cookie_id is None:
+                break
+            cookie_ref = await cookie_pool.fetch(cookie_id)
+            if cookie_ref is not None:
+                break
+    if cookie_ref is None:
+        raise NoAvailableCookieError(
+            f"No available cookie for category {model_spec.category.value}"
+        )
+    with span("session.acquire"):
+        grok_client = grok_client_pool.get(cookie_ref.cookie)
 
-    cookie_ref = await CookieQueries.get_random_weighted_cookie(category)
-    grok_client = GrokClient(cookie_ref.cookie)
+    return cookie_ref, grok_client
 
-    return grok_client
 
+async def upload_attachments(
+    grok_client: GrokClient, images: list[ImageAttachment]
+) -> list[str]:
+    """上传图片并返回fileMetadataId, 同一账号下相同内容的图片只上传一次"""
 
-@async_retry(retries=4, delay=3)
-async def grok_chat(model: str, prompt: str):
+    async def upload(image: ImageAttachment) -> str:
+        file_id = attachment_cache.get(grok_client.account_key, image.digest)
+        if file_id is None:
+            file_id = await grok_client.upload_file(
+                image.file_name, image.mime_type, image.content_b64
+            )
+            attachment_cache.put(grok_client.account_key, image.digest, file_id)
+        return file_id
+
+    # 同一请求中重复的图片只上传一次
+    unique_images = list({image.digest: image for image in images}.values())
+    with span("upload_attachments", count=len(unique_images)):
+        file_ids = await asyncio.gather(*[upload(image) for image in unique_images])
+    return list(file_ids)
+
+
+def is_usable_first_chunk(item) -> bool:
+    """对冲时判断首行是否可用: 上游错误或Cloudflare挑战页让位给另一个请求"""
+    chunk, chunk_json = item
+    return not chunk_json.get("error") and "Just a moment" not in chunk
+
+
+@async_retry(
+    retries=lambda: runtime_settings.current.chat_retries,
+    delay=lambda: runtime_settings.current.chat_retry_delay_seconds,
+)
+async def grok_chat(
+    model_spec: ModelSpec,
+    prompt: str,
+    reasoning_format: str | None = None,
+    images: list[ImageAttachment] = (),
+    image_base_url: str = "",
+    usage: UsageRecord | None = None,
+    binding: ConversationBinding | None = None,
+):
+    """binding不为空时(多轮会话)优先使用它固定的cookie, 能续接时只把新消息发到上游的同一个对话"""
+    if usage is not None and usage.cookie_id is not None:
+        # 上一次尝试失败后重试, 计入上一次使用的cookie
+        usage.fail_attempt()
+    if binding is not None:
+        binding.begin_attempt()
     prompt = prompt.replace("""system: 上面是之前的历史记录,对于下面的问题，不管多简单，多复杂，都需要详细思考后给出答案。下面是你的回复格式:     <think>     # put your thinking here     </think>""", "")
-    logger.info(f"{{'model': '{model}', 'prompt': '{prompt}'}}")
-    grok_client = await select_cookie_client(model)
-    reasoning = "reasoner" in model.lower()
-    deepresearch = (
-        "deepresearch" in model.lower()
-    )  # give me a deep survey about the video generation type model
-    response_text = ""
-    # if "deepresearch" in model.lower():
-    model = "grok-3"
-    if reasoning:
-        response_text += "<think>\n"
-        # yield ""
-        yield "\n>"
-        yield "<think>"
-    current_message_id = None
-
-    is_thinking = None  # Track current thinking state
-    step_id = 1
-    async for (chunk, chunk_json) in grok_client.chat(
-        prompt, model, reasoning, deepresearch
-    ):
-        response_text += chunk
+    logger.info(f"{{'model': '{model_spec.name}', 'prompt': '{prompt}'}}")
+    model = model_spec.upstream_model
+    timeouts = runtime_settings.current.stream_timeouts_for(model_spec.category)
+
+    # 发出续接请求的cookie, 对冲请求总是新建对话
+    continued_cookie_id = None
+
+    async def open_pinned_chat():
+        """会话固定的cookie还可用时在它上面发起对话, 能续接时继续上游的同一个对话"""
+        nonlocal continued_cookie_id
+        cookie_id = binding.cookie_id
+        if cookie_id is None or cookie_pool.weight(cookie_id, model_spec.category) <= 0:
+            # 额度用完、被隔离或删除, 换一个cookie并新建对话
+            return None
+        cookie_ref = await cookie_pool.fetch(cookie_id)
+        if cookie_ref is None:
+            return None
+        grok_client = grok_client_pool.get(cookie_ref.cookie)
+        continuation = {}
+        chat_prompt, chat_images = prompt, images
+        if binding.can_continue:
+            continued_cookie_id = cookie_id
+            continuation = {
+                "conversation_id": binding.conversation_id,
+                "parent_response_id": binding.response_id,
+            }
+            chat_prompt, chat_images = binding.follow_up_prompt, binding.follow_up_images
+        file_attachments = (
+            await upload_attachments(grok_client, chat_images) if chat_images else []
+        )
+        return cookie_ref, grok_client.chat(
+            chat_prompt,
+            model,
+            model_spec.reasoning,
+            model_spec.deepsearch,
+            payload_overrides=model_spec.payload_overrides,
+            file_attachments=file_attachments,
+            timeouts=timeouts,
+            **continuation,
+        )
+
+    async def open_chat(primary_cookie=None):
+        """选cookie、上传附件并发起对话; 对冲时换一个和主请求不同的cookie"""
+        if primary_cookie is None and binding is not None:
+            pinned = await open_pinned_chat()
+            if pinned is not None:
+                return pinned
+        for _ in range(HEDGE_SELECT_ATTEMPTS if primary_cookie is not None else 1):
+            cookie_ref, grok_client = await select_cookie_client(model_spec)
+            if primary_cookie is None or cookie_ref.id != primary_cookie.id:
+                break
+        else:
+            return None
+        file_attachments = await upload_attachments(grok_client, images) if images else []
+        return cookie_ref, grok_client.chat(
+            prompt,
+            model,
+            model_spec.reasoning,
+            model_spec.deepsearch,
+            payload_overrides=model_spec.payload_overrides,
+            file_attachments=file_attachments,
+            timeouts=timeouts,
+        )
+
+    async def on_rejected(cookie_ref, item):
+        chunk, chunk_json = item
+        event = GrokResponseEvent.from_chunk(chunk, chunk_json)
+        if event.is_rate_limited:
+            await window_recovery_scheduler.mark_exhausted(cookie_ref.id, model_spec.category)
+        if event.timeout_phase is not None:
+            cookie_health.record_timeout(cookie_ref.id, event.timeout_phase)
+
+    primary = await open_chat()
+    renderer = create_stream_renderer(
+        reasoning_format or model_spec.reasoning_format,
+        reasoning=model_spec.reasoning,
+        deepsearch=model_spec.deepsearch,
+    )
+    response_parts = []
+    for rendered in renderer.start():
+        yield rendered
+
+    cookie_ref, upstream = await chat_hedger.hedge(
+        model_spec.name,
+        primary,
+        open_chat,
+        accept=is_usable_first_chunk,
+        on_reject=on_rejected,
+    )
+    if usage is not None:
+        usage.use_cookie(cookie_ref.id)
+    continued = cookie_ref.id == continued_cookie_id
+    if binding is not None:
+        binding.bind(cookie_ref.id, continued)
+    first_event = True
+    async for (chunk, chunk_json) in upstream:
+        response_parts.append(chunk)
+        if usage is not None:
+            usage.first_token()
 
         if "Just a moment" in chunk:
             raise RuntimeError("CF error, retryiing....")
-        if "messageStepId" in str(chunk_json):
-            new_message_id = chunk_json["result"]["response"]["messageStepId"]
-
-            if new_message_id != current_message_id and chunk:
-                chunk = "\n---\n" + f"> `Step{step_id}`"
-                step_id += 1
-
-            current_message_id = new_message_id
-
-        # Check if thinking state changed: reasoning case
-        if "isThinking" in str(chunk_json):
-            new_thinking_state = chunk_json["result"]["response"]["isThinking"]
-            if new_thinking_state and chunk == "\n":
-                chunk = "\n>"
-            # logger.debug(f"isThinking: {new_thinking_state}\n new_thinking_state: {new_thinking_state}")
-            # if new_thinking_state and chunk.endswith("\n"):
-            #     chunk = chunk[:-1] + "\n>"
-            # If we're transitioning from thinking to not thinking, close the think tag
-            if (is_thinking) and (new_thinking_state == False) and reasoning:
-                yield "</think>"
-                yield "\n\n"
-                # Update thinking state
-            is_thinking = new_thinking_state
-
-        if deepresearch:
-            if chunk.endswith("\n"):
-                chunk = chunk[:-1] + "\n>"
-
-            if "action_input" in chunk:
-                action_json = json.loads(chunk)
-                action = action_json["action"]
-                action_params = ""
-                for k, v in action_json["action_input"].items():
-                    action_params += f"{k}: {v},"
-                chunk = f"\n  ***{action} with {action_params}***"
-
-        if "modelResponse" in str(chunk_json) and deepresearch:
-            chunk = (
-                chunk_json.get("result", {})
-                .get("response", {})
-                .get("modelResponse", {})
-                .get("message", "")
-            )
-            chunk = "\n" + chunk
 
-        yield chunk
+        transform_start = time.perf_counter()
+        event = GrokResponseEvent.from_chunk(chunk, chunk_json)
+        if binding is not None:
+            if (
+                first_event
+                and continued
+                and event.error
+                and not event.is_rate_limited
+                and event.timeout_phase is None
+            ):
+                # 上游的对话已经不存在或不能继续, 在同一个cookie上新建对话重试
+                binding.forget_conversation()
+                binding.retry_same_cookie = True
+                raise RuntimeError(f"Conversation continuation failed: {event.error}, retrying....")
+            binding.observe(event)
+        first_event = False
+        if event.is_rate_limited:
+            # 这个cookie的额度已经用完, 立即停止选中它, 窗口结束后自动恢复
+            await window_recovery_scheduler.mark_exhausted(
+                cookie_ref.id, model_spec.category
+            )
+        if usage is not None and event.error:
+            usage.outcome = (
+                UsageOutcome.ERROR if event.timeout_phase is None else UsageOutcome.TIMEOUT
+            )
+        if event.timeout_phase is not None:
+            cookie_health.record_timeout(cookie_ref.id, event.timeout_phase)
+            if event.timeout_phase in (TimeoutPhase.CONNECT, TimeoutPhase.FIRST_BYTE):
+                # 还没有任何输出, 换一个cookie重试
+                raise RuntimeError(f"Upstream {event.timeout_phase.value} timeout, retrying....")
+        if event.generated_image is not None:
+            # 只有生成完成的图片才保存, 中间进度直接忽略
+            if event.generated_image.completed:
+                image_name = await submit_task2event_loop(
+                    save_image_b64, event.generated_image.image_b64
+                )
+                for rendered in renderer.image(build_image_url(image_base_url, image_name)):
+                    yield rendered
+            continue
+
+        rendered_chunks = renderer.feed(event)
+        add_timing("transform", time.perf_counter() - transform_start)
+        for rendered in rendered_chunks:
+            yield rendered
+
+    for rendered in renderer.finish():
+        yield rendered
+    response_text = "".join(response_parts)
     logger.info(
         f"""{{
         "model": "{model}",
@@ -126,32 +388,122 @@ async def grok_chat(model: str, prompt: str):
     )
 
 
-async def extract_messages_and_images(messages: list[ChatMessage]):
-    texts = []
-    # base64_images = []
-    image_paths = []
-    roles = []
+@async_retry(
+    retries=lambda: runtime_settings.current.image_retries,
+    delay=lambda: runtime_settings.current.image_retry_delay_seconds,
+)
+async def grok_generate_images(
+    model_spec: ModelSpec, prompt: str, n: int = 1, usage: UsageRecord | None = None
+):
+    """生成图片并保存到本地, 逐个yield保存后的文件名"""
+    if usage is not None and usage.cookie_id is not None:
+        usage.fail_attempt()
+    cookie_ref, grok_client = await select_cookie_client(model_spec)
+    if usage is not None:
+        usage.use_cookie(cookie_ref.id)
+    payload_overrides = {
+        **model_spec.payload_overrides,
+        "enableImageGeneration": True,
+        "returnImageBytes": True,
+        "imageGenerationCount": n,
+    }
+    saved = set()
+    async for (chunk, chunk_json) in grok_client.chat(
+        prompt,
+        model_spec.upstream_model,
+        payload_overrides=payload_overrides,
+        timeouts=runtime_settings.current.stream_timeouts_for(model_spec.category),
+    ):
+        if "Just a moment" in chunk:
+            raise RuntimeError("CF error, retryiing....")
+        event = GrokResponseEvent.from_chunk(chunk, chunk_json)
+        if event.is_rate_limited:
+            await window_recovery_scheduler.mark_exhausted(
+                cookie_ref.id, model_spec.category
+            )
+        if event.timeout_phase is not None:
+            cookie_health.record_timeout(cookie_ref.id, event.timeout_phase)
+            if usage is not None:
+                usage.outcome = UsageOutcome.TIMEOUT
+        if event.error:
+            raise RuntimeError(f"Image generation failed: {event.error}")
+        image = event.generated_image
+        if image is None or not image.completed or image.image_id in saved:
+            continue
+        saved.add(image.image_id)
+        yield await submit_task2event_loop(save_image_b64, image.image_b64)
+        if len(saved) >= n:
+            return
+
+
+def decode_file_data(file_data: str) -> tuple[str, bytes]:
+    """解析openai file类型消息中的 data:<mime>;base64,... , 返回(mime, 内容)"""
+    match = DATA_URL_PATTERN.match(file_data)
+    if not match:
+        raise ValueError("file_data should be a base64 data url")
+    try:
+        raw = base64.b64decode("".join(file_data[match.end():].split()), validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"Invalid base64 file: {e}")
+    return (match.group("mime") or "application/octet-stream").lower(), raw
+
+
+async def convert_file_part(file_part: dict) -> str:
+    """把文件消息转换成放进prompt的文本"""
+    file_name = file_part.get("filename") or "file"
+    mime_type, raw = await submit_task2event_loop(
+        decode_file_data, file_part["file_data"]
+    )
+    converted = await DocumentConverter.from_bytes(file_name, mime_type, raw).convert()
+    if converted is None:
+        raise ValueError(f"Unsupported file type: {mime_type}")
+    return f"<file name=\"{file_name}\">\n{converted.extracted_content}\n</file>"
+
+
+async def extract_messages_and_images(
+    messages: list[ChatMessage],
+) -> tuple[list[ChatMessage], list[ImageAttachment]]:
+    """把多模态消息拆成纯文本消息和图片附件, 文件消息转换成文本; base64的解码放到线程池中完成"""
+    text_messages = []
+    image_urls = []
     for message in messages:
-        role = message.role
         content = message.content
-        roles.append(role)
         if isinstance(content, str):
-            texts.append(content)
-        elif isinstance(content, list):
-            for item in content:
-                message_type = item["type"]
-                if message_type == "text":
-                    texts.append(item["text"])
-                elif message_type == "image_url":
-                    base64_image = item["image_url"]["url"]
-                    image_path = await save_base64_image(base64_image)
-                    image_paths.append(image_path)
-                else:
-                    raise ValueError("Invalid message content type")
-    messages = []
-    for text, role in zip(texts, roles):
-        messages.append(ChatMessage(role=role, content=text))
-    return messages, image_paths
+            text_messages.append(message)
+            continue
+        texts = []
+        file_parts = {}
+        for item in content:
+            message_type = item.get("type")
+            if message_type == "text":
+                texts.append(item["text"])
+            elif message_type == "image_url":
+                image_url = item["image_url"]
+                url = image_url["url"] if isinstance(image_url, dict) else image_url
+                if url.startswith(("http://", "https://")):
+                    logger.warning("Remote image urls are not supported, skipped")
+                    continue
+                image_urls.append(url)
+            elif message_type == "file":
+                # 先占位, 下面统一转换, 保持文本和文件的原始顺序
+                file_parts[len(texts)] = item["file"]
+                texts.append("")
+            else:
+                raise ValueError(f"Invalid message content type: {message_type}")
+        if file_parts:
+            converted = await asyncio.gather(
+                *[convert_file_part(file_part) for file_part in file_parts.values()]
+            )
+            for index, text in zip(file_parts, converted):
+                texts[index] = text
+        text_messages.append(ChatMessage(role=message.role, content="\n".join(texts)))
+
+    images = []
+    if image_urls:
+        images = await asyncio.gather(
+            *[submit_task2event_loop(decode_image_url, url) for url in image_urls]
+        )
+    return text_messages, list(images)
 
 
 async def summarize_a_title(
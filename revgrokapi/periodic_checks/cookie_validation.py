@@ -0,0 +1,115 @@
+"""
+revgrokapi/periodic_checks/cookie_validation.py
+
+Import-time validation of new cookies and the low-frequency recheck of
+quarantined ones. Cookies added through the cookie router are probed right
+away, bounded by the `rate_limit_probe_concurrency` runtime setting, so they
+enter the pool with real weights instead of waiting for the next sweep; a
+401/403 answer counts towards quarantine exactly like one seen in a sweep.
+Quarantined cookies keep weight 0, are skipped by sweeps and window recovery,
+and are probed again every COOKIE_QUARANTINE_RECHECK_HOURS; the first
+successful probe reactivates them.
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from revgrokapi.configs import COOKIE_QUARANTINE_THRESHOLD
+from revgrokapi.models import Cookie
+from revgrokapi.models.cookie_models import CookieRecord, CookieStatus
+from revgrokapi.periodic_checks.rate_limit_probe import (SWEEP_WRITE_BATCH_SIZE,
+                                                         rate_limit_prober)
+from revgrokapi.pool import cookie_pool
+
+
+class CookieValidator:
+    def __init__(self):
+        self.validated = 0
+        self.invalid = 0
+        self.quarantined = 0
+        self.reactivated = 0
+        self.last_recheck_at: Optional[float] = None
+        # 定时复查和手动触发的复查不同时进行
+        self._recheck_lock = asyncio.Lock()
+
+    async def validate(self, cookies: List[CookieRecord]) -> Dict:
+        """探测新导入的cookie, 写入初始权重并记录有效性"""
+        if not cookies:
+            return {"total": 0, "valid": 0, "invalid": 0, "unknown": 0, "quarantined": []}
+        validity = await rate_limit_prober.probe_cookies(cookies, force=True)
+        known = {cookie_id: valid for cookie_id, valid in validity.items() if valid is not None}
+        quarantined = await rate_limit_prober.record_validity(known)
+        invalid = sum(1 for valid in known.values() if not valid)
+        self.validated += len(cookies)
+        self.invalid += invalid
+        self.quarantined += len(quarantined)
+        return {
+            "total": len(cookies),
+            "valid": len(known) - invalid,
+            "invalid": invalid,
+            "unknown": len(validity) - len(known),
+            "quarantined": quarantined,
+        }
+
+    async def recheck(self, cookies: List[CookieRecord]) -> Dict:
+        """复查隔离的cookie, 探测成功的解除隔离; 仍然失效的累加失效次数"""
+        validity = await rate_limit_prober.probe_cookies(cookies, force=True)
+        valid_ids = [cookie_id for cookie_id, valid in validity.items() if valid]
+        invalid_ids = [cookie_id for cookie_id, valid in validity.items() if valid is False]
+        await Cookie.record_validity([], invalid_ids, COOKIE_QUARANTINE_THRESHOLD)
+        await Cookie.reactivate(valid_ids)
+        # 隔离期间不在池中, 探测写入的权重需要重新读入
+        await cookie_pool.sync(valid_ids)
+        self.reactivated += len(valid_ids)
+        if valid_ids:
+            logger.info(f"Reactivated {len(valid_ids)} quarantined cookies: {valid_ids}")
+        return {
+            "total": len(cookies),
+            "reactivated": valid_ids,
+            "invalid": len(invalid_ids),
+            "unknown": len(cookies) - len(valid_ids) - len(invalid_ids),
+        }
+
+    async def recheck_quarantined(self) -> Dict:
+        """按id分批复查所有隔离的cookie"""
+        async with self._recheck_lock:
+            start_time = time.perf_counter()
+            summary = {"total": 0, "reactivated": [], "invalid": 0, "unknown": 0}
+            last_id = 0
+            while True:
+                cookies = await Cookie.get_records(
+                    status=CookieStatus.QUARANTINED,
+                    id__gt=last_id,
+                    limit=SWEEP_WRITE_BATCH_SIZE,
+                )
+                if not cookies:
+                    break
+                last_id = cookies[-1].id
+                result = await self.recheck(cookies)
+                summary["total"] += result["total"]
+                summary["reactivated"] += result["reactivated"]
+                summary["invalid"] += result["invalid"]
+                summary["unknown"] += result["unknown"]
+            self.last_recheck_at = time.time()
+            logger.info(
+                f"Quarantine recheck: {summary['total']} cookies, "
+                f"{len(summary['reactivated'])} reactivated "
+                f"in {time.perf_counter() - start_time:.2f} seconds"
+            )
+            return summary
+
+    async def stats(self) -> Dict:
+        return {
+            "quarantined_now": await Cookie.filter(status=CookieStatus.QUARANTINED).count(),
+            "threshold": COOKIE_QUARANTINE_THRESHOLD,
+            "validated": self.validated,
+            "invalid": self.invalid,
+            "quarantined": self.quarantined,
+            "reactivated": self.reactivated,
+            "last_recheck_at": self.last_recheck_at,
+        }
+
+
+cookie_validator = CookieValidator()
@@ -3,21 +3,79 @@ from datetime import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
-from revgrokapi.configs import GROK_CLIENT_LIMIT_CHECKS_INTERVAL_MINUTES
+from loguru import logger
+
+from revgrokapi.configs import (API_KEY_USAGE_FLUSH_INTERVAL_SECONDS,
+                                COOKIE_POOL_RELOAD_SECONDS,
+                                COOKIE_QUARANTINE_RECHECK_HOURS,
+                                USAGE_FLUSH_INTERVAL_SECONDS)
 from revgrokapi.periodic_checks.clients_limit_checks import \
     check_grok_clients_limits
+from revgrokapi.periodic_checks.cookie_validation import cookie_validator
+from revgrokapi.pool import cookie_pool
+from revgrokapi.quota import api_key_manager, usage_accounting
+from revgrokapi.runtime_settings import RuntimeSettings, runtime_settings
 
 limit_check_scheduler = AsyncIOScheduler()
 
 # 设置定时任务
+limit_check_interval = runtime_settings.current.limit_check_interval_minutes
 limit_check_scheduler.add_job(
     check_grok_clients_limits,
-    trigger=IntervalTrigger(minutes=GROK_CLIENT_LIMIT_CHECKS_INTERVAL_MINUTES),
+    trigger=IntervalTrigger(minutes=limit_check_interval),
     id="check_usage_limits",
-    name=f"Check API usage limits every {GROK_CLIENT_LIMIT_CHECKS_INTERVAL_MINUTES} minutes",
+    name=f"Check API usage limits every {limit_check_interval} minutes",
+    replace_existing=True,
+)
+
+limit_check_scheduler.add_job(
+    api_key_manager.flush,
+    trigger=IntervalTrigger(seconds=API_KEY_USAGE_FLUSH_INTERVAL_SECONDS),
+    id="flush_api_key_usage",
+    name=f"Flush api key usage every {API_KEY_USAGE_FLUSH_INTERVAL_SECONDS} seconds",
     replace_existing=True,
 )
 
+limit_check_scheduler.add_job(
+    usage_accounting.flush,
+    trigger=IntervalTrigger(seconds=USAGE_FLUSH_INTERVAL_SECONDS),
+    id="flush_usage_accounting",
+    name=f"Flush hourly usage every {USAGE_FLUSH_INTERVAL_SECONDS} seconds",
+    replace_existing=True,
+)
+
+limit_check_scheduler.add_job(
+    cookie_pool.load,
+    trigger=IntervalTrigger(seconds=COOKIE_POOL_RELOAD_SECONDS),
+    id="reload_cookie_pool",
+    name=f"Reload cookie pool every {COOKIE_POOL_RELOAD_SECONDS} seconds",
+    replace_existing=True,
+)
+
+limit_check_scheduler.add_job(
+    cookie_validator.recheck_quarantined,
+    trigger=IntervalTrigger(hours=COOKIE_QUARANTINE_RECHECK_HOURS),
+    id="recheck_quarantined_cookies",
+    name=f"Recheck quarantined cookies every {COOKIE_QUARANTINE_RECHECK_HOURS} hours",
+    replace_existing=True,
+)
+
+
+def on_settings_changed(old: RuntimeSettings, new: RuntimeSettings):
+    """刷新间隔修改后重新安排任务, 下一次执行从现在开始计算"""
+    if old.limit_check_interval_minutes == new.limit_check_interval_minutes:
+        return
+    limit_check_scheduler.reschedule_job(
+        "check_usage_limits",
+        trigger=IntervalTrigger(minutes=new.limit_check_interval_minutes),
+    )
+    logger.info(
+        f"Limit check interval changed to {new.limit_check_interval_minutes} minutes"
+    )
+
+
+runtime_settings.add_listener(on_settings_changed)
+
 
 class LimitScheduler:
     limit_check_scheduler = limit_check_scheduler
@@ -0,0 +1,353 @@
+"""
+revgrokapi/periodic_checks/rate_limit_probe.py
+
+Probes the remaining queries of every cookie and writes them back as selection
+weights. Upstream has no endpoint returning all request kinds at once, so the
+saving comes from doing less: one pooled session per cookie, results cached for
+the `rate_limit_probe_ttl_seconds` runtime setting, and exhausted categories
+skipped until their window (windowSizeSeconds) has elapsed. Results of a
+refresh are written in batches, one transaction per SWEEP_WRITE_BATCH_SIZE
+cookies, and only rows that changed are touched. Refreshes run as background
+jobs whose progress can be polled. Probes answered with 401/403 count towards
+quarantining the cookie; quarantined cookies are left out of refreshes and
+rechecked by revgrokapi/periodic_checks/cookie_validation.py.
+"""
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+from loguru import logger
+
+from revgrokapi.configs import COOKIE_QUARANTINE_THRESHOLD
+from revgrokapi.models import Cookie
+from revgrokapi.models.cookie_models import (CookieQueries, CookieRecord,
+                                             CookieStatus, QueryCategory,
+                                             WeightChanges)
+from revgrokapi.openai_api.model_registry import model_registry
+from revgrokapi.pool import cookie_pool
+from revgrokapi.revgrok import grok_client_pool
+from revgrokapi.runtime_settings import runtime_settings
+
+# 保留最近多少个刷新任务的状态
+MAX_REFRESH_JOBS = 20
+# 刷新时每攒够这么多个cookie的探测结果写一次数据库
+SWEEP_WRITE_BATCH_SIZE = 200
+# 探测返回这些状态码说明cookie本身失效(过期/被封), 而不是额度用完或网络问题
+INVALID_COOKIE_STATUS_CODES = frozenset({401, 403})
+
+
+@dataclass(slots=True)
+class ProbeResult:
+    remaining_queries: int
+    window_size_seconds: int
+    probed_at: float
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+
+    @classmethod
+    def from_response(cls, data: Dict, probed_at: float) -> "ProbeResult":
+        return cls(
+            remaining_queries=data.get("remainingQueries", 0),
+            window_size_seconds=data.get("windowSizeSeconds", 0),
+            probed_at=probed_at,
+            status_code=data.get("statusCode"),
+            error=data.get("error"),
+        )
+
+    def reusable(self, now: float, ttl: float) -> bool:
+        """出错的结果不缓存; 额度用完时窗口结束前不会恢复, 不需要再探测"""
+        if self.error:
+            return False
+        if now - self.probed_at < ttl:
+            return True
+        return (
+            self.remaining_queries <= 0
+            and self.window_size_seconds > 0
+            and now < self.probed_at + self.window_size_seconds
+        )
+
+
+@dataclass
+class RefreshJob:
+    job_id: str
+    force: bool = False
+    status: str = "pending"  # pending / running / done / failed
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+    probed_categories: int = 0
+    skipped_categories: int = 0
+    # 权重有变化的(cookie, 类别)数和实际写入的记录数
+    changed_weights: int = 0
+    written_rows: int = 0
+    # 探测为失效的cookie数, 其中本次被隔离的数量
+    invalid: int = 0
+    quarantined: int = 0
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def category_models() -> Dict[str, str]:
+    """探测时每个类别使用的上游模型名, 取注册表中该类别的第一个模型"""
+    models = {}
+    for spec in model_registry.specs():
+        models.setdefault(spec.category.value, spec.upstream_model)
+    for category in QueryCategory:
+        models.setdefault(category.value, "grok-3")
+    return models
+
+
+def probe_validity(rate_limits: Dict[str, Dict]) -> Optional[bool]:
+    """根据一次探测的原始结果判断cookie是否有效; 没有探测或只有网络/cf错误时无法判断, 返回None"""
+    if not rate_limits:
+        return None
+    if any(not data.get("error") for data in rate_limits.values()):
+        return True
+    if any(data.get("statusCode") in INVALID_COOKIE_STATUS_CODES for data in rate_limits.values()):
+        return False
+    return None
+
+
+class RateLimitProber:
+    def __init__(self):
+        self._results: Dict[int, Dict[str, ProbeResult]] = {}
+        self._jobs: "OrderedDict[str, RefreshJob]" = OrderedDict()
+        self._running_job: Optional[RefreshJob] = None
+        self._running_task: Optional[asyncio.Task] = None
+        # 每次探测后回调 listener(cookie_id, {类别: exhausted_at}, {类别: window_size})
+        self._probe_listeners: List[Callable] = []
+
+    @property
+    def ttl(self) -> float:
+        return runtime_settings.current.rate_limit_probe_ttl_seconds
+
+    def cached_results(self, cookie_id: int) -> Dict[str, ProbeResult]:
+        return dict(self._results.get(cookie_id, {}))
+
+    def forget(self, cookie_id: int):
+        self._results.pop(cookie_id, None)
+
+    def add_probe_listener(self, listener: Callable):
+        if listener not in self._probe_listeners:
+            self._probe_listeners.append(listener)
+
+    def record_exhausted(self, cookie_id: int, kind: str, window_size_seconds: int):
+        """对话中发现额度用完时同步缓存, 避免刷新时沿用旧的剩余额度"""
+        self._results.setdefault(cookie_id, {})[kind] = ProbeResult(
+            remaining_queries=0,
+            window_size_seconds=window_size_seconds,
+            probed_at=time.time(),
+        )
+
+    async def _probe(
+        self,
+        cookie: CookieRecord,
+        force: bool = False,
+        categories: Optional[Iterable[str]] = None,
+    ) -> tuple[Dict[str, ProbeResult], int, Dict[str, Dict]]:
+        """只探测不写库, 返回(全部类别的结果, 实际探测的类别数, 本次探测的原始结果)"""
+        now = time.time()
+        cached = self._results.setdefault(cookie.id, {})
+        models = category_models()
+        if categories is not None:
+            models = {kind: models[kind] for kind in categories if kind in models}
+        to_probe = {
+            kind: model_name
+            for kind, model_name in models.items()
+            if force or kind not in cached or not cached[kind].reusable(now, self.ttl)
+        }
+        rate_limits = {}
+        if to_probe:
+            grok_client = grok_client_pool.get(cookie.cookie)
+            rate_limits = await grok_client.get_rate_limit(to_probe)
+            probed_at = time.time()
+            for kind, data in rate_limits.items():
+                cached[kind] = ProbeResult.from_response(data, probed_at)
+        return dict(cached), len(to_probe), rate_limits
+
+    async def _write(self, rate_limits: Dict[int, Dict[str, Dict]]) -> WeightChanges:
+        """把一批探测结果一次写入数据库, 再通知监听者"""
+        changes = await CookieQueries.bulk_update_rate_limits(rate_limits)
+        cookie_pool.apply_weight_changes(changes)
+        for cookie_id, exhausted in changes.exhausted.items():
+            cached = self._results.get(cookie_id, {})
+            window_sizes = {
+                kind: cached[kind].window_size_seconds for kind in exhausted if kind in cached
+            }
+            for listener in self._probe_listeners:
+                listener(cookie_id, exhausted, window_sizes)
+        return changes
+
+    async def record_validity(self, validity: Dict[int, bool]) -> List[int]:
+        """记录一批cookie的有效性, 返回新隔离的cookie id"""
+        valid_ids = [cookie_id for cookie_id, valid in validity.items() if valid]
+        invalid_ids = [cookie_id for cookie_id, valid in validity.items() if not valid]
+        if not valid_ids and not invalid_ids:
+            return []
+        quarantined = await Cookie.record_validity(
+            valid_ids, invalid_ids, COOKIE_QUARANTINE_THRESHOLD
+        )
+        cookie_pool.remove(quarantined)
+        for cookie_id in quarantined:
+            # 权重已经置0, 缓存的剩余额度不能再被沿用
+            self.forget(cookie_id)
+        if quarantined:
+            logger.warning(f"Quarantined {len(quarantined)} invalid cookies: {quarantined}")
+        return quarantined
+
+    async def probe_cookie(
+        self,
+        cookie: CookieRecord,
+        force: bool = False,
+        categories: Optional[Iterable[str]] = None,
+    ) -> tuple[Dict[str, ProbeResult], int]:
+        """探测一个cookie需要探测的类别并更新权重, 返回(全部类别的结果, 实际探测的类别数)"""
+        results, probed, rate_limits = await self._probe(cookie, force, categories)
+        if rate_limits:
+            await self._write({cookie.id: rate_limits})
+        return results, probed
+
+    async def probe_cookies(
+        self, cookies: List[CookieRecord], force: bool = True
+    ) -> Dict[int, Optional[bool]]:
+        """并发(rate_limit_probe_concurrency)探测一批cookie并按批写入权重, 返回 {cookie_id: 是否有效}"""
+        semaphore = asyncio.Semaphore(runtime_settings.current.rate_limit_probe_concurrency)
+        rate_limits: Dict[int, Dict[str, Dict]] = {}
+        validity: Dict[int, Optional[bool]] = {}
+
+        async def probe(cookie: CookieRecord):
+            async with semaphore:
+                try:
+                    _, _, data = await self._probe(cookie, force)
+                except Exception as e:
+                    logger.error(f"Error probing cookie {cookie.id}: {e}")
+                    validity[cookie.id] = None
+                    return
+            if data:
+                rate_limits[cookie.id] = data
+            validity[cookie.id] = probe_validity(data)
+
+        await asyncio.gather(*[probe(cookie) for cookie in cookies])
+        cookie_ids = list(rate_limits)
+        for start in range(0, len(cookie_ids), SWEEP_WRITE_BATCH_SIZE):
+            await self._write(
+                {
+                    cookie_id: rate_limits[cookie_id]
+                    for cookie_id in cookie_ids[start : start + SWEEP_WRITE_BATCH_SIZE]
+                }
+            )
+        return validity
+
+    async def refresh_all(self, job: RefreshJob):
+        job.status = "running"
+        start_time = time.perf_counter()
+        try:
+            # get_multi默认只取100条; 隔离的cookie由cookie_validation低频复查
+            all_cookies = await Cookie.get_records(status=CookieStatus.ACTIVE)
+            job.total = len(all_cookies)
+            logger.info(f"Found {len(all_cookies)} cookies to check")
+            # 每次刷新开始时读取, 修改后从下一次刷新生效
+            semaphore = asyncio.Semaphore(
+                runtime_settings.current.rate_limit_probe_concurrency
+            )
+            category_count = len(QueryCategory)
+            # 探测结果先攒起来, 每满一批在一个事务中写入, 而不是每个cookie写一次
+            pending: Dict[int, Dict[str, Dict]] = {}
+            # {cookie_id: 是否有效}, 和权重一起按批写入
+            pending_validity: Dict[int, bool] = {}
+
+            async def flush():
+                nonlocal pending, pending_validity
+                if not pending and not pending_validity:
+                    return
+                batch, pending = pending, {}
+                validity, pending_validity = pending_validity, {}
+                try:
+                    if batch:
+                        changes = await self._write(batch)
+                        job.changed_weights += changes.changed_count
+                        job.written_rows += changes.written
+                    # 先写权重再隔离, 隔离时置0的权重不会被这一批覆盖
+                    job.quarantined += len(await self.record_validity(validity))
+                except Exception as e:
+                    job.failed += len(batch)
+                    logger.error(f"Failed to write rate limits of {len(batch)} cookies: {e}")
+
+            async def check_cookie(cookie: CookieRecord):
+                async with semaphore:
+                    try:
+                        results, probed, rate_limits = await self._probe(cookie, job.force)
+                        job.probed_categories += probed
+                        job.skipped_categories += category_count - probed
+                        if rate_limits:
+                            pending[cookie.id] = rate_limits
+                        valid = probe_validity(rate_limits)
+                        if valid is not None:
+                            pending_validity[cookie.id] = valid
+                        if valid is False:
+                            job.invalid += 1
+                        logger.info(
+                            f"Cookie {cookie.id}: "
+                            f"{ {kind: r.remaining_queries for kind, r in results.items()} }"
+                        )
+                    except Exception:
+                        from traceback import format_exc
+
+                        job.failed += 1
+                        logger.error(
+                            f"Error checking rate limit for cookie {cookie.id}: {format_exc()}"
+                        )
+                    finally:
+                        job.completed += 1
+                if max(len(pending), len(pending_validity)) >= SWEEP_WRITE_BATCH_SIZE:
+                    await flush()
+
+            await asyncio.gather(*[check_cookie(cookie) for cookie in all_cookies])
+            await flush()
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Rate limit refresh failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            logger.debug(f"Time elapsed: {time.perf_counter() - start_time:.2f} seconds")
+
+    def start_refresh(self, force: bool = False) -> RefreshJob:
+        """在后台开始刷新, 已有刷新在进行时直接返回它"""
+        if self._running_job is not None and self._running_job.finished_at is None:
+            return self._running_job
+        job = RefreshJob(job_id=uuid.uuid4().hex, force=force)
+        self._jobs[job.job_id] = job
+        while len(self._jobs) > MAX_REFRESH_JOBS:
+            self._jobs.popitem(last=False)
+        self._running_job = job
+        self._running_task = asyncio.create_task(self.refresh_all(job))
+        return job
+
+    async def shutdown(self, timeout: float):
+        """等待进行中的刷新写完权重, 超时后取消"""
+        task = self._running_task
+        if task is None or task.done():
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Rate limit refresh still running at shutdown, cancelled")
+            task.cancel()
+
+    def get_job(self, job_id: str) -> Optional[RefreshJob]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> List[RefreshJob]:
+        return list(self._jobs.values())
+
+
+rate_limit_prober = RateLimitProber()
@@ -0,0 +1,160 @@
+"""
+revgrokapi/periodic_checks/window_recovery.py
+
+Restores exhausted cookies as soon as their rate-limit window can have reset,
+instead of leaving them at weight 0 until the next full sweep. Every exhausted
+(cookie, category) gets a deadline `exhausted_at + window_size_seconds` in a
+min-heap; a single task sleeps until the earliest deadline and re-probes just
+that category.
+"""
+import asyncio
+import heapq
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from revgrokapi.configs import (WINDOW_RECOVERY_FALLBACK_SECONDS,
+                                WINDOW_RECOVERY_RETRY_SECONDS)
+from revgrokapi.models import Cookie
+from revgrokapi.models.cookie_models import (CookieQueries, CookieStatus,
+                                             QueryCategory)
+from revgrokapi.periodic_checks.rate_limit_probe import rate_limit_prober
+from revgrokapi.pool import cookie_pool
+
+Key = Tuple[int, str]
+
+
+def recovery_deadline(exhausted_at: datetime, window_size_seconds: int) -> float:
+    window = window_size_seconds or WINDOW_RECOVERY_FALLBACK_SECONDS
+    return exhausted_at.timestamp() + window
+
+
+class WindowRecoveryScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []
+        # 每个(cookie, 类别)当前有效的截止时间, 堆中与之不一致的条目已过期
+        self._deadlines: Dict[Key, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.recovered = 0
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, cookie_id: int, category: str, deadline: float):
+        key = (cookie_id, category)
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, cookie_id, category))
+        # 新的截止时间比当前等待的更早时唤醒调度任务
+        if self._heap[0][0] == deadline:
+            self._wakeup.set()
+
+    def cancel(self, cookie_id: int, category: str):
+        self._deadlines.pop((cookie_id, category), None)
+
+    def pending(self) -> List[Dict]:
+        return [
+            {"cookie_id": cookie_id, "category": category, "deadline": deadline}
+            for (cookie_id, category), deadline in sorted(
+                self._deadlines.items(), key=lambda item: item[1]
+            )
+        ]
+
+    async def load(self):
+        """启动时从数据库恢复所有额度用完的记录"""
+        records = await CookieQueries.filter(exhausted_at__isnull=False)
+        for record in records:
+            self.schedule(
+                record.cookie_ref_id,
+                record.category.value,
+                recovery_deadline(record.exhausted_at, record.window_size_seconds),
+            )
+        logger.info(f"Window recovery: {len(records)} exhausted cookie categories loaded")
+
+    async def mark_exhausted(self, cookie_id: int, category: QueryCategory):
+        """对话中遇到额度用完: 权重立即置0, 窗口结束时再恢复"""
+        record = await CookieQueries.mark_exhausted(cookie_id, category)
+        if record is None:
+            return
+        cookie_pool.set_weight(cookie_id, category, 0)
+        rate_limit_prober.record_exhausted(
+            cookie_id, category.value, record.window_size_seconds
+        )
+        self.schedule(
+            cookie_id,
+            category.value,
+            recovery_deadline(record.exhausted_at, record.window_size_seconds),
+        )
+
+    def on_probe(self, cookie_id: int, exhausted: Dict[str, Optional[datetime]], window_sizes: Dict[str, int]):
+        """探测结果的回调: 用完的类别安排恢复, 已恢复的取消"""
+        # 窗口已过仍未恢复时, 至少间隔RETRY秒再探测, 避免反复探测
+        earliest = time.time() + WINDOW_RECOVERY_RETRY_SECONDS
+        for category, exhausted_at in exhausted.items():
+            if exhausted_at is None:
+                self.cancel(cookie_id, category)
+            else:
+                deadline = recovery_deadline(exhausted_at, window_sizes.get(category, 0))
+                self.schedule(cookie_id, category, max(deadline, earliest))
+
+    async def _recover(self, cookie_id: int, category: str):
+        cookie = await Cookie.get_by_id(cookie_id)
+        # 隔离的cookie由cookie_validation复查, 恢复后由刷新重新安排
+        if cookie is None or cookie.status == CookieStatus.QUARANTINED:
+            return
+        results, _ = await rate_limit_prober.probe_cookie(
+            cookie, force=True, categories=[category]
+        )
+        result = results.get(category)
+        if result is not None and result.error:
+            # 探测失败(网络/cf等), 稍后重试
+            self.schedule(cookie_id, category, time.time() + WINDOW_RECOVERY_RETRY_SECONDS)
+        elif result is not None and result.remaining_queries > 0:
+            self.recovered += 1
+            logger.info(
+                f"Window recovery: cookie {cookie_id} {category} restored "
+                f"with {result.remaining_queries} queries"
+            )
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, cookie_id, category = heapq.heappop(self._heap)
+                if self._deadlines.get((cookie_id, category)) == deadline:
+                    del self._deadlines[(cookie_id, category)]
+                    due.append((cookie_id, category))
+            for cookie_id, category in due:
+                try:
+                    await self._recover(cookie_id, category)
+                except Exception as e:
+                    logger.error(
+                        f"Window recovery failed for cookie {cookie_id} {category}: {e}"
+                    )
+                    self.schedule(
+                        cookie_id, category, time.time() + WINDOW_RECOVERY_RETRY_SECONDS
+                    )
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        await self.load()
+        rate_limit_prober.add_probe_listener(self.on_probe)
+        self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+window_recovery_scheduler = WindowRecoveryScheduler()
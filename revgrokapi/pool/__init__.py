@@ -0,0 +1,6 @@
+from .cookie_pool import CookiePool, cookie_pool
+
+__all__ = [
+    "CookiePool",
+    "cookie_pool",
+]
@@ -0,0 +1,232 @@
+"""
+revgrokapi/pool/cookie_pool.py
+
+Compact in-memory view of the cookie pool used to pick a cookie per request.
+Instead of one Tortoise model instance per cookie (datetimes, the multi-KB
+cookie string and the related-object machinery) the pool keeps parallel
+`array`s: the sorted ids of the active cookies and, per category, their
+weights, 8 + 4 * categories bytes per cookie. Cookie strings are not held;
+the chosen cookie is read by id as a `CookieRecord`. Weight writes made by
+this process are applied as they happen, and a reload every
+COOKIE_POOL_RELOAD_SECONDS picks up the writes of other workers. Quarantined
+cookies are not part of the pool.
+"""
+import asyncio
+import random
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Set
+
+from loguru import logger
+
+from revgrokapi.models.cookie_models import (Cookie, CookieQueries,
+                                             CookieRecord, CookieStatus,
+                                             QueryCategory, WeightChanges)
+
+# 加载时每批读取的cookie数
+POOL_LOAD_BATCH_SIZE = 5000
+# id和权重数组的类型: int64 / int32
+ID_TYPECODE = "q"
+WEIGHT_TYPECODE = "i"
+
+
+def _category_value(category) -> str:
+    return category.value if isinstance(category, QueryCategory) else category
+
+
+class CookiePool:
+    def __init__(self):
+        # 升序的cookie id, 各类别的权重数组和它按下标对齐
+        self._ids = array(ID_TYPECODE)
+        self._weights: Dict[str, array] = {
+            category.value: array(WEIGHT_TYPECODE) for category in QueryCategory
+        }
+        # 加载期间被修改过的cookie, 加载完成后按数据库重新同步
+        self._touched: Optional[Set[int]] = None
+        self._load_lock = asyncio.Lock()
+        self.loaded_at: Optional[float] = None
+        self.load_seconds = 0.0
+        self.selections = 0
+        # 选中后读取时cookie已经被删除或隔离
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, cookie_id: int) -> bool:
+        return self._position(cookie_id) >= 0
+
+    def _position(self, cookie_id: int) -> int:
+        index = bisect_left(self._ids, cookie_id)
+        if index < len(self._ids) and self._ids[index] == cookie_id:
+            return index
+        return -1
+
+    def _touch(self, cookie_ids: Iterable[int]):
+        if self._touched is not None:
+            self._touched.update(cookie_ids)
+
+    def _put(self, cookie_id: int, weights: Dict[str, int]):
+        index = bisect_left(self._ids, cookie_id)
+        if index == len(self._ids) or self._ids[index] != cookie_id:
+            # 新cookie的id通常最大, insert在末尾不需要移动
+            self._ids.insert(index, cookie_id)
+            for category_weights in self._weights.values():
+                category_weights.insert(index, 0)
+        for category, weight in weights.items():
+            category_weights = self._weights.get(category)
+            if category_weights is not None:
+                category_weights[index] = weight
+
+    def _remove(self, cookie_id: int):
+        index = self._position(cookie_id)
+        if index < 0:
+            return
+        del self._ids[index]
+        for category_weights in self._weights.values():
+            del category_weights[index]
+
+    async def load(self):
+        """从数据库重新加载所有有效cookie的id和权重, 构造完新的数组后一次替换"""
+        async with self._load_lock:
+            start_time = time.perf_counter()
+            self._touched = set()
+            try:
+                ids = array(ID_TYPECODE)
+                weights = {category: array(WEIGHT_TYPECODE) for category in self._weights}
+                last_id = 0
+                while True:
+                    batch = await Cookie.filter(
+                        status=CookieStatus.ACTIVE, id__gt=last_id
+                    ).order_by("id").limit(POOL_LOAD_BATCH_SIZE).values_list("id", flat=True)
+                    if not batch:
+                        break
+                    offset = len(ids)
+                    ids.extend(batch)
+                    for category_weights in weights.values():
+                        category_weights.extend([0] * len(batch))
+                    rows = await CookieQueries.filter(
+                        cookie_ref_id__gt=last_id, cookie_ref_id__lte=batch[-1]
+                    ).values_list("cookie_ref_id", "category", "queries_weight")
+                    for cookie_id, category, weight in rows:
+                        index = bisect_left(ids, cookie_id, offset)
+                        if index < len(ids) and ids[index] == cookie_id:
+                            weights[_category_value(category)][index] = weight
+                    last_id = batch[-1]
+                self._ids, self._weights = ids, weights
+                touched = self._touched
+            finally:
+                self._touched = None
+            if touched:
+                # 加载期间的写入可能没有反映在读到的批次中
+                await self.sync(touched)
+            self.loaded_at = time.time()
+            self.load_seconds = time.perf_counter() - start_time
+            logger.debug(
+                f"Cookie pool loaded {len(ids)} cookies in {self.load_seconds:.2f} seconds"
+            )
+
+    async def sync(self, cookie_ids: Iterable[int]):
+        """按数据库重新读取这些cookie: 有效的写入当前权重, 删除或隔离的移出"""
+        cookie_ids = list(cookie_ids)
+        self._touch(cookie_ids)
+        for start in range(0, len(cookie_ids), POOL_LOAD_BATCH_SIZE):
+            batch = cookie_ids[start : start + POOL_LOAD_BATCH_SIZE]
+            active = await Cookie.filter(
+                id__in=batch, status=CookieStatus.ACTIVE
+            ).values_list("id", flat=True)
+            weights = await CookieQueries.get_weights_by_cookie_ids(active) if active else {}
+            for cookie_id in set(batch) - set(active):
+                self._remove(cookie_id)
+            for cookie_id in active:
+                cookie_weights = weights.get(cookie_id, {})
+                self._put(
+                    cookie_id,
+                    {category: cookie_weights.get(category, 0) for category in self._weights},
+                )
+
+    def apply_weight_changes(self, changes: WeightChanges):
+        """本进程写入的权重变化; 不在池中的cookie(隔离中)忽略"""
+        self._touch(changes.changed)
+        for cookie_id, categories in changes.changed.items():
+            index = self._position(cookie_id)
+            if index < 0:
+                continue
+            for category, (_, weight) in categories.items():
+                self._weights[category][index] = weight
+
+    def set_weight(self, cookie_id: int, category: QueryCategory, weight: int):
+        self._touch((cookie_id,))
+        index = self._position(cookie_id)
+        if index >= 0:
+            self._weights[_category_value(category)][index] = weight
+
+    def remove(self, cookie_ids: Iterable[int]):
+        cookie_ids = list(cookie_ids)
+        self._touch(cookie_ids)
+        for cookie_id in cookie_ids:
+            self._remove(cookie_id)
+
+    def choose(
+        self, category: QueryCategory, weight_factors: Optional[Dict[int, float]] = None
+    ) -> Optional[int]:
+        """按权重随机选一个cookie id, weight_factors为 {cookie id: 权重倍数}(如健康度惩罚)"""
+        weights = self._weights[_category_value(category)]
+        if not any(weights):
+            return None
+        if weight_factors:
+            # 只复制一次权重数组, 再调整少数被惩罚的cookie
+            weights = list(weights)
+            for cookie_id, factor in weight_factors.items():
+                index = self._position(cookie_id)
+                if index >= 0:
+                    weights[index] *= factor
+        (cookie_id,) = random.choices(self._ids, weights=weights)
+        self.selections += 1
+        return cookie_id
+
+    def weight(self, cookie_id: int, category: QueryCategory) -> int:
+        """cookie在这个类别的当前权重, 不在池中(已删除/隔离)时为0"""
+        index = self._position(cookie_id)
+        return self._weights[_category_value(category)][index] if index >= 0 else 0
+
+    async def fetch(self, cookie_id: int) -> Optional[CookieRecord]:
+        """按id读取选中的cookie; 已经被删除或隔离的移出池"""
+        record = await Cookie.get_record(cookie_id, status=CookieStatus.ACTIVE)
+        if record is None:
+            self.misses += 1
+            self.remove((cookie_id,))
+        return record
+
+    def cookie_ids_by_weight(self, category: QueryCategory, min_weight: int = 1) -> List[int]:
+        """权重不低于min_weight的cookie id, 按权重降序"""
+        weights = self._weights[_category_value(category)]
+        indexes = [index for index, weight in enumerate(weights) if weight >= min_weight]
+        indexes.sort(key=weights.__getitem__, reverse=True)
+        return [self._ids[index] for index in indexes]
+
+    def total_weights(self) -> Dict[str, int]:
+        return {category: sum(weights) for category, weights in self._weights.items()}
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self._ids) + sum(
+            sys.getsizeof(weights) for weights in self._weights.values()
+        )
+
+    def stats(self) -> Dict:
+        memory = self.memory_bytes()
+        return {
+            "cookies": len(self),
+            "memory_bytes": memory,
+            "bytes_per_cookie": round(memory / len(self), 1) if len(self) else None,
+            "total_weights": self.total_weights(),
+            "selections": self.selections,
+            "misses": self.misses,
+            "loaded_at": self.loaded_at,
+            "load_seconds": round(self.load_seconds, 3),
+        }
+
+
+cookie_pool = CookiePool()
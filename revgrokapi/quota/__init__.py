@@ -0,0 +1,28 @@
+from .admission import (AdmissionController, AdmissionTicket,
+                        ServerBusyError, admission_controller)
+from .api_key_manager import (ApiKeyState, InvalidApiKeyError,
+                              QuotaExceededError, RateLimitExceededError,
+                              api_key_manager)
+from .cookie_health import CookieHealth, cookie_health
+from .token_bucket import TokenBucket
+from .usage_accounting import (UsageAccounting, UsageOutcome, UsageRecord,
+                               usage_accounting)
+
+__all__ = [
+    "AdmissionController",
+    "AdmissionTicket",
+    "ApiKeyState",
+    "CookieHealth",
+    "InvalidApiKeyError",
+    "QuotaExceededError",
+    "RateLimitExceededError",
+    "ServerBusyError",
+    "TokenBucket",
+    "UsageAccounting",
+    "UsageOutcome",
+    "UsageRecord",
+    "admission_controller",
+    "api_key_manager",
+    "cookie_health",
+    "usage_accounting",
+]
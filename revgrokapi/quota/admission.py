@@ -0,0 +1,62 @@
+from revgrokapi.runtime_settings import runtime_settings
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class AdmissionTicket:
+    """占用的一个并发名额; release可以重复调用, 被回收时也会释放(流式响应没开始就断开时)"""
+
+    __slots__ = ("_controller",)
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+
+    def release(self):
+        if self._controller is not None:
+            self._controller.in_flight -= 1
+            self._controller = None
+
+    def __del__(self):
+        self.release()
+
+
+class AdmissionController:
+    """全局的并发请求数限制, 上限来自运行时配置max_concurrent_requests(0不限制)"""
+
+    __slots__ = ("in_flight", "rejected", "draining")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.rejected = 0
+        # 进入停机排空后不再接收新请求, 已接收的继续完成
+        self.draining = False
+
+    def start_draining(self):
+        self.draining = True
+
+    def acquire(self) -> AdmissionTicket:
+        """占用一个名额, 满了或正在停机时抛出ServerBusyError"""
+        if self.draining:
+            self.rejected += 1
+            raise ServerBusyError("Server is shutting down")
+        limit = runtime_settings.current.max_concurrent_requests
+        if limit and self.in_flight >= limit:
+            self.rejected += 1
+            raise ServerBusyError(
+                f"Server is busy: {self.in_flight} concurrent requests (limit {limit})"
+            )
+        self.in_flight += 1
+        return AdmissionTicket(self)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "limit": runtime_settings.current.max_concurrent_requests,
+            "draining": self.draining,
+        }
+
+
+admission_controller = AdmissionController()
@@ -0,0 +1,275 @@
+"""
+revgrokapi/quota/api_key_manager.py
+
+In-memory view of the api key table. Admission (rate limit + quota) is decided
+purely from memory; usage counters are accumulated here and flushed to the
+database periodically by the scheduler.
+"""
+import secrets
+from typing import Dict, List, Optional
+
+from loguru import logger
+from tortoise.expressions import F
+
+from revgrokapi.configs import POE_OPENAI_LIKE_API_KEY
+from revgrokapi.models.api_key_models import ApiKey
+from revgrokapi.quota.token_bucket import TokenBucket
+
+
+class InvalidApiKeyError(Exception):
+    pass
+
+
+class RateLimitExceededError(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
+class ApiKeyState:
+    """单个api key在内存中的状态: 配置、令牌桶以及尚未落库的用量"""
+
+    __slots__ = (
+        "id",
+        "key",
+        "name",
+        "is_active",
+        "requests_per_minute",
+        "tokens_per_minute",
+        "request_quota",
+        "token_quota",
+        "request_bucket",
+        "token_bucket",
+        "used_requests",
+        "used_prompt_tokens",
+        "used_completion_tokens",
+        "pending_requests",
+        "pending_prompt_tokens",
+        "pending_completion_tokens",
+    )
+
+    def __init__(self, key: str, id: Optional[int] = None, name: str = ""):
+        self.id = id
+        self.key = key
+        self.name = name
+        self.is_active = True
+        self.requests_per_minute = 0
+        self.tokens_per_minute = 0
+        self.request_quota = 0
+        self.token_quota = 0
+        self.request_bucket: Optional[TokenBucket] = None
+        self.token_bucket: Optional[TokenBucket] = None
+        self.used_requests = 0
+        self.used_prompt_tokens = 0
+        self.used_completion_tokens = 0
+        self.pending_requests = 0
+        self.pending_prompt_tokens = 0
+        self.pending_completion_tokens = 0
+
+    @classmethod
+    def from_model(cls, api_key: ApiKey) -> "ApiKeyState":
+        state = cls(api_key.key, id=api_key.id)
+        state.apply_model(api_key)
+        return state
+
+    def apply_model(self, api_key: ApiKey):
+        """用数据库记录刷新配置, 保留令牌桶余量和未落库的用量"""
+        self.id = api_key.id
+        self.name = api_key.name
+        self.is_active = api_key.is_active
+        self.request_quota = api_key.request_quota
+        self.token_quota = api_key.token_quota
+        self.used_requests = api_key.used_requests
+        self.used_prompt_tokens = api_key.used_prompt_tokens
+        self.used_completion_tokens = api_key.used_completion_tokens
+        self.request_bucket = self._resize_bucket(
+            self.request_bucket, api_key.requests_per_minute
+        )
+        self.token_bucket = self._resize_bucket(
+            self.token_bucket, api_key.tokens_per_minute
+        )
+        self.requests_per_minute = api_key.requests_per_minute
+        self.tokens_per_minute = api_key.tokens_per_minute
+
+    @staticmethod
+    def _resize_bucket(
+        bucket: Optional[TokenBucket], per_minute: int
+    ) -> Optional[TokenBucket]:
+        if per_minute <= 0:
+            return None
+        if bucket is None:
+            return TokenBucket(per_minute)
+        bucket.resize(per_minute)
+        return bucket
+
+    @property
+    def total_requests(self) -> int:
+        return self.used_requests + self.pending_requests
+
+    @property
+    def total_tokens(self) -> int:
+        return (
+            self.used_prompt_tokens
+            + self.used_completion_tokens
+            + self.pending_prompt_tokens
+            + self.pending_completion_tokens
+        )
+
+    def to_usage_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "key": f"{self.key[:8]}...",
+            "is_active": self.is_active,
+            "requests": self.total_requests,
+            "prompt_tokens": self.used_prompt_tokens + self.pending_prompt_tokens,
+            "completion_tokens": self.used_completion_tokens
+            + self.pending_completion_tokens,
+            "request_quota": self.request_quota,
+            "token_quota": self.token_quota,
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "request_bucket_remaining": (
+                round(self.request_bucket.tokens, 2) if self.request_bucket else None
+            ),
+            "token_bucket_remaining": (
+                round(self.token_bucket.tokens, 2) if self.token_bucket else None
+            ),
+        }
+
+
+class ApiKeyManager:
+    def __init__(self):
+        self._states: Dict[str, ApiKeyState] = {}
+        # 兼容原来写死在configs中的key, 不限速也不落库
+        self._legacy_state = ApiKeyState(POE_OPENAI_LIKE_API_KEY, name="legacy")
+
+    @staticmethod
+    def generate_key() -> str:
+        return f"sk-grok-{secrets.token_urlsafe(24)}"
+
+    async def load(self):
+        """从数据库加载所有api key到内存"""
+        api_keys = await ApiKey.all()
+        states = {}
+        for api_key in api_keys:
+            state = self._states.get(api_key.key)
+            if state:
+                state.apply_model(api_key)
+            else:
+                state = ApiKeyState.from_model(api_key)
+            states[api_key.key] = state
+        self._states = states
+        logger.info(f"Loaded {len(states)} api keys into memory")
+
+    def upsert(self, api_key: ApiKey):
+        """新增或修改api key之后同步到内存"""
+        stale = [k for k, v in self._states.items() if v.id == api_key.id]
+        for key in stale:
+            if key != api_key.key:
+                self._states[api_key.key] = self._states.pop(key)
+        state = self._states.get(api_key.key)
+        if state:
+            state.apply_model(api_key)
+        else:
+            self._states[api_key.key] = ApiKeyState.from_model(api_key)
+
+    def remove(self, key_id: int):
+        for key, state in list(self._states.items()):
+            if state.id == key_id:
+                del self._states[key]
+
+    def get_state(self, api_key: str) -> ApiKeyState:
+        """返回有效的api key的状态, 无效或已停用时抛出 InvalidApiKeyError"""
+        if api_key == self._legacy_state.key:
+            return self._legacy_state
+        state = self._states.get(api_key)
+        if state is None or not state.is_active:
+            raise InvalidApiKeyError("Invalid API key")
+        return state
+
+    def admit(self, api_key: str, prompt_tokens: int) -> ApiKeyState:
+        """检查api key是否有效、是否超过速率和总额度, 通过时计入一次请求
+
+        不访问数据库, 失败时抛出 InvalidApiKeyError / RateLimitExceededError /
+        QuotaExceededError.
+        """
+        state = self.get_state(api_key)
+        if state.request_quota and state.total_requests >= state.request_quota:
+            raise QuotaExceededError("Request quota exceeded for this API key")
+        if state.token_quota and state.total_tokens + prompt_tokens > state.token_quota:
+            raise QuotaExceededError("Token quota exceeded for this API key")
+
+        if state.request_bucket and not state.request_bucket.try_consume(1):
+            raise RateLimitExceededError(
+                "Request rate limit exceeded for this API key",
+                retry_after=state.request_bucket.retry_after(1),
+            )
+        if state.token_bucket and not state.token_bucket.try_consume(prompt_tokens):
+            if state.request_bucket:
+                # 把刚刚扣掉的请求令牌还回去
+                state.request_bucket.tokens += 1
+            raise RateLimitExceededError(
+                "Token rate limit exceeded for this API key",
+                retry_after=state.token_bucket.retry_after(prompt_tokens),
+            )
+
+        state.pending_requests += 1
+        state.pending_prompt_tokens += prompt_tokens
+        return state
+
+    def record_prompt_tokens(self, state: ApiKeyState, prompt_tokens: int):
+        """准入之后才确定多发送的prompt tokens(如会话不能续接时改发完整历史), 令牌桶允许出现欠账"""
+        if state.token_bucket:
+            state.token_bucket.consume(prompt_tokens)
+        state.pending_prompt_tokens += prompt_tokens
+
+    def record_completion(self, state: ApiKeyState, completion_tokens: int):
+        """生成结束后记录completion tokens, 令牌桶允许出现欠账"""
+        if state.token_bucket:
+            state.token_bucket.consume(completion_tokens)
+        state.pending_completion_tokens += completion_tokens
+
+    def usage(self) -> List[Dict]:
+        states = [self._legacy_state, *self._states.values()]
+        return [state.to_usage_dict() for state in states]
+
+    async def flush(self):
+        """把内存中累计的用量写回数据库"""
+        flushed = 0
+        for state in list(self._states.values()):
+            requests = state.pending_requests
+            prompt_tokens = state.pending_prompt_tokens
+            completion_tokens = state.pending_completion_tokens
+            if not (requests or prompt_tokens or completion_tokens):
+                continue
+            # 先清零再写库, 避免await期间新增的用量被覆盖
+            state.pending_requests -= requests
+            state.pending_prompt_tokens -= prompt_tokens
+            state.pending_completion_tokens -= completion_tokens
+            try:
+                await ApiKey.filter(id=state.id).update(
+                    used_requests=F("used_requests") + requests,
+                    used_prompt_tokens=F("used_prompt_tokens") + prompt_tokens,
+                    used_completion_tokens=F("used_completion_tokens")
+                    + completion_tokens,
+                )
+            except Exception as e:
+                logger.error(f"Error flushing usage for api key {state.id}: {e}")
+                state.pending_requests += requests
+                state.pending_prompt_tokens += prompt_tokens
+                state.pending_completion_tokens += completion_tokens
+                continue
+            state.used_requests += requests
+            state.used_prompt_tokens += prompt_tokens
+            state.used_completion_tokens += completion_tokens
+            flushed += 1
+        if flushed:
+            logger.debug(f"Flushed usage of {flushed} api keys")
+
+
+api_key_manager = ApiKeyManager()
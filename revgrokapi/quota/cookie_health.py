@@ -0,0 +1,85 @@
+"""
+revgrokapi/quota/cookie_health.py
+
+Short-term health of each cookie, fed by classified upstream stream timeouts.
+Every first-byte, idle or total timeout halves the cookie's selection weight;
+the penalty decays with COOKIE_HEALTH_HALF_LIFE_SECONDS, so a cookie whose
+streams stalled for a while drifts back to its normal share once it behaves.
+Connect timeouts are the proxy's problem (the proxy pool already tracks them)
+and are only counted here.
+"""
+import time
+from collections import Counter
+from typing import Dict, Tuple
+
+from revgrokapi.configs import (COOKIE_HEALTH_HALF_LIFE_SECONDS,
+                                COOKIE_HEALTH_MIN_WEIGHT_FACTOR)
+from revgrokapi.revgrok.events import TimeoutPhase
+
+PENALIZED_PHASES = {TimeoutPhase.FIRST_BYTE, TimeoutPhase.IDLE, TimeoutPhase.TOTAL}
+# 衰减到这个值以下的惩罚直接删除
+MIN_PENALTY = 0.01
+
+
+class CookieHealth:
+    def __init__(self, half_life: float = COOKIE_HEALTH_HALF_LIFE_SECONDS):
+        self.half_life = half_life
+        # cookie id -> (惩罚分, 更新时间), 每次超时加1
+        self._penalties: Dict[int, Tuple[float, float]] = {}
+        self.timeouts: Counter = Counter()
+
+    def _penalty(self, cookie_id: int, now: float) -> float:
+        entry = self._penalties.get(cookie_id)
+        if entry is None:
+            return 0.0
+        penalty, updated_at = entry
+        return penalty * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def record_timeout(self, cookie_id: int, phase: TimeoutPhase):
+        self.timeouts[phase.value] += 1
+        if phase not in PENALIZED_PHASES:
+            return
+        now = time.monotonic()
+        self._penalties[cookie_id] = (self._penalty(cookie_id, now) + 1, now)
+
+    def weight_factor(self, cookie_id: int, now: float) -> float:
+        return max(COOKIE_HEALTH_MIN_WEIGHT_FACTOR, 0.5 ** self._penalty(cookie_id, now))
+
+    def _prune(self, now: float):
+        for cookie_id in list(self._penalties):
+            if self._penalty(cookie_id, now) < MIN_PENALTY:
+                del self._penalties[cookie_id]
+
+    def weight_factors(self) -> Dict[int, float]:
+        """被惩罚的cookie的权重倍数 {cookie id: 倍数}, 给cookie_pool.choose使用"""
+        if not self._penalties:
+            return {}
+        now = time.monotonic()
+        self._prune(now)
+        return {cookie_id: self.weight_factor(cookie_id, now) for cookie_id in self._penalties}
+
+    def forget(self, cookie_id: int):
+        self._penalties.pop(cookie_id, None)
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        penalized = sorted(
+            ((cookie_id, self._penalty(cookie_id, now)) for cookie_id in self._penalties),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+        return {
+            "timeouts": dict(self.timeouts),
+            "penalized": [
+                {
+                    "cookie_id": cookie_id,
+                    "penalty": round(penalty, 3),
+                    "weight_factor": round(self.weight_factor(cookie_id, now), 3),
+                }
+                for cookie_id, penalty in penalized
+                if penalty >= MIN_PENALTY
+            ],
+        }
+
+
+cookie_health = CookieHealth()
@@ -0,0 +1,52 @@
+import time
+
+
+class TokenBucket:
+    """进程内的令牌桶, 按 per_minute 的速率匀速补充, 容量等于 per_minute."""
+
+    __slots__ = ("capacity", "refill_per_second", "tokens", "updated_at")
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.refill_per_second = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(
+                self.capacity, self.tokens + elapsed * self.refill_per_second
+            )
+            self.updated_at = now
+
+    def try_consume(self, amount: float = 1.0) -> bool:
+        """余量足够时扣减并返回True, 否则不扣减返回False
+
+        超过桶容量的请求在桶满时放行, 多出的部分记为欠账(余量为负).
+        """
+        self._refill(time.monotonic())
+        if self.tokens >= min(amount, self.capacity):
+            self.tokens -= amount
+            return True
+        return False
+
+    def consume(self, amount: float):
+        """强制扣减, 余量可以变成负数(例如生成结束后才知道的completion tokens)"""
+        self._refill(time.monotonic())
+        self.tokens -= amount
+
+    def retry_after(self, amount: float = 1.0) -> float:
+        """距离可以扣减 amount 还需要等待的秒数"""
+        self._refill(time.monotonic())
+        missing = min(amount, self.capacity) - self.tokens
+        if missing <= 0 or self.refill_per_second <= 0:
+            return 0.0
+        return missing / self.refill_per_second
+
+    def resize(self, per_minute: int):
+        """修改速率, 保留当前余量"""
+        self._refill(time.monotonic())
+        self.capacity = float(per_minute)
+        self.refill_per_second = per_minute / 60.0
+        self.tokens = min(self.tokens, self.capacity)
@@ -0,0 +1,191 @@
+"""
+revgrokapi/quota/usage_accounting.py
+
+Per-request usage accounting: the cookie that served the request, its category
+and model, prompt/completion tokens, time to first token, duration and
+outcome. The request path only adds to in-memory counters keyed by (hour,
+cookie, category, model). A scheduled flush rolls them into the usage_hourly
+table with one batched upsert per flush. Failed attempts that were retried on
+another cookie are counted as errors of the cookie they ran on, so per-cookie
+error rates include retried failures.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+from revgrokapi.configs import USAGE_RETENTION_DAYS
+from revgrokapi.models.cookie_models import QueryCategory
+from revgrokapi.models.usage_models import USAGE_COUNTER_FIELDS, UsageHourly
+
+SECONDS_PER_HOUR = 3600
+
+# (小时的时间戳, cookie id, 类别, 模型)
+UsageKey = Tuple[int, int, str, str]
+
+
+class UsageOutcome(str, Enum):
+    OK = "ok"
+    ERROR = "error"
+    TIMEOUT = "timeout"
+    # 客户端中途断开
+    CANCELLED = "cancelled"
+
+
+# 各结果计入的计数字段, 成功只计入requests
+OUTCOME_FIELDS = {
+    UsageOutcome.ERROR: "errors",
+    UsageOutcome.TIMEOUT: "timeouts",
+    UsageOutcome.CANCELLED: "cancelled",
+}
+
+
+class UsageRecord:
+    """一次请求的用量, 由路由创建, grok_chat填入实际使用的cookie和首行时间
+
+    首行延迟和耗时都从这次尝试开始计算, 反映的是cookie本身的表现.
+    """
+
+    __slots__ = (
+        "model",
+        "category",
+        "prompt_tokens",
+        "cookie_id",
+        "start",
+        "ttft",
+        "outcome",
+    )
+
+    def __init__(self, model: str, category: QueryCategory, prompt_tokens: int = 0):
+        self.model = model
+        self.category = category
+        self.prompt_tokens = prompt_tokens
+        self.cookie_id: Optional[int] = None
+        # 这次尝试开始的时间
+        self.start = time.perf_counter()
+        self.ttft: Optional[float] = None
+        # 没有设置时由finish根据是否正常结束决定
+        self.outcome: Optional[UsageOutcome] = None
+
+    def use_cookie(self, cookie_id: int):
+        self.cookie_id = cookie_id
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.start
+
+    def fail_attempt(self, outcome: UsageOutcome = UsageOutcome.ERROR):
+        """这次尝试失败, 接下来会换cookie重试; 单独计入这次使用的cookie"""
+        if self.cookie_id is not None:
+            usage_accounting.record(
+                self.cookie_id,
+                self.category,
+                self.model,
+                self.outcome or outcome,
+                duration=time.perf_counter() - self.start,
+            )
+        self.cookie_id = None
+        self.ttft = None
+        self.outcome = None
+        self.start = time.perf_counter()
+
+    def finish(self, completion_tokens: int, outcome: UsageOutcome = UsageOutcome.OK):
+        """请求结束时调用一次; grok_chat已经判定的结果(如超时)优先"""
+        if self.cookie_id is None:
+            # 没有选到cookie(或者最后一次尝试已经计入), 没有可以归属的用量
+            return
+        usage_accounting.record(
+            self.cookie_id,
+            self.category,
+            self.model,
+            self.outcome or outcome,
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=completion_tokens,
+            ttft=self.ttft,
+            duration=time.perf_counter() - self.start,
+        )
+        self.cookie_id = None
+
+
+class UsageAccounting:
+    def __init__(self):
+        self._pending: Dict[UsageKey, Dict[str, float]] = {}
+        self.recorded = 0
+        self.flushed_rows = 0
+        self._pruned_hour: Optional[int] = None
+
+    def record(
+        self,
+        cookie_id: int,
+        category: QueryCategory,
+        model: str,
+        outcome: UsageOutcome,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        ttft: Optional[float] = None,
+        duration: float = 0.0,
+    ):
+        """只累加内存中的计数, 不访问数据库"""
+        hour = int(time.time()) // SECONDS_PER_HOUR * SECONDS_PER_HOUR
+        key = (hour, cookie_id, QueryCategory(category).value, model)
+        counters = self._pending.get(key)
+        if counters is None:
+            counters = self._pending[key] = dict.fromkeys(USAGE_COUNTER_FIELDS, 0)
+        counters["requests"] += 1
+        outcome_field = OUTCOME_FIELDS.get(outcome)
+        if outcome_field is not None:
+            counters[outcome_field] += 1
+        counters["prompt_tokens"] += prompt_tokens
+        counters["completion_tokens"] += completion_tokens
+        if ttft is not None:
+            counters["ttft_count"] += 1
+            counters["ttft_ms_sum"] += ttft * 1000
+        counters["duration_ms_sum"] += duration * 1000
+        self.recorded += 1
+
+    def _merge_back(self, pending: Dict[UsageKey, Dict[str, float]]):
+        for key, delta in pending.items():
+            counters = self._pending.setdefault(key, dict.fromkeys(USAGE_COUNTER_FIELDS, 0))
+            for field, value in delta.items():
+                counters[field] += value
+
+    async def flush(self):
+        """把累计的用量一次性写入usage_hourly, 失败时放回内存等下一次"""
+        pending, self._pending = self._pending, {}
+        if pending:
+            try:
+                written = await UsageHourly.bulk_accumulate(pending)
+            except Exception as e:
+                logger.error(f"Error flushing usage accounting: {e}")
+                self._merge_back(pending)
+                return
+            self.flushed_rows += written
+            logger.debug(f"Flushed {written} hourly usage rows")
+        await self._prune()
+
+    async def _prune(self):
+        """每小时删除一次超过保留期的汇总"""
+        hour = int(time.time()) // SECONDS_PER_HOUR
+        if self._pruned_hour == hour:
+            return
+        self._pruned_hour = hour
+        cutoff = datetime.now(timezone.utc) - timedelta(days=USAGE_RETENTION_DAYS)
+        try:
+            deleted = await UsageHourly.filter(hour__lt=cutoff).delete()
+        except Exception as e:
+            logger.error(f"Error pruning usage accounting: {e}")
+            return
+        if deleted:
+            logger.info(f"Pruned {deleted} hourly usage rows older than {USAGE_RETENTION_DAYS} days")
+
+    def stats(self) -> Dict:
+        return {
+            "recorded": self.recorded,
+            "pending_rows": len(self._pending),
+            "flushed_rows": self.flushed_rows,
+        }
+
+
+usage_accounting = UsageAccounting()
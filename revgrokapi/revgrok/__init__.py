@@ -1,3 +1,5 @@
 from .client import GrokClient
+from .proxy_pool import ProxyPool, proxy_pool
+from .session_pool import GrokClientPool, grok_client_pool
 
-__all__ = ["GrokClient"]
+__all__ = ["GrokClient", "GrokClientPool", "ProxyPool", "grok_client_pool", "proxy_pool"]
@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from typing import Optional
+
+
+class AttachmentCache:
+    """按内容hash缓存已上传附件的fileMetadataId.
+
+    附件id只对上传它的账号有效, 所以按cookie分区; 每个cookie内部以及cookie
+    本身都是有界的LRU.
+    """
+
+    def __init__(self, max_entries_per_cookie: int = 256, max_cookies: int = 1024):
+        self.max_entries_per_cookie = max_entries_per_cookie
+        self.max_cookies = max_cookies
+        self._cache: "OrderedDict[str, OrderedDict[str, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cookie_key: str, digest: str) -> Optional[str]:
+        entries = self._cache.get(cookie_key)
+        file_id = entries.get(digest) if entries is not None else None
+        if file_id is None:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(cookie_key)
+        entries.move_to_end(digest)
+        self.hits += 1
+        return file_id
+
+    def put(self, cookie_key: str, digest: str, file_id: str):
+        entries = self._cache.get(cookie_key)
+        if entries is None:
+            entries = self._cache[cookie_key] = OrderedDict()
+            if len(self._cache) > self.max_cookies:
+                self._cache.popitem(last=False)
+        self._cache.move_to_end(cookie_key)
+        entries[digest] = file_id
+        entries.move_to_end(digest)
+        if len(entries) > self.max_entries_per_cookie:
+            entries.popitem(last=False)
+
+    def invalidate(self, cookie_key: str):
+        self._cache.pop(cookie_key, None)
+
+
+attachment_cache = AttachmentCache()
@@ -69,58 +69,181 @@ import asyncio
 import json
 import time
 import re
+from contextlib import asynccontextmanager
+from typing import Mapping
+
+from curl_cffi.const import CurlInfo
 from curl_cffi.requests import AsyncSession, BrowserType
+from curl_cffi.requests.exceptions import Timeout as CurlTimeout
 from loguru import logger
 
-from .configs import CHAT_URL, RATE_LIMIT_URL
-from .utils import get_default_chat_payload, get_default_user_agent
+from .configs import (BASE_URL, CHAT_URL, CONVERSATION_RESPONSES_URL,
+                      RATE_LIMIT_URL, UPLOAD_FILE_URL)
+from .events import UPSTREAM_TIMEOUT_CODE, TimeoutPhase
+from .proxy_pool import proxy_pool
+from .utils import (get_chat_payload_template, get_default_headers,
+                    get_default_user_agent, get_page_headers)
 from ..configs import PROXIES
+from ..runtime_settings import StreamTimeouts, runtime_settings
+from ..tracing import span, traced
 from ..utils.async_utils import async_retry
+from ..utils.cookie_utils import extract_cookie_value
+
+# 上游连接各阶段的耗时(curl统计的是从请求开始的累计秒数)
+CONNECTION_TIMINGS = (
+    ("dns_ms", CurlInfo.NAMELOOKUP_TIME),
+    ("connect_ms", CurlInfo.CONNECT_TIME),
+    ("tls_ms", CurlInfo.APPCONNECT_TIME),
+    ("first_byte_ms", CurlInfo.STARTTRANSFER_TIME),
+)
+
+
+def record_connection_timings(chat_span, response):
+    if chat_span is None or response.curl is None:
+        return
+    try:
+        for name, info in CONNECTION_TIMINGS:
+            chat_span.set_attribute(name, round(response.curl.getinfo(info) * 1000, 3))
+    except Exception as e:
+        logger.debug(f"Failed to read connection timings: {e}")
+
+
+class UpstreamTimeoutError(Exception):
+    """上游流在某个阶段超时"""
+
+    def __init__(self, phase: TimeoutPhase, seconds: float):
+        super().__init__(f"Upstream {phase.value} timeout after {seconds:g}s")
+        self.phase = phase
+        self.seconds = seconds
+
+    def to_chunk(self) -> tuple[str, dict]:
+        """转换成chat()产出的错误行, 调用方通过GrokResponseEvent.timeout_phase识别"""
+        return f"请求出错: {self}", {
+            "error": {
+                "code": UPSTREAM_TIMEOUT_CODE,
+                "phase": self.phase.value,
+                "message": str(self),
+            }
+        }
+
+
+async def abort_stream(response):
+    """结束流式响应; 没读完时取消传输任务(curl随之移除句柄、断开连接).
+    curl_cffi的aclose会一直等到上游发完, 上游卡住时会一直占着连接和这个请求."""
+    task = response.astream_task
+    if task is not None and not task.done():
+        task.cancel()
+        await asyncio.wait([task])
+
+
+class StreamTimer:
+    """流式请求的分阶段截止时间: 第一行之前按first_byte, 之后每行按idle, 都不超过total
+
+    连接超时交给curl(CONNECTTIMEOUT), 其余阶段在每次等待时用asyncio.timeout_at,
+    不能用一个跨越yield的timeout, 否则会在调用方处理数据时取消调用方的task.
+    """
+
+    __slots__ = ("timeouts", "loop", "first_byte_deadline", "deadline", "received")
+
+    def __init__(self, timeouts: StreamTimeouts):
+        self.timeouts = timeouts
+        self.loop = asyncio.get_running_loop()
+        now = self.loop.time()
+        self.first_byte_deadline = now + timeouts.first_byte_seconds
+        self.deadline = now + timeouts.total_seconds
+        self.received = False
+
+    @property
+    def curl_timeout(self) -> tuple[float, float]:
+        # curl对流式请求把第二项当作低速超时, 这里只作为兜底, 不早于total
+        return self.timeouts.connect_seconds, self.timeouts.total_seconds
+
+    def _next(self) -> tuple[TimeoutPhase, float, float]:
+        if self.received:
+            phase, seconds = TimeoutPhase.IDLE, self.timeouts.idle_seconds
+            at = self.loop.time() + seconds
+        else:
+            phase, seconds = TimeoutPhase.FIRST_BYTE, self.timeouts.first_byte_seconds
+            at = self.first_byte_deadline
+        if self.deadline <= at:
+            return TimeoutPhase.TOTAL, self.timeouts.total_seconds, self.deadline
+        return phase, seconds, at
+
+    async def wait(self, awaitable):
+        phase, seconds, at = self._next()
+        timeout = asyncio.timeout_at(at)
+        try:
+            async with timeout:
+                return await awaitable
+        except TimeoutError:
+            if not timeout.expired():
+                raise
+            raise UpstreamTimeoutError(phase, seconds) from None
+        except CurlTimeout:
+            # 兜底的低速超时不会早于total, 这里只会是连接超时
+            raise UpstreamTimeoutError(
+                TimeoutPhase.CONNECT, self.timeouts.connect_seconds
+            ) from None
+
+    @asynccontextmanager
+    async def stream(self, request):
+        """request为client.request(..., stream=True), 等待响应头也受first_byte/total限制"""
+        response = await self.wait(request)
+        try:
+            yield response
+        finally:
+            await abort_stream(response)
+
+    async def lines(self, response):
+        lines = response.aiter_lines()
+        while True:
+            try:
+                line = await self.wait(anext(lines))
+            except StopAsyncIteration:
+                return
+            self.received = True
+            yield line
 
 
 class GrokClient:
     @property
     def headers(self):
-        return {
-            "Accept": "*/*",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Accept-Language": "en-US,en;q=0.9",
-            "Content-Type": "application/json",
-            "Cookie": self.cookie,
-            "Origin": "https://grok.com",
-            "Referer": "https://grok.com/",
-            "Sec-Ch-Ua": '"Not A(Brand";v="99", "Google Chrome";v="121", "Chromium";v="121"',
-            "Sec-Ch-Ua-Mobile": "?0",
-            "Sec-Ch-Ua-Platform": '"Windows"',
-            "Sec-Fetch-Dest": "empty",
-            "Sec-Fetch-Mode": "cors",
-            "Sec-Fetch-Site": "same-origin",
-            "User-Agent": self.user_agent,
-        }
+        return self._headers
 
-    def __init__(self, cookie: str, user_agent: str | None = None):
+    def __init__(self, cookie: str, user_agent: str | None = None, proxy: str | None = None):
         self.cookie = cookie
         self.user_agent = user_agent if user_agent else get_default_user_agent()
+        # 代理池分配的出口, cf_clearance和出口IP绑定, 换代理需要新建client
+        self.proxy = proxy
         self.client = AsyncSession(
             impersonate=BrowserType.chrome120,
-            proxies=PROXIES,
+            proxies={"http": proxy, "https": proxy} if proxy else PROXIES,
             timeout=60.0
         )
         self.cf_clearance = self._extract_cf_clearance(cookie)
+        # 账号标识, cf_clearance变化时保持不变, 用于按账号缓存附件等
+        self.account_key = extract_cookie_value(cookie, "sso") or cookie
+        self._refresh_headers()
+
+    def _refresh_headers(self):
+        """cookie变化后重新获取预先构建好的请求头"""
+        self._headers = get_default_headers(self.cookie, self.user_agent)
+        self._page_headers = get_page_headers(self.cookie, self.user_agent)
 
     def _extract_cf_clearance(self, cookie: str) -> str:
         """从cookie字符串中提取cf_clearance值"""
         match = re.search(r'cf_clearance=([^;]+)', cookie)
         return match.group(1) if match else ""
 
+    @traced("cloudflare")
     async def _handle_cloudflare(self, url: str) -> bool:
         """处理Cloudflare挑战并获取所需的cookies"""
         logger.info("检测到Cloudflare挑战，尝试解决...")
         try:
             # 直接访问主页面获取Cloudflare cookies
             response = await self.client.get(
-                "https://grok.com/",
-                headers={k: v for k, v in self.headers.items() if k != "Content-Type"},
+                f"{BASE_URL}/",
+                headers=self._page_headers,
                 impersonate=BrowserType.chrome120
             )
 
@@ -141,6 +264,7 @@ class GrokClient:
                             self.cookie = re.sub(r'cf_clearance=[^;]+', f'cf_clearance={value}', self.cookie)
                         else:
                             self.cookie += f"; cf_clearance={value}"
+                        self._refresh_headers()
                         logger.info("成功获取新的cf_clearance")
                 return True
 
@@ -149,77 +273,137 @@ class GrokClient:
             logger.error(f"处理Cloudflare挑战时出错: {e}")
             return False
 
-    @async_retry(retries=3, delay=2)
+    @async_retry(
+        retries=lambda: runtime_settings.current.upstream_retries,
+        delay=lambda: runtime_settings.current.upstream_retry_delay_seconds,
+    )
     async def chat(
             self,
             prompt: str,
             model: str,
             reasoning: bool = False,
             deepresearch: bool = False,
+            payload_overrides: Mapping | None = None,
+            file_attachments: list[str] | None = None,
+            timeouts: StreamTimeouts | None = None,
+            conversation_id: str | None = None,
+            parent_response_id: str | None = None,
     ):
-        default_payload = get_default_chat_payload()
-        update_payload = {
-            "modelName": model,
-            "message": prompt,
-            "isReasoning": reasoning,
-            "deepsearchPreset": "default" if deepresearch else "",
-        }
-
-        default_payload.update(update_payload)
-        payload = default_payload
+        """timeouts为空时按reasoning/deepresearch取对应类别的运行时配置;
+        给出conversation_id时在这个对话中接着parent_response_id继续, 否则新建对话"""
+        payload_template = get_chat_payload_template(
+            model,
+            reasoning,
+            "default" if deepresearch else "",
+            json.dumps(dict(payload_overrides), sort_keys=True) if payload_overrides else "",
+        )
+        if conversation_id:
+            url = CONVERSATION_RESPONSES_URL.format(conversation_id=conversation_id)
+            payload = payload_template.render(
+                prompt, file_attachments or (), {"parentResponseId": parent_response_id}
+            )
+        else:
+            url = CHAT_URL
+            payload = payload_template.render(prompt, file_attachments or ())
+        if timeouts is None:
+            timeouts = runtime_settings.current.stream_timeouts_for(
+                "DEEPSEARCH" if deepresearch else "REASONING" if reasoning else "DEFAULT"
+            )
+        timer = StreamTimer(timeouts)
 
         try:
-            async with self.client.stream(
-                    method="POST",
-                    url=CHAT_URL,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=600.0,
-            ) as response:
-                # 检查是否遇到Cloudflare挑战
-                # 注意：curl_cffi的响应对象没有aread方法，需要使用text属性
-                    # 对于curl_cffi，直接使用response.text获取内容
-                if "Just a moment" in response.text or "challenge-running" in response.text:
-                        # 处理Cloudflare挑战
-                        success = await self._handle_cloudflare(CHAT_URL)
-                        if success:
-                            # 重新尝试请求
-                            raise Exception("需要重试请求")  # 触发async_retry装饰器
-                        else:
-                            yield "Cloudflare挑战失败，请检查cookie或更换IP", {"error": "Cloudflare challenge failed"}
+            with span(
+                "grok.chat", model=model, continued=bool(conversation_id)
+            ) as chat_span, proxy_pool.track(
+                self.proxy
+            ) as proxy_request:
+                async with timer.stream(self.client.request(
+                        method="POST",
+                        url=url,
+                        headers=self.headers,
+                        data=payload,
+                        stream=True,
+                        timeout=timer.curl_timeout,
+                )) as response:
+                    record_connection_timings(chat_span, response)
+                    if proxy_request is not None:
+                        proxy_request.first_byte()
+                    # 检查是否遇到Cloudflare挑战
+                    # 注意：curl_cffi的响应对象没有aread方法，需要使用text属性
+                        # 对于curl_cffi，直接使用response.text获取内容
+                    if "Just a moment" in response.text or "challenge-running" in response.text:
+                            if proxy_request is not None:
+                                proxy_request.challenge()
+                            # 处理Cloudflare挑战
+                            success = await self._handle_cloudflare(url)
+                            if success:
+                                # 重新尝试请求
+                                raise Exception("需要重试请求")  # 触发async_retry装饰器
+                            else:
+                                yield "Cloudflare挑战失败，请检查cookie或更换IP", {"error": "Cloudflare challenge failed"}
+                                return
+
+                    # 常规响应处理
+                    is_first_chunk = True
+                    async for chunk_bytes in timer.lines(response):
+                        if is_first_chunk:
+                            logger.debug(f"First chunk: {chunk_bytes[:500]!r}")
+                            if chat_span is not None:
+                                chat_span.add_event("first_line")
+                            is_first_chunk = False
+                        # 直接从bytes解析, 图片生成时一行可能有上MB的base64, 避免先decode成str再拷贝一次
+                        try:
+                            chunk_json = json.loads(chunk_bytes)
+                        except (json.JSONDecodeError, UnicodeDecodeError):
+                            chunk = chunk_bytes.decode("utf-8", errors="replace")
+                            logger.debug(chunk)
+                            yield chunk, {}
+                            if "error" in chunk and "isThinking" not in chunk:
+                                return
+                            continue
+
+                        if not isinstance(chunk_json, dict):
+                            continue
+                        if chunk_json.get("error"):
+                            yield chunk_bytes.decode("utf-8", errors="replace"), chunk_json
                             return
 
-                # 常规响应处理
-                is_first_chunk = True
-                async for chunk_bytes in response.aiter_lines():
-                    chunk = chunk_bytes.decode("utf-8")
-                    if is_first_chunk:
-                        logger.debug(f"First chunk: {chunk}")
-                        is_first_chunk = False
-                    try:
-                        chunk_json = json.loads(chunk)
-                    except json.JSONDecodeError:
-                        logger.debug(chunk)
-                        chunk_json = {}
-                        yield chunk, {}
-
-                    if "error" in chunk and "isThinking" not in chunk:
-                        yield chunk, chunk_json
-                        return
-
-                    response_token = (
-                        chunk_json.get("result", {}).get("response", {}).get("token", "")
-                    )
-                    yield response_token, chunk_json
+                        result = chunk_json.get("result", {})
+                        # 继续已有对话时上游不再嵌套一层response
+                        response_token = result.get("response", result).get("token", "")
+                        yield response_token, chunk_json
 
+        except UpstreamTimeoutError as e:
+            logger.warning(f"聊天请求超时: {e}")
+            yield e.to_chunk()
         except Exception as e:
             logger.error(f"聊天请求出错: {e}")
             # 检查是否是连接问题，可能是被Cloudflare阻止
             if "Connection" in str(e) or "Timeout" in str(e):
                 # 尝试处理Cloudflare
-                await self._handle_cloudflare(CHAT_URL)
+                await self._handle_cloudflare(url)
             yield f"请求出错: {str(e)}", {"error": str(e)}
 
+    async def upload_file(self, file_name: str, mime_type: str, content_b64: str) -> str:
+        """上传附件(内容为base64字符串), 返回可以放进fileAttachments的fileMetadataId"""
+        response = await self.client.post(
+            UPLOAD_FILE_URL,
+            headers=self.headers,
+            json={
+                "fileName": file_name,
+                "fileMimeType": mime_type,
+                "content": content_b64,
+            },
+        )
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"Upload file failed with status {response.status_code}: {response.text[:200]}"
+            )
+        file_id = response.json().get("fileMetadataId")
+        if not file_id:
+            raise RuntimeError(f"Upload file failed: {response.text[:200]}")
+        return file_id
+
     # 为rate_limit请求也添加Cloudflare处理
     async def _get_single_rate_limit(self, request_kind, model_name="grok-3"):
         """Helper method to fetch rate limit for a specific request kind"""
@@ -233,37 +417,63 @@ class GrokClient:
             "remainingQueries": 0,
         }
         try:
-            rate_limit_response = await self.client.post(
-                url, headers=self.headers, json=payload
-            )
+            with proxy_pool.track(self.proxy) as proxy_request:
+                rate_limit_response = await self.client.post(
+                    url, headers=self.headers, json=payload
+                )
+                if proxy_request is not None:
+                    proxy_request.first_byte()
 
             # 检查是否遇到Cloudflare挑战
             if rate_limit_response.status_code == 403 or rate_limit_response.status_code == 503:
                 # 对于curl_cffi，使用text属性
                 if "Just a moment" in rate_limit_response.text or "challenge-running" in rate_limit_response.text:
+                    if proxy_request is not None:
+                        proxy_request.challenge()
                     # 处理Cloudflare挑战
                     success = await self._handle_cloudflare(url)
                     if success:
                         # 重新尝试请求
                         raise Exception("需要重试请求")  # 触发async_retry装饰器
+                    # 挑战页的403不代表cookie失效, 不保留状态码
+                    raise Exception("Cloudflare挑战未通过")
 
-            json_response = rate_limit_response.json()
+            if rate_limit_response.status_code != 200:
+                # 保留状态码, 调用方据此区分cookie失效和额度用完; 错误响应不一定是JSON
+                json_response = {
+                    "windowSizeSeconds": 0,
+                    "remainingQueries": 0,
+                    "statusCode": rate_limit_response.status_code,
+                    "error": rate_limit_response.text[:200],
+                }
+            else:
+                json_response = rate_limit_response.json()
         except Exception as e:
             logger.error(f"获取rate limit时出错: {e}")
-            pass
+            json_response = {**json_response, "error": str(e)}
         logger.debug(json_response)
         return request_kind, json_response
 
-    async def get_rate_limit(self):
-        """Fetch rate limits for all model types concurrently using asyncio.gather"""
-        model_types = ["DEFAULT", "REASONING", "DEEPSEARCH"]
+    async def get_rate_limit(self, model_names: dict[str, str] | None = None):
+        """并发获取各类别的rate limit, 复用同一个session(连接)
+
+        model_names: {requestKind: modelName}, 只探测其中的类别; 默认探测全部类别并使用grok-3
+        """
+        if model_names is None:
+            model_names = {kind: "grok-3" for kind in ["DEFAULT", "REASONING", "DEEPSEARCH"]}
 
         # Use asyncio.gather to run all requests concurrently
         results = await asyncio.gather(
-            *[self._get_single_rate_limit(kind) for kind in model_types]
+            *[
+                self._get_single_rate_limit(kind, model_name)
+                for kind, model_name in model_names.items()
+            ]
         )
 
         # Format results into a dictionary {request_kind: rate_limit_data}
         rate_limits = {kind: data for kind, data in results}
 
-        return rate_limits
\ No newline at end of file
+        return rate_limits
+
+    async def close(self):
+        await self.client.close()
@@ -1,3 +1,9 @@
-BASE_URL = "https://grok.com"
+import os
+
+# 压测时可以指向本地的 benchmarks/mock_grok.py
+BASE_URL = os.environ.get("GROK_BASE_URL", "https://grok.com")
 CHAT_URL = f"{BASE_URL}/rest/app-chat/conversations/new"
+# 在已有的对话中继续发送消息, 需要带上parentResponseId
+CONVERSATION_RESPONSES_URL = f"{BASE_URL}/rest/app-chat/conversations/{{conversation_id}}/responses"
 RATE_LIMIT_URL = f"{BASE_URL}/rest/rate-limits"
+UPLOAD_FILE_URL = f"{BASE_URL}/rest/app-chat/upload-file"
@@ -0,0 +1,112 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Dict, Optional
+
+# GrokClient把上游超时转换成的错误行 {"error": {"code": UPSTREAM_TIMEOUT_CODE, "phase": ...}}
+UPSTREAM_TIMEOUT_CODE = "upstream_timeout"
+
+
+class TimeoutPhase(str, Enum):
+    CONNECT = "connect"
+    FIRST_BYTE = "first_byte"
+    IDLE = "idle"
+    TOTAL = "total"
+
+
+@dataclass(slots=True)
+class GeneratedImageEvent:
+    """图片生成的进度/结果, progress为100且带有base64内容时表示生成完成"""
+
+    image_id: str
+    image_index: int = 0
+    progress: int = 0
+    image_url: Optional[str] = None
+    # 直接引用json解析出的字符串, 不做拷贝
+    image_b64: Optional[str] = None
+
+    @property
+    def completed(self) -> bool:
+        return self.progress >= 100 and bool(self.image_b64)
+
+    @classmethod
+    def from_response(cls, data: Dict[str, Any]) -> "GeneratedImageEvent":
+        return cls(
+            image_id=str(data.get("imageId", "")),
+            image_index=data.get("imageIndex") or 0,
+            progress=data.get("progress") or 0,
+            image_url=data.get("imageUrl"),
+            image_b64=data.get("imageBytes") or data.get("image"),
+        )
+
+
+@dataclass(slots=True)
+class GrokResponseEvent:
+    """一行NDJSON中 result.response 部分的类型化表示"""
+
+    token: str = ""
+    is_thinking: Optional[bool] = None
+    message_step_id: Optional[int] = None
+    message_tag: Optional[str] = None
+    model_response: Optional[Dict[str, Any]] = None
+    error: Optional[Any] = None
+    generated_image: Optional[GeneratedImageEvent] = None
+    # 新建对话时上游先返回一行对话信息; 回复中每行带有这条回复的id, 继续对话时作为parentResponseId
+    conversation_id: Optional[str] = None
+    response_id: Optional[str] = None
+
+    @property
+    def is_rate_limited(self) -> bool:
+        """上游返回额度用完, 如 {"error": {"code": 8, "message": "Too many requests"}}"""
+        if not isinstance(self.error, dict):
+            return False
+        message = str(self.error.get("message", "")).lower()
+        return self.error.get("code") == 8 or "too many requests" in message
+
+    @property
+    def timeout_phase(self) -> Optional[TimeoutPhase]:
+        """上游流超时时返回超时的阶段"""
+        if not isinstance(self.error, dict) or self.error.get("code") != UPSTREAM_TIMEOUT_CODE:
+            return None
+        return TimeoutPhase(self.error.get("phase"))
+
+    @classmethod
+    def from_chunk(cls, token: str, chunk_json: Any) -> "GrokResponseEvent":
+        if not isinstance(chunk_json, dict):
+            return cls(token=token)
+        result = chunk_json.get("result")
+        if not isinstance(result, dict):
+            return cls(token=token, error=chunk_json.get("error"))
+        response = result.get("response")
+        if response is None and (
+            "token" in result or "modelResponse" in result
+        ):
+            # 继续已有对话(/responses)时上游不再嵌套一层response
+            response = result
+        if not isinstance(response, dict):
+            conversation = result.get("conversation")
+            return cls(
+                token=token,
+                error=chunk_json.get("error"),
+                conversation_id=(
+                    conversation.get("conversationId")
+                    if isinstance(conversation, dict)
+                    else None
+                ),
+            )
+        model_response = response.get("modelResponse")
+        image_response = response.get("streamingImageGenerationResponse")
+        return cls(
+            token=token,
+            is_thinking=response.get("isThinking"),
+            message_step_id=response.get("messageStepId"),
+            message_tag=response.get("messageTag"),
+            model_response=model_response,
+            error=chunk_json.get("error"),
+            generated_image=(
+                GeneratedImageEvent.from_response(image_response)
+                if isinstance(image_response, dict)
+                else None
+            ),
+            response_id=response.get("responseId")
+            or (model_response.get("responseId") if isinstance(model_response, dict) else None),
+        )
@@ -0,0 +1,297 @@
+"""
+revgrokapi/revgrok/proxy_pool.py
+
+Spreads upstream traffic over several egress proxies. Each cookie (account) is
+pinned to one proxy so its cf_clearance, which Cloudflare binds to the egress
+IP, stays valid. Per-proxy in-flight count, latency, failure and challenge
+rates are tracked from real requests plus a periodic health check; cookies move
+off a proxy when it goes down, or when it is clearly slower or more challenged
+than the others.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from curl_cffi.requests import AsyncSession, BrowserType
+from loguru import logger
+
+from .configs import BASE_URL
+from ..configs import (PROXY_HEALTH_CHECK_INTERVAL_SECONDS, PROXY_MAX_IN_FLIGHT,
+                       PROXY_REBALANCE_MIN_SECONDS)
+from ..runtime_settings import RuntimeSettings, runtime_settings
+
+# 指数移动平均的系数, 越大越看重最近的请求
+EWMA_ALPHA = 0.2
+# 连续失败这么多次后标记为不可用, 等健康检查通过再恢复
+MAX_CONSECUTIVE_FAILURES = 3
+# 延迟超过最快代理的这么多倍、或挑战/失败率超过阈值时视为变差, 绑定的cookie会迁走
+SLOW_FACTOR = 3.0
+MAX_CHALLENGE_RATE = 0.3
+MAX_FAILURE_RATE = 0.5
+HEALTH_CHECK_TIMEOUT_SECONDS = 10
+
+
+def _ewma(current: float, sample: float) -> float:
+    return current + EWMA_ALPHA * (sample - current)
+
+
+def _ewma_latency(current: float, sample: float) -> float:
+    # 还没有延迟数据时直接使用第一次的值
+    return sample if current == 0 else _ewma(current, sample)
+
+
+@dataclass(slots=True)
+class ProxyStats:
+    url: str
+    healthy: bool = True
+    in_flight: int = 0
+    peak_in_flight: int = 0
+    requests: int = 0
+    failures: int = 0
+    challenges: int = 0
+    consecutive_failures: int = 0
+    latency_ms: float = 0.0
+    failure_rate: float = 0.0
+    challenge_rate: float = 0.0
+    assigned: int = 0
+    last_checked: Optional[float] = None
+
+    def score(self) -> float:
+        """越小越好: 延迟, 按负载、挑战率和失败率放大"""
+        return (
+            (self.latency_ms + 1)
+            * (1 + self.in_flight / PROXY_MAX_IN_FLIGHT)
+            * (1 + 4 * self.challenge_rate)
+            * (1 + 4 * self.failure_rate)
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "challenges": self.challenges,
+            "latency_ms": round(self.latency_ms, 1),
+            "failure_rate": round(self.failure_rate, 3),
+            "challenge_rate": round(self.challenge_rate, 3),
+            "assigned": self.assigned,
+            "last_checked": self.last_checked,
+        }
+
+
+class ProxyRequest:
+    """一次经过代理的请求, 由ProxyPool.track创建"""
+
+    __slots__ = ("stats", "start", "latency_ms", "challenged")
+
+    def __init__(self, stats: ProxyStats):
+        self.stats = stats
+        self.start = time.perf_counter()
+        self.latency_ms: Optional[float] = None
+        self.challenged = False
+
+    def first_byte(self):
+        """收到响应头时调用, 记录的延迟不包含流式输出的时间"""
+        if self.latency_ms is None:
+            self.latency_ms = (time.perf_counter() - self.start) * 1000
+
+    def challenge(self):
+        self.challenged = True
+
+
+class ProxyPool:
+    def __init__(self, proxies: List[str]):
+        self._stats: Dict[str, ProxyStats] = {url: ProxyStats(url) for url in proxies}
+        # account_key -> (代理, 绑定时间)
+        self._pins: Dict[str, tuple[str, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.rebalanced = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._stats)
+
+    def _degraded(self, stats: ProxyStats, best_latency: float) -> bool:
+        return (
+            stats.challenge_rate > MAX_CHALLENGE_RATE
+            or stats.failure_rate > MAX_FAILURE_RATE
+            or (best_latency > 0 and stats.latency_ms > SLOW_FACTOR * best_latency)
+        )
+
+    def _best_latency(self) -> float:
+        return min(
+            (stats.latency_ms for stats in self._stats.values() if stats.healthy),
+            default=0.0,
+        )
+
+    def _choose(self, exclude: Optional[str] = None) -> str:
+        """在没有变差的可用代理中选绑定账号最少的, 相同时选分数最好的"""
+        healthy = [stats for stats in self._stats.values() if stats.healthy]
+        best_latency = self._best_latency()
+        candidates = (
+            [stats for stats in healthy if not self._degraded(stats, best_latency)]
+            # 全部不可用时仍然要选一个, 不能让请求无路可走
+            or healthy
+            or list(self._stats.values())
+        )
+        candidates = [stats for stats in candidates if stats.url != exclude] or candidates
+        best = min(candidates, key=lambda stats: (stats.assigned, stats.score()))
+        return best.url
+
+    def assign(self, account_key: str) -> Optional[str]:
+        """返回这个账号应该使用的代理, 未配置代理池时返回None"""
+        if not self._stats:
+            return None
+        pinned = self._pins.get(account_key)
+        if pinned is not None:
+            url, pinned_at = pinned
+            stats = self._stats.get(url)
+            if stats is not None and stats.healthy:
+                if time.time() - pinned_at < PROXY_REBALANCE_MIN_SECONDS:
+                    return url
+                if not self._degraded(stats, self._best_latency()):
+                    return url
+            new_url = self._choose(exclude=url)
+            if new_url == url:
+                return url
+            logger.info(f"Proxy rebalance: {account_key[:8]}... {url} -> {new_url}")
+            self.rebalanced += 1
+            self.release(account_key)
+        else:
+            new_url = self._choose()
+        self._pins[account_key] = (new_url, time.time())
+        self._stats[new_url].assigned += 1
+        return new_url
+
+    def set_proxies(self, proxies: List[str]):
+        """替换代理列表, 保留仍在列表中的代理的统计; 绑定到被移除代理的账号下次使用时重新分配"""
+        self._stats = {url: self._stats.get(url) or ProxyStats(url) for url in proxies}
+        for account_key, (url, _) in list(self._pins.items()):
+            if url not in self._stats:
+                del self._pins[account_key]
+        logger.info(f"Proxy pool updated: {len(self._stats)} proxies")
+
+    def on_settings_changed(self, old: RuntimeSettings, new: RuntimeSettings):
+        if old.proxies == new.proxies:
+            return
+        self.set_proxies(new.proxies)
+        if not self._stats:
+            return
+        # 新加入的代理立即检查一次
+        asyncio.create_task(self.check_all())
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def release(self, account_key: str):
+        pinned = self._pins.pop(account_key, None)
+        if pinned is not None and pinned[0] in self._stats:
+            self._stats[pinned[0]].assigned -= 1
+
+    @contextmanager
+    def track(self, proxy: Optional[str]):
+        """统计一次请求: 并发数、首字节延迟、失败和Cloudflare挑战"""
+        stats = self._stats.get(proxy) if proxy else None
+        if stats is None:
+            yield None
+            return
+        request = ProxyRequest(stats)
+        stats.in_flight += 1
+        stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        ok = False
+        try:
+            yield request
+            ok = True
+        except (GeneratorExit, asyncio.CancelledError):
+            # 下游断开或取消, 不算代理的问题
+            ok = True
+            raise
+        finally:
+            stats.in_flight -= 1
+            self._record(stats, request, ok)
+
+    def _record(self, stats: ProxyStats, request: ProxyRequest, ok: bool):
+        stats.requests += 1
+        if request.latency_ms is not None:
+            stats.latency_ms = _ewma_latency(stats.latency_ms, request.latency_ms)
+        stats.challenge_rate = _ewma(stats.challenge_rate, 1.0 if request.challenged else 0.0)
+        if request.challenged:
+            stats.challenges += 1
+        stats.failure_rate = _ewma(stats.failure_rate, 0.0 if ok else 1.0)
+        if ok:
+            stats.consecutive_failures = 0
+            return
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        if stats.healthy and stats.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            stats.healthy = False
+            logger.warning(f"Proxy {stats.url} marked unhealthy after {stats.consecutive_failures} failures")
+
+    async def check(self, stats: ProxyStats):
+        start = time.perf_counter()
+        try:
+            async with AsyncSession(
+                impersonate=BrowserType.chrome120,
+                proxies={"http": stats.url, "https": stats.url},
+                timeout=HEALTH_CHECK_TIMEOUT_SECONDS,
+            ) as session:
+                response = await session.get(f"{BASE_URL}/")
+            healthy = response.status_code < 500
+            challenged = "Just a moment" in response.text or "challenge-running" in response.text
+        except Exception as e:
+            logger.warning(f"Proxy {stats.url} health check failed: {e}")
+            healthy = False
+        stats.last_checked = time.time()
+        if healthy:
+            stats.latency_ms = _ewma_latency(
+                stats.latency_ms, (time.perf_counter() - start) * 1000
+            )
+            # 变差的代理分不到新流量, 挑战/失败率只能靠健康检查回落, 否则会一直被排除
+            stats.challenge_rate = _ewma(stats.challenge_rate, 1.0 if challenged else 0.0)
+            stats.failure_rate = _ewma(stats.failure_rate, 0.0)
+            stats.consecutive_failures = 0
+            if not stats.healthy:
+                logger.info(f"Proxy {stats.url} recovered")
+            stats.healthy = True
+        else:
+            stats.healthy = False
+
+    async def check_all(self):
+        await asyncio.gather(*[self.check(stats) for stats in self._stats.values()])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PROXY_HEALTH_CHECK_INTERVAL_SECONDS)
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Proxy health check failed: {e}")
+
+    async def start(self):
+        if self._stats and self._task is None:
+            # 启动时先检查一次, 避免把cookie绑定到不可用的代理上
+            await self.check_all()
+            healthy = sum(stats.healthy for stats in self._stats.values())
+            logger.info(f"Proxy pool: {healthy}/{len(self._stats)} proxies healthy")
+            self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "pinned_accounts": len(self._pins),
+            "rebalanced": self.rebalanced,
+            "proxies": [stats.to_dict() for stats in self._stats.values()],
+        }
+
+
+proxy_pool = ProxyPool(runtime_settings.current.proxies)
+runtime_settings.add_listener(proxy_pool.on_settings_changed)
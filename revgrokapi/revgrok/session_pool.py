@@ -0,0 +1,76 @@
+import asyncio
+from collections import OrderedDict
+
+from loguru import logger
+
+from .client import GrokClient
+from .proxy_pool import proxy_pool
+from ..configs import GROK_CLIENT_POOL_SIZE
+from ..utils.cookie_utils import extract_cookie_value
+
+# 被淘汰的client可能还有进行中的流式请求, 等这么久之后再关闭
+EVICTED_CLOSE_DELAY_SECONDS = 660
+
+
+class GrokClientPool:
+    """每个cookie复用一个GrokClient(及其curl session), 复用连接并保留更新过的cf_clearance"""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._clients: "OrderedDict[str, GrokClient]" = OrderedDict()
+        # 已淘汰、等待延迟关闭的client, 停机时一起关闭
+        self._retired: set = set()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def get(self, cookie: str) -> GrokClient:
+        # 代理池把账号固定到一个出口, 出口变了(代理不可用/被迁移)就换新的client
+        proxy = proxy_pool.assign(extract_cookie_value(cookie, "sso") or cookie)
+        client = self._clients.get(cookie)
+        if client is not None:
+            if client.proxy == proxy:
+                self._clients.move_to_end(cookie)
+                return client
+            del self._clients[cookie]
+            self._close_later(client)
+        client = self._clients[cookie] = GrokClient(cookie, proxy=proxy)
+        if len(self._clients) > self.max_size:
+            _, evicted = self._clients.popitem(last=False)
+            self._close_later(evicted)
+        return client
+
+    def discard(self, cookie: str):
+        """cookie被删除/修改后丢弃对应的client"""
+        client = self._clients.pop(cookie, None)
+        if client is not None:
+            self._close_later(client)
+        proxy_pool.release(extract_cookie_value(cookie, "sso") or cookie)
+
+    def _close_later(self, client: GrokClient):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._retired.add(client)
+
+        def close():
+            if client in self._retired:
+                self._retired.discard(client)
+                loop.create_task(client.close())
+
+        loop.call_later(EVICTED_CLOSE_DELAY_SECONDS, close)
+
+    async def close_all(self):
+        clients = [*self._clients.values(), *self._retired]
+        self._clients.clear()
+        self._retired.clear()
+        results = await asyncio.gather(
+            *[client.close() for client in clients], return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to close grok client: {result}")
+
+
+grok_client_pool = GrokClientPool(GROK_CLIENT_POOL_SIZE)
@@ -1,5 +1,7 @@
-import httpx
-from fake_useragent import UserAgent
+import json
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Mapping, Sequence
 
 
 def get_default_user_agent():
@@ -7,6 +9,9 @@ def get_default_user_agent():
 
 
 def get_random_user_agent():
+    # 只在需要时导入, fake_useragent加载时要读取整个UA数据文件
+    from fake_useragent import UserAgent
+
     ua = UserAgent()
 
     # 随机生成一个User-Agent
@@ -22,10 +27,12 @@ def get_default_chat_payload():
         "fileAttachments": [],
         "imageAttachments": [],
         "disableSearch": False,
-        "enableImageGeneration": True,
-        "returnImageBytes": True,
+        # 图片生成默认关闭, 上游不会在流中夹带大段的base64图片;
+        # 需要生成图片的模型通过ModelSpec.payload_overrides打开
+        "enableImageGeneration": False,
+        "returnImageBytes": False,
         "returnRawGrokInXaiRequest": False,
-        "enableImageStreaming": True,
+        "enableImageStreaming": False,
         "imageGenerationCount": 2,
         "forceConcise": False,
         "toolOverrides": {
@@ -43,3 +50,130 @@ def get_default_chat_payload():
         "deepsearchPreset": "",  #     "deepsearchPreset": "default",
         "isReasoning": False,
     }
+
+
+class ChatPayloadTemplate:
+    """预先序列化好的chat payload, 只有message/fileAttachments字段在每次请求时填入.
+
+    payload中其余部分被编码成固定的字节串片段, render 时只需要转义prompt本身,
+    不再重建/更新/序列化整个字典.
+    """
+
+    __slots__ = ("_parts", "_slots")
+
+    _MESSAGE_SENTINEL = "__REVGROK_MESSAGE_PLACEHOLDER__"
+    _ATTACHMENTS_SENTINEL = "__REVGROK_ATTACHMENTS_PLACEHOLDER__"
+    _EMPTY_ATTACHMENTS = b"[]"
+
+    def __init__(self, payload: Mapping):
+        payload = dict(payload)
+        payload["message"] = self._MESSAGE_SENTINEL
+        payload["fileAttachments"] = self._ATTACHMENTS_SENTINEL
+        encoded = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        markers = sorted(
+            (encoded.index(json.dumps(sentinel)), json.dumps(sentinel), slot)
+            for sentinel, slot in (
+                (self._MESSAGE_SENTINEL, "message"),
+                (self._ATTACHMENTS_SENTINEL, "fileAttachments"),
+            )
+        )
+        parts = []
+        slots = []
+        position = 0
+        for index, marker, slot in markers:
+            parts.append(encoded[position:index].encode("utf-8"))
+            slots.append(slot)
+            position = index + len(marker)
+        parts.append(encoded[position:].encode("utf-8"))
+        self._parts = tuple(parts)
+        self._slots = tuple(slots)
+
+    @staticmethod
+    def _encode_prompt(prompt: str) -> bytes:
+        if prompt.isascii():
+            return json.dumps(prompt).encode("ascii")
+        try:
+            # 非ascii字符直接按utf-8发送, 比 \uXXXX 转义体积小一半
+            return json.dumps(prompt, ensure_ascii=False).encode("utf-8")
+        except UnicodeEncodeError:
+            # 含有孤立的代理字符时退回到ascii转义
+            return json.dumps(prompt).encode("ascii")
+
+    def render(
+        self,
+        prompt: str,
+        file_attachments: Sequence[str] = (),
+        extra_fields: Mapping | None = None,
+    ) -> bytes:
+        """extra_fields为每次请求都不同的少量字段(如parentResponseId), 追加在末尾, 不进入模板缓存"""
+        values = {
+            "message": self._encode_prompt(prompt),
+            "fileAttachments": (
+                json.dumps(list(file_attachments)).encode("utf-8")
+                if file_attachments
+                else self._EMPTY_ATTACHMENTS
+            ),
+        }
+        chunks = [self._parts[0]]
+        for slot, part in zip(self._slots, self._parts[1:]):
+            chunks.append(values[slot])
+            chunks.append(part)
+        if extra_fields:
+            # 最后一个片段以payload的 "}" 结尾
+            chunks[-1] = chunks[-1][:-1]
+            for key, value in extra_fields.items():
+                chunks.append(b"," + json.dumps(key).encode("utf-8") + b":")
+                chunks.append(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+            chunks.append(b"}")
+        return b"".join(chunks)
+
+
+@lru_cache(maxsize=256)
+def get_chat_payload_template(
+    model: str,
+    reasoning: bool = False,
+    deepsearch_preset: str = "",
+    payload_overrides_json: str = "",
+) -> ChatPayloadTemplate:
+    """按 (模型, 推理, deepsearch, 覆盖字段) 缓存payload模板"""
+    payload = get_default_chat_payload()
+    if payload_overrides_json:
+        payload.update(json.loads(payload_overrides_json))
+    payload.update(
+        {
+            "modelName": model,
+            "isReasoning": reasoning,
+            "deepsearchPreset": deepsearch_preset,
+        }
+    )
+    return ChatPayloadTemplate(payload)
+
+
+@lru_cache(maxsize=1024)
+def get_default_headers(cookie: str, user_agent: str) -> Mapping[str, str]:
+    """每个cookie一份的只读请求头"""
+    return MappingProxyType(
+        {
+            "Accept": "*/*",
+            "Accept-Encoding": "gzip, deflate, br",
+            "Accept-Language": "en-US,en;q=0.9",
+            "Content-Type": "application/json",
+            "Cookie": cookie,
+            "Origin": "https://grok.com",
+            "Referer": "https://grok.com/",
+            "Sec-Ch-Ua": '"Not A(Brand";v="99", "Google Chrome";v="121", "Chromium";v="121"',
+            "Sec-Ch-Ua-Mobile": "?0",
+            "Sec-Ch-Ua-Platform": '"Windows"',
+            "Sec-Fetch-Dest": "empty",
+            "Sec-Fetch-Mode": "cors",
+            "Sec-Fetch-Site": "same-origin",
+            "User-Agent": user_agent,
+        }
+    )
+
+
+@lru_cache(maxsize=1024)
+def get_page_headers(cookie: str, user_agent: str) -> Mapping[str, str]:
+    """访问页面(处理Cloudflare)时使用的请求头, 不带Content-Type"""
+    headers = get_default_headers(cookie, user_agent)
+    return MappingProxyType({k: v for k, v in headers.items() if k != "Content-Type"})
@@ -1,10 +1,26 @@
 from fastapi import APIRouter
 
+from revgrokapi.openai_api.batch_router import router as batch_router
 from revgrokapi.openai_api.openai_api_router import router as openai_api_router
+from revgrokapi.routers.api_key.router import router as api_key_router
 from revgrokapi.routers.cookie.router import router as cookie_router
+from revgrokapi.routers.document.router import router as document_router
 from revgrokapi.routers.health.router import router as health_router
+from revgrokapi.routers.image.router import router as image_router
+from revgrokapi.routers.proxy.router import router as proxy_router
+from revgrokapi.routers.settings.router import router as settings_router
+from revgrokapi.routers.trace.router import router as trace_router
+from revgrokapi.routers.usage.router import router as usage_router
 
 router = APIRouter(prefix="/api/v1")
 router.include_router(cookie_router, prefix="/cookie", tags=["cookie"])
 router.include_router(health_router, prefix="/health", tags=["health"])
 router.include_router(openai_api_router, prefix="/openai", tags=["openai"])
+router.include_router(batch_router, prefix="/openai", tags=["openai"])
+router.include_router(api_key_router, prefix="/api-key", tags=["api-key"])
+router.include_router(document_router, prefix="/document", tags=["document"])
+router.include_router(image_router, prefix="/images", tags=["image"])
+router.include_router(trace_router, prefix="/trace", tags=["trace"])
+router.include_router(proxy_router, prefix="/proxy", tags=["proxy"])
+router.include_router(settings_router, prefix="/settings", tags=["settings"])
+router.include_router(usage_router, prefix="/usage", tags=["usage"])
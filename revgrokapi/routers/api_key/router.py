@@ -0,0 +1,104 @@
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel
+
+from revgrokapi.models.api_key_models import ApiKey
+from revgrokapi.quota import api_key_manager
+from revgrokapi.utils.auth_utils import verify_admin_api_key
+
+
+class ApiKeyCreateRequest(BaseModel):
+    key: Optional[str] = None
+    name: str = ""
+    is_active: bool = True
+    requests_per_minute: int = 0
+    tokens_per_minute: int = 0
+    request_quota: int = 0
+    token_quota: int = 0
+
+
+class ApiKeyUpdateRequest(BaseModel):
+    name: Optional[str] = None
+    is_active: Optional[bool] = None
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    request_quota: Optional[int] = None
+    token_quota: Optional[int] = None
+
+
+class ApiKeyResponse(BaseModel):
+    id: int
+    key: str
+    name: str
+    is_active: bool
+    requests_per_minute: int
+    tokens_per_minute: int
+    request_quota: int
+    token_quota: int
+    used_requests: int
+    used_prompt_tokens: int
+    used_completion_tokens: int
+
+
+router = APIRouter(dependencies=[Depends(verify_admin_api_key)])
+
+
+@router.post("/", response_model=ApiKeyResponse, status_code=status.HTTP_201_CREATED)
+async def create_api_key(api_key_in: ApiKeyCreateRequest):
+    data = api_key_in.model_dump()
+    data["key"] = data["key"] or api_key_manager.generate_key()
+    try:
+        api_key = await ApiKey.create_item(**data)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Could not create api key: {str(e)}",
+        )
+    api_key_manager.upsert(api_key)
+    return await api_key.to_dict()
+
+
+@router.get("/", response_model=List[ApiKeyResponse])
+async def list_api_keys(skip: int = 0, limit: int = 100):
+    api_keys = await ApiKey.get_multi(skip=skip, limit=limit)
+    return [await api_key.to_dict() for api_key in api_keys]
+
+
+@router.get("/usage", response_model=List[Dict])
+async def get_api_key_usage():
+    """
+    获取每个api key的实时用量(包含尚未落库的部分)和令牌桶余量
+    """
+    return api_key_manager.usage()
+
+
+@router.put("/{key_id}", response_model=ApiKeyResponse)
+async def update_api_key(key_id: int, api_key_in: ApiKeyUpdateRequest):
+    api_key = await ApiKey.get_by_id(key_id)
+    if not api_key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Api key with ID {key_id} not found",
+        )
+    update_data = {k: v for k, v in api_key_in.model_dump().items() if v is not None}
+    if not update_data:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="No valid fields to update"
+        )
+    # 只更新配置字段, 不覆盖flush写入的用量计数
+    await ApiKey.filter(id=key_id).update(**update_data)
+    api_key = await ApiKey.get_by_id(key_id)
+    api_key_manager.upsert(api_key)
+    return await api_key.to_dict()
+
+
+@router.delete("/{key_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_api_key(key_id: int):
+    deleted = await ApiKey.delete_by_id(key_id)
+    if not deleted:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Api key with ID {key_id} not found",
+        )
+    api_key_manager.remove(key_id)
@@ -1,16 +1,27 @@
+import json
 from datetime import datetime
 from typing import Any, Dict, List, Optional, TypeVar
 from loguru import logger
 
 from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from tortoise import Model, fields
 from tortoise.expressions import Q
 
-from revgrokapi.models.cookie_models import (Cookie, CookieQueries, CookieType,
-                                             QueryCategory)
+from revgrokapi.models.cookie_models import (Cookie, CookieQueries,
+                                             CookieStatus, CookieType,
+                                             QueryCategory, hash_cookie)
 from revgrokapi.periodic_checks.clients_limit_checks import \
-    __check_grok_clients_limits
+    check_grok_clients_limits
+from revgrokapi.periodic_checks.cookie_validation import cookie_validator
+from revgrokapi.periodic_checks.rate_limit_probe import rate_limit_prober
+from revgrokapi.periodic_checks.window_recovery import \
+    window_recovery_scheduler
+from revgrokapi.pool import cookie_pool
+from revgrokapi.quota.cookie_health import cookie_health
+from revgrokapi.revgrok import grok_client_pool
+from revgrokapi.utils.cookie_utils import is_well_formed_sso_cookie
 
 
 # Pydantic schemas for API request/response models
@@ -32,6 +43,8 @@ class CookieUpdateRequest(BaseModel):
 
 class CookieResponse(CookieBase):
     id: int
+    status: CookieStatus = CookieStatus.ACTIVE
+    invalid_count: int = 0
     created_at: datetime
     updated_at: datetime
 
@@ -57,40 +70,103 @@ class CookieQueryValuesResponse(BaseModel):
     queries: Dict[str, float]
 
 
+class CookiePageResponse(BaseModel):
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[int] = None
+
+
+# 导出时每批从数据库读取的cookie数
+EXPORT_BATCH_SIZE = 1000
+
+
+def parse_field_names(field_names: Optional[str]) -> Optional[List[str]]:
+    """"id,account,cookie_type" -> ["id", "account", "cookie_type"], 校验字段名"""
+    if not field_names:
+        return None
+    names = [name.strip() for name in field_names.split(",") if name.strip()]
+    try:
+        return Cookie.check_fields(names)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 # FastAPI router for RESTful endpoints
 router = APIRouter()
 
 
-@router.post("/", response_model=List[CookieResponse], status_code=status.HTTP_201_CREATED)
-async def create_cookie(cookie_in: CookieCreateRequest):
+def check_cookie_format(cookie: str):
+    if not is_well_formed_sso_cookie(cookie):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Malformed cookie, expected sso=<token>",
+        )
+
+
+async def validate_imported(cookies: List[Cookie]) -> List[Cookie]:
+    """导入后立即探测, 写入初始权重; 返回重新读出的cookie(带上有效性)"""
+    if not cookies:
+        return cookies
+    await cookie_pool.sync(cookie.id for cookie in cookies)
+    summary = await cookie_validator.validate(cookies)
+    logger.info(f"Validated {len(cookies)} imported cookies: {summary}")
+    return await Cookie.filter(id__in=[cookie.id for cookie in cookies]).order_by("id")
+
+
+@router.post("/", response_model=CookieResponse, status_code=status.HTTP_201_CREATED)
+async def create_cookie(cookie_in: CookieCreateRequest, validate: bool = True):
+    """validate=true时导入后立即探测额度, 不用等下一次刷新就有权重"""
+    check_cookie_format(cookie_in.cookie)
     try:
         cookie = await Cookie.create_item(**cookie_in.model_dump())
-        return cookie
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Could not create cookie: {str(e)}",
         )
+    if validate:
+        (cookie,) = await validate_imported([cookie])
+    else:
+        await cookie_pool.sync([cookie.id])
+    return cookie
 
 
 
 @router.post("/batch_upload", response_model=List[CookieResponse], status_code=status.HTTP_201_CREATED)
-async def create_cookie(cookie: str, cookie_type: CookieType, account: str):
+async def create_cookie(cookie: str, cookie_type: CookieType, account: str, validate: bool = True):
+    """每行 account----password----sso值; 格式不对的跳过, validate=true时导入后并发探测"""
     cookie_str = cookie
     cookie_str = cookie_str.strip()
     cookie_strs = cookie_str.split()
     cookies = []
     accounts = []
-    types = [cookie_type] * len(cookie_strs)
 
     for _cookie_str in cookie_strs:
         logger.debug(_cookie_str)
-        account, password, raw_cookie = _cookie_str.split("----")
+        parts = _cookie_str.split("----")
+        if len(parts) != 3:
+            logger.warning(f"Skip malformed line: {_cookie_str[:50]}")
+            continue
+        account, password, raw_cookie = parts
         cookie = f"sso={raw_cookie}"
+        if not is_well_formed_sso_cookie(cookie):
+            logger.warning(f"Skip malformed cookie of account {account}")
+            continue
         cookies.append(cookie)
         accounts.append(account)
+    types = [cookie_type] * len(cookies)
+    # 一次查询找出已经存在的cookie, 不再依赖插入时的唯一约束报错
+    existing = await Cookie.existing_hashes(cookies)
     response = []
     for cookie, account, cookie_type in zip(cookies, accounts, types):
+        if hash_cookie(cookie) in existing:
+            logger.info(f"Skip existing cookie of account {account}")
+            continue
         try:
             cookie = await Cookie.create_item(cookie=cookie, cookie_type=cookie_type, account=account)
             response.append(cookie)
@@ -101,6 +177,10 @@ async def create_cookie(cookie: str, cookie_type: CookieType, account: str):
             # )
             from traceback import format_exc
             logger.error(f"Error creating cookie: {format_exc()}")
+    if validate:
+        response = await validate_imported(response)
+    else:
+        await cookie_pool.sync(cookie.id for cookie in response)
     return response
 
     # try:
@@ -120,12 +200,13 @@ async def get_all_cookies_with_queries():
     """
     # 获取所有cookie
     all_cookies = await Cookie.get_multi()
+    # 一次查询取出这些cookie的所有类别权重
+    weights_by_id = await CookieQueries.get_weights_by_cookie_ids(
+        cookie.id for cookie in all_cookies
+    )
     result = []
 
     for cookie in all_cookies:
-        # 获取该cookie的所有查询类别权重
-        query_records = await CookieQueries.filter(cookie_ref=cookie).all()
-
         # 将查询类别权重转换为字典
         queries = {}
         for category in QueryCategory:
@@ -133,8 +214,7 @@ async def get_all_cookies_with_queries():
             queries[category.value] = 0
 
         # 更新实际值
-        for record in query_records:
-            queries[record.category.value] = record.queries_weight
+        queries.update(weights_by_id.get(cookie.id, {}))
 
         # 构建响应对象
         cookie_data = {
@@ -149,6 +229,67 @@ async def get_all_cookies_with_queries():
     return result
 
 
+@router.get("/page", response_model=CookiePageResponse)
+async def get_cookie_page(
+    cursor: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cookie_type: Optional[CookieType] = None,
+    field_names: Optional[str] = Query(
+        None, alias="fields", description="只返回这些字段, 如 id,account,cookie_type"
+    ),
+):
+    """按id倒序的游标分页, 用上一页返回的next_cursor取下一页"""
+    filters = {"cookie_type": cookie_type} if cookie_type else {}
+    # 默认不返回cookie文本, 需要时在fields中指定
+    selected = parse_field_names(field_names) or [
+        "id",
+        "account",
+        "cookie_type",
+        "created_at",
+        "updated_at",
+    ]
+    items, next_cursor = await Cookie.get_page(
+        cursor=cursor, limit=limit, fields=selected, **filters
+    )
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@router.get("/export")
+async def export_cookies(
+    cookie_type: Optional[CookieType] = None,
+    field_names: Optional[str] = Query(None, alias="fields"),
+    weights: bool = True,
+):
+    """以NDJSON流式导出整个cookie池(每行一个cookie, 附带各类别权重),
+    按批读取, 内存中只保留一批"""
+    filters = {"cookie_type": cookie_type} if cookie_type else {}
+    selected = parse_field_names(field_names) or [
+        "id",
+        "cookie",
+        "cookie_type",
+        "account",
+        "created_at",
+        "updated_at",
+    ]
+
+    async def generate():
+        async for rows in Cookie.iterate_batches(
+            EXPORT_BATCH_SIZE, fields=selected, **filters
+        ):
+            if weights:
+                weights_by_id = await CookieQueries.get_weights_by_cookie_ids(
+                    row["id"] for row in rows
+                )
+            lines = []
+            for row in rows:
+                if weights:
+                    row["queries"] = weights_by_id.get(row["id"], {})
+                lines.append(json.dumps(row, ensure_ascii=False, default=_json_default))
+            yield "\n".join(lines) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
 @router.get("/{cookie_id}", response_model=CookieResponse)
 async def get_cookie(cookie_id: int):
     cookie = await Cookie.get_by_id(cookie_id)
@@ -166,18 +307,22 @@ async def list_cookies(
     limit: int = 100,
     cookie_type: Optional[CookieType] = None,
     search: Optional[str] = None,
+    fuzzy: bool = False,
 ):
+    """search默认按完整cookie或账号精确查找(走索引); fuzzy=true时按账号子串搜索"""
     filters = {}
     if cookie_type:
         filters["cookie_type"] = cookie_type
 
-    if search:
+    if search and fuzzy:
         cookies = await Cookie.search_items(
-            search_fields=["cookie", "account"],
+            search_fields=["account"],
             search_term=search,
             skip=skip,
             limit=limit,
         )
+    elif search:
+        cookies = await Cookie.find_by_cookie_or_account(search, skip=skip, limit=limit)
     else:
         cookies = await Cookie.get_multi(skip=skip, limit=limit, **filters)
 
@@ -199,24 +344,110 @@ async def update_cookie(cookie_id: int, cookie_in: CookieUpdateRequest):
             status_code=status.HTTP_400_BAD_REQUEST, detail="No valid fields to update"
         )
 
+    old_cookie = cookie.cookie
+    if update_data.get("cookie", old_cookie) != old_cookie:
+        check_cookie_format(update_data["cookie"])
+        # 换了新的cookie, 之前的失效记录不再适用
+        update_data.update(
+            status=CookieStatus.ACTIVE, invalid_count=0, quarantined_at=None
+        )
     updated_cookie = await cookie.update_item(**update_data)
+    if updated_cookie.cookie != old_cookie:
+        grok_client_pool.discard(old_cookie)
+        rate_limit_prober.forget(cookie_id)
+        cookie_health.forget(cookie_id)
+        # 解除隔离的cookie重新进入池
+        await cookie_pool.sync([cookie_id])
     return updated_cookie
 
 
 @router.delete("/{cookie_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_cookie(cookie_id: int):
-    deleted = await Cookie.delete_by_id(cookie_id)
-    if not deleted:
+    cookie = await Cookie.get_by_id(cookie_id)
+    if not cookie:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Cookie with ID {cookie_id} not found",
         )
+    await cookie.delete_item()
+    cookie_pool.remove([cookie_id])
+    grok_client_pool.discard(cookie.cookie)
+    rate_limit_prober.forget(cookie_id)
+    cookie_health.forget(cookie_id)
 
 
 @router.get("/stats/refresh")
-async def get_refreshed_cookie_stats():
-    await __check_grok_clients_limits()
-    return {"message": "Cookie stats refreshed"}
+async def get_refreshed_cookie_stats(force: bool = False):
+    """在后台刷新所有cookie的剩余额度, 通过 /stats/refresh/{job_id} 查询进度;
+    缓存期内的结果不会重新探测, force=true 时全部重新探测"""
+    return await check_grok_clients_limits(force=force)
+
+
+@router.get("/stats/refresh/{job_id}")
+async def get_refresh_job(job_id: str):
+    job = rate_limit_prober.get_job(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Refresh job {job_id} not found",
+        )
+    return job.to_dict()
+
+
+@router.get("/stats/recovery")
+async def get_window_recovery_stats():
+    """额度用完、等待窗口结束后恢复的cookie"""
+    return {
+        "recovered": window_recovery_scheduler.recovered,
+        "pending": window_recovery_scheduler.pending(),
+    }
+
+
+@router.get("/stats/quarantine")
+async def get_quarantine_stats(limit: int = Query(100, ge=1, le=1000)):
+    """被隔离的cookie(多次探测为401/403)和导入校验、复查的统计"""
+    quarantined = (
+        await Cookie.filter(status=CookieStatus.QUARANTINED)
+        .order_by("-quarantined_at")
+        .limit(limit)
+        .values("id", "account", "cookie_type", "invalid_count", "quarantined_at")
+    )
+    return {**await cookie_validator.stats(), "cookies": quarantined}
+
+
+@router.post("/quarantine/recheck")
+async def recheck_quarantined_cookies():
+    """立即复查所有被隔离的cookie, 恢复有效的"""
+    return await cookie_validator.recheck_quarantined()
+
+
+@router.post("/{cookie_id}/recheck")
+async def recheck_cookie(cookie_id: int):
+    """立即探测一个cookie: 隔离的恢复有效后解除隔离, 正常的记录一次有效性"""
+    cookie = await Cookie.get_by_id(cookie_id)
+    if not cookie:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Cookie with ID {cookie_id} not found",
+        )
+    if cookie.status == CookieStatus.QUARANTINED:
+        result = await cookie_validator.recheck([cookie])
+    else:
+        result = await cookie_validator.validate([cookie])
+    cookie = await Cookie.get_by_id(cookie_id)
+    return {**result, "status": cookie.status.value, "invalid_count": cookie.invalid_count}
+
+
+@router.get("/stats/pool")
+async def get_cookie_pool_stats():
+    """内存中cookie池的大小、占用的内存和各类别的权重总和"""
+    return cookie_pool.stats()
+
+
+@router.get("/stats/health")
+async def get_cookie_health_stats():
+    """上游流超时次数(按阶段)和因此被降低选中权重的cookie"""
+    return cookie_health.stats()
 
 
 @router.get("/stats/total", response_model=CookieTotalCountResponse)
@@ -228,16 +459,7 @@ async def get_total_cookie_stats():
     total_count = await Cookie.get_count()
 
     # 获取各模型的可用量（剩余查询数的总和）
-    model_counts = {}
-
-    for category in QueryCategory:
-        # 获取该模型下所有cookie的记录
-        all_records = await CookieQueries.filter(category=category).all()
-
-        # 计算该类别下所有cookie的权重总和（剩余查询数）
-        total_weight = sum(record.queries_weight for record in all_records)
-
-        model_counts[category.value] = total_weight
+    model_counts = await CookieQueries.total_weights()
 
     return {"total_count": total_count, "model_counts": model_counts}
 
@@ -255,17 +477,7 @@ async def get_cookie_stats_by_type():
         type_count = await Cookie.get_count(cookie_type=cookie_type)
 
         # 获取该类型下各模型的可用量（剩余查询数的总和）
-        model_counts = {}
-        for category in QueryCategory:
-            # 获取该类型和模型下所有cookie的记录
-            all_records = await CookieQueries.filter(
-                cookie_ref__cookie_type=cookie_type, category=category
-            ).all()
-
-            # 计算该类别下所有cookie的权重总和（剩余查询数）
-            total_weight = sum(record.queries_weight for record in all_records)
-
-            model_counts[category.value] = total_weight
+        model_counts = await CookieQueries.total_weights(cookie_type)
 
         result.append(
             {
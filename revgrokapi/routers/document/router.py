@@ -0,0 +1,32 @@
+from typing import List
+
+from fastapi import APIRouter, Depends, UploadFile
+
+from revgrokapi.configs import PROCESS_POOL_WORKERS
+from revgrokapi.utils.auth_utils import verify_admin_api_key
+from revgrokapi.utils.file_utils import (DocumentConverter, conversion_stats,
+                                         document_text_cache)
+
+router = APIRouter(dependencies=[Depends(verify_admin_api_key)])
+
+
+@router.post("/convert")
+async def convert_documents(files: List[UploadFile]):
+    """把上传的文档(文本/pdf/docx)转换成纯文本, 不支持的格式返回null"""
+    results = []
+    for upload_file in files:
+        results.append(await DocumentConverter(upload_file).convert())
+    return results
+
+
+@router.get("/stats")
+async def document_stats():
+    return {
+        "workers": PROCESS_POOL_WORKERS,
+        "cache": {
+            "size": len(document_text_cache),
+            "hits": document_text_cache.hits,
+            "misses": document_text_cache.misses,
+        },
+        "formats": conversion_stats.to_dict(),
+    }
@@ -1,4 +1,7 @@
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from revgrokapi.drain import drain_state
 
 router = APIRouter()
 
@@ -6,3 +9,13 @@ router = APIRouter()
 @router.get("/")
 async def health():
     return {"status": "ok"}
+
+
+@router.get("/ready")
+async def ready():
+    """负载均衡用的readiness, 停机排空期间返回503"""
+    if drain_state.draining:
+        return JSONResponse(
+            status_code=503, content={"status": "draining", **drain_state.stats()}
+        )
+    return {"status": "ready"}
@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import FileResponse, Response
+
+from revgrokapi.utils.image_utils import IMAGE_MEDIA_TYPES, get_image_path
+
+router = APIRouter()
+
+# 文件名就是内容hash, 内容永远不会变化
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@router.get("/{name}")
+async def get_image(name: str, if_none_match: str = Header(None)):
+    path = get_image_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    digest, extension = name.split(".", 1)
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": f'"{digest}"'}
+    if if_none_match and digest in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=IMAGE_MEDIA_TYPES[extension], headers=headers)
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Depends
+
+from revgrokapi.revgrok import proxy_pool
+from revgrokapi.utils.auth_utils import verify_admin_api_key
+
+router = APIRouter(dependencies=[Depends(verify_admin_api_key)])
+
+
+@router.get("/stats")
+async def get_proxy_stats():
+    """各代理的健康状态、并发、延迟、失败/挑战率和绑定的账号数"""
+    return proxy_pool.stats()
+
+
+@router.post("/check")
+async def check_proxies():
+    """立即对所有代理做一次健康检查"""
+    await proxy_pool.check_all()
+    return proxy_pool.stats()
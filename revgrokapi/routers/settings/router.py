@@ -0,0 +1,41 @@
+from typing import Any, Dict
+
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import ValidationError
+
+from revgrokapi.openai_api.batches import batch_runner
+from revgrokapi.openai_api.chat_sessions import chat_session_manager
+from revgrokapi.quota import admission_controller
+from revgrokapi.runtime_settings import runtime_settings
+from revgrokapi.utils.auth_utils import verify_admin_api_key
+
+router = APIRouter(dependencies=[Depends(verify_admin_api_key)])
+
+
+@router.get("/")
+async def get_settings():
+    """当前生效的运行时配置(密钥不返回)"""
+    return {
+        "settings": runtime_settings.current.public_dict(),
+        "admission": admission_controller.stats(),
+        "batches": batch_runner.stats(),
+        "chat_sessions": chat_session_manager.stats(),
+    }
+
+
+@router.patch("/")
+async def update_settings(changes: Dict[str, Any]):
+    """修改部分配置, 校验通过后写入配置文件并立即生效, 不需要重启"""
+    try:
+        settings = await runtime_settings.update(changes)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    return {"settings": settings.public_dict()}
+
+
+@router.post("/reload")
+async def reload_settings():
+    """重新读取环境变量和配置文件"""
+    if not runtime_settings.load():
+        raise HTTPException(status_code=422, detail="Invalid settings file, kept current settings")
+    return {"settings": runtime_settings.current.public_dict()}
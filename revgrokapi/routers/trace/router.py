@@ -0,0 +1,31 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from revgrokapi.openai_api.hedging import chat_hedger
+from revgrokapi.tracing import recent_traces
+from revgrokapi.utils.auth_utils import verify_admin_api_key
+
+router = APIRouter(dependencies=[Depends(verify_admin_api_key)])
+
+
+@router.get("/slowest")
+async def slowest_traces(
+    limit: int = Query(20, ge=1, le=200), name: Optional[str] = None
+):
+    """最近请求中耗时最长的若干个, 带各阶段耗时"""
+    return recent_traces.slowest(limit, name)
+
+
+@router.get("/hedging")
+async def hedging_stats():
+    """对冲请求的次数、胜出次数、预算余额和各模型当前的对冲阈值"""
+    return chat_hedger.stats()
+
+
+@router.get("/{trace_id}")
+async def get_trace(trace_id: str):
+    trace = recent_traces.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Literal, Optional
+
+from fastapi import APIRouter, Depends, Query
+
+from revgrokapi.models.cookie_models import Cookie
+from revgrokapi.models.usage_models import UsageHourly
+from revgrokapi.quota import usage_accounting
+from revgrokapi.utils.auth_utils import verify_admin_api_key
+
+router = APIRouter(dependencies=[Depends(verify_admin_api_key)])
+
+# 最多统计最近这么多小时
+MAX_HOURS = 24 * 90
+
+
+def _since(hours: int) -> datetime:
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    # 包含当前这个小时
+    return now - timedelta(hours=hours - 1)
+
+
+def _summarize(row: Dict[str, Any], hours: int) -> Dict[str, Any]:
+    """在汇总的计数上算出错误率、平均延迟和吞吐"""
+    requests = row["requests"]
+    failed = row["errors"] + row["timeouts"]
+    duration_seconds = row["duration_ms_sum"] / 1000
+    row.update(
+        error_rate=round(failed / requests, 4) if requests else 0.0,
+        avg_ttft_ms=round(row["ttft_ms_sum"] / row["ttft_count"], 1) if row["ttft_count"] else None,
+        avg_duration_ms=round(row["duration_ms_sum"] / requests, 1) if requests else None,
+        # 上游生成的速度: 完成的token数 / 花在这些请求上的时间
+        completion_tokens_per_second=(
+            round(row["completion_tokens"] / duration_seconds, 2) if duration_seconds else None
+        ),
+        requests_per_hour=round(requests / hours, 2),
+    )
+    for field in ("ttft_ms_sum", "duration_ms_sum", "ttft_count"):
+        row.pop(field)
+    return row
+
+
+async def _with_accounts(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    accounts = dict(
+        await Cookie.filter(id__in=[row["cookie_id"] for row in rows]).values_list("id", "account")
+    )
+    for row in rows:
+        # 已经删除的cookie没有账号
+        row["account"] = accounts.get(row["cookie_id"])
+    return rows
+
+
+@router.get("/cookies/top")
+async def top_cookies(
+    hours: int = Query(24, ge=1, le=MAX_HOURS),
+    limit: int = Query(10, ge=1, le=1000),
+    order_by: Literal["requests", "completion_tokens", "prompt_tokens", "errors", "timeouts"] = "requests",
+    category: Optional[str] = None,
+):
+    """最近hours小时内用量最多(或错误最多)的cookie"""
+    await usage_accounting.flush()
+    filters = {"category": category} if category else {}
+    rows = await UsageHourly.aggregate(
+        _since(hours), ["cookie_id"], order_by=order_by, limit=limit, **filters
+    )
+    return await _with_accounts([_summarize(row, hours) for row in rows])
+
+
+@router.get("/models")
+async def model_usage(hours: int = Query(24, ge=1, le=MAX_HOURS)):
+    """每个模型的请求数、错误率、首行延迟和吞吐"""
+    await usage_accounting.flush()
+    rows = await UsageHourly.aggregate(
+        _since(hours), ["model", "category"], order_by="requests"
+    )
+    return [_summarize(row, hours) for row in rows]
+
+
+@router.get("/errors")
+async def error_rates(
+    hours: int = Query(24, ge=1, le=MAX_HOURS),
+    group_by: Literal["cookie", "model"] = "cookie",
+    min_requests: int = Query(10, ge=1),
+    limit: int = Query(20, ge=1, le=1000),
+):
+    """错误率最高的cookie或模型, 请求数少于min_requests的不参与排序"""
+    await usage_accounting.flush()
+    group_field = "cookie_id" if group_by == "cookie" else "model"
+    rows = await UsageHourly.aggregate(_since(hours), [group_field])
+    rows = [_summarize(row, hours) for row in rows if row["requests"] >= min_requests]
+    rows.sort(key=lambda row: row["error_rate"], reverse=True)
+    rows = rows[:limit]
+    if group_by == "cookie":
+        rows = await _with_accounts(rows)
+    return rows
+
+
+@router.get("/hourly")
+async def hourly_usage(
+    hours: int = Query(24, ge=1, le=MAX_HOURS),
+    model: Optional[str] = None,
+    cookie_id: Optional[int] = None,
+):
+    """按小时的用量曲线, 可以只看一个模型或一个cookie"""
+    await usage_accounting.flush()
+    filters = {}
+    if model:
+        filters["model"] = model
+    if cookie_id is not None:
+        filters["cookie_id"] = cookie_id
+    rows = await UsageHourly.aggregate(_since(hours), ["hour"], **filters)
+    rows.sort(key=lambda row: row["hour"])
+    return [_summarize(row, 1) for row in rows]
+
+
+@router.get("/stats")
+async def usage_accounting_stats():
+    """内存中还没写库的汇总行数等"""
+    return usage_accounting.stats()
@@ -0,0 +1,247 @@
+"""
+revgrokapi/runtime_settings.py
+
+Settings that can be tuned under load without a restart (which would drop every
+in-flight SSE stream). Values come from, in increasing priority: the defaults in
+configs.py, `REVGROK_<FIELD>` environment variables, and `RUNTIME_SETTINGS_PATH`
+(a json object with any subset of the fields). The file is watched for changes
+and can be edited through the admin endpoint, e.g.:
+
+    {"chat_retries": 2, "max_concurrent_requests": 200}
+
+Every change is validated as a whole and swapped in atomically; an invalid file
+is logged and ignored. Code that reads a value per use (retry policy, probe
+concurrency, admission) just reads `runtime_settings.current`; stateful parts
+(scheduler interval, proxy list) register a listener.
+"""
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from loguru import logger
+from pydantic import (BaseModel, ConfigDict, Field, ValidationError,
+                      field_validator)
+
+from revgrokapi.configs import (ADMIN_API_KEY,
+                                GROK_CLIENT_LIMIT_CHECKS_INTERVAL_MINUTES,
+                                PROXY_POOL, RATE_LIMIT_PROBE_CONCURRENCY,
+                                RATE_LIMIT_PROBE_TTL_SECONDS,
+                                RUNTIME_SETTINGS_PATH,
+                                RUNTIME_SETTINGS_WATCH_INTERVAL_SECONDS)
+from revgrokapi.utils.async_task_utils import submit_task2event_loop
+from revgrokapi.utils.json_utils import load_json
+
+ENV_PREFIX = "REVGROK_"
+# 接口返回配置时隐藏这些字段的值
+SECRET_FIELDS = {"admin_api_key"}
+
+
+class StreamTimeouts(BaseModel):
+    """上游流式请求各阶段的超时(秒)"""
+
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    # 建立连接(TCP+TLS, 经过代理时包括代理)
+    connect_seconds: float = Field(10, gt=0)
+    # 从发出请求到收到第一行
+    first_byte_seconds: float = Field(30, gt=0)
+    # 收到第一行之后, 相邻两行之间的最长间隔
+    idle_seconds: float = Field(60, gt=0)
+    # 整个流的截止时间
+    total_seconds: float = Field(600, gt=0)
+
+
+def _default_stream_timeouts() -> Dict[str, StreamTimeouts]:
+    # deepsearch会搜索很久, 中间可能长时间没有输出
+    return {
+        "DEFAULT": StreamTimeouts(),
+        "REASONING": StreamTimeouts(),
+        "DEEPSEARCH": StreamTimeouts(
+            first_byte_seconds=60, idle_seconds=180, total_seconds=1800
+        ),
+    }
+
+
+class RuntimeSettings(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    # 定时刷新cookie额度的间隔
+    limit_check_interval_minutes: int = Field(GROK_CLIENT_LIMIT_CHECKS_INTERVAL_MINUTES, ge=1)
+    # 刷新额度时同时探测的cookie数, 探测结果的缓存时间
+    rate_limit_probe_concurrency: int = Field(RATE_LIMIT_PROBE_CONCURRENCY, ge=1)
+    rate_limit_probe_ttl_seconds: float = Field(RATE_LIMIT_PROBE_TTL_SECONDS, ge=0)
+    # 对话(选cookie+请求上游)整体的重试
+    chat_retries: int = Field(4, ge=1)
+    chat_retry_delay_seconds: float = Field(3, ge=0)
+    # 单个GrokClient请求上游的重试(Cloudflare挑战后等)
+    upstream_retries: int = Field(3, ge=1)
+    upstream_retry_delay_seconds: float = Field(2, ge=0)
+    # 图片生成的重试
+    image_retries: int = Field(3, ge=1)
+    image_retry_delay_seconds: float = Field(3, ge=0)
+    # 上游流式请求的超时, 按QueryCategory配置, 没有配置的类别使用默认值
+    stream_timeouts: Dict[str, StreamTimeouts] = Field(
+        default_factory=_default_stream_timeouts
+    )
+    # 代理池, 为空时使用configs.PROXIES
+    proxies: List[str] = Field(default_factory=lambda: list(PROXY_POOL))
+    # 对冲请求: 首行超过该模型最近首行延迟的这个百分位(限制在min/max之间)还没到,
+    # 就换一个cookie再发一个请求, 用先到的那个; 对冲请求数不超过对话请求数的budget_ratio
+    hedge_enabled: bool = False
+    hedge_percentile: float = Field(95, ge=50, le=100)
+    hedge_min_delay_seconds: float = Field(1, ge=0)
+    hedge_max_delay_seconds: float = Field(10, ge=0)
+    hedge_budget_ratio: float = Field(0.05, ge=0, le=1)
+    # 同时进行的对话/图片生成请求数上限, 0表示不限制
+    max_concurrent_requests: int = Field(0, ge=0)
+    # 所有batch同时执行的请求数上限, 0表示暂停batch;
+    # max_concurrent_requests不为0时, batch请求只在并发数低于上限的(1 - reserve)时开始, 给交互请求留出余量
+    batch_max_concurrency: int = Field(8, ge=0)
+    batch_interactive_reserve: float = Field(0.5, ge=0, le=1)
+    # 为空时管理接口关闭, 见 utils/auth_utils.admin_api_key
+    admin_api_key: str = ADMIN_API_KEY
+
+    @field_validator("stream_timeouts", mode="before")
+    @classmethod
+    def _merge_stream_timeouts(cls, value):
+        """只配置了部分类别/字段时, 其余沿用默认值"""
+        if not isinstance(value, dict):
+            return value
+        merged = {
+            category: timeouts.model_dump()
+            for category, timeouts in _default_stream_timeouts().items()
+        }
+        for category, timeouts in value.items():
+            if isinstance(timeouts, StreamTimeouts):
+                timeouts = timeouts.model_dump()
+            if not isinstance(timeouts, dict):
+                return value
+            merged[category] = {**merged.get(category, {}), **timeouts}
+        return merged
+
+    def stream_timeouts_for(self, category: str) -> StreamTimeouts:
+        return self.stream_timeouts.get(category) or StreamTimeouts()
+
+    def public_dict(self) -> Dict[str, Any]:
+        data = self.model_dump()
+        for name in SECRET_FIELDS:
+            data[name] = "***"
+        return data
+
+
+def _env_overrides() -> Dict[str, Any]:
+    overrides = {}
+    for name, field in RuntimeSettings.model_fields.items():
+        value = os.environ.get(f"{ENV_PREFIX}{name.upper()}")
+        if value is None:
+            continue
+        if field.annotation == List[str]:
+            overrides[name] = [item.strip() for item in value.split(",") if item.strip()]
+        elif field.annotation == Dict[str, StreamTimeouts]:
+            # 如 REVGROK_STREAM_TIMEOUTS='{"DEEPSEARCH": {"idle_seconds": 300}}'
+            overrides[name] = json.loads(value)
+        else:
+            # 交给pydantic把字符串转换成对应类型
+            overrides[name] = value
+    return overrides
+
+
+SettingsListener = Callable[[RuntimeSettings, RuntimeSettings], Any]
+
+
+class RuntimeSettingsManager:
+    def __init__(self, path: Path = RUNTIME_SETTINGS_PATH):
+        self.path = path
+        self._current = RuntimeSettings()
+        self._file_overrides: Dict[str, Any] = {}
+        self._mtime: Optional[float] = None
+        self._listeners: List[SettingsListener] = []
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def current(self) -> RuntimeSettings:
+        return self._current
+
+    def add_listener(self, listener: SettingsListener):
+        """listener(old, new), 配置变化后调用"""
+        self._listeners.append(listener)
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return self.path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _build(self, file_overrides: Dict[str, Any]) -> RuntimeSettings:
+        return RuntimeSettings(**{**_env_overrides(), **file_overrides})
+
+    def _apply(self, settings: RuntimeSettings):
+        old, self._current = self._current, settings
+        if old == settings:
+            return
+        changed = [
+            name
+            for name in RuntimeSettings.model_fields
+            if getattr(old, name) != getattr(settings, name)
+        ]
+        logger.info(f"Runtime settings changed: {changed}")
+        for listener in self._listeners:
+            try:
+                listener(old, settings)
+            except Exception as e:
+                logger.error(f"Runtime settings listener {listener} failed: {e}")
+
+    def load(self) -> bool:
+        """读取环境变量和配置文件; 文件内容无效时保留当前配置, 返回是否成功"""
+        self._mtime = self._file_mtime()
+        try:
+            file_overrides = load_json(self.path) if self._mtime is not None else {}
+            if not isinstance(file_overrides, dict):
+                raise ValueError("settings file must contain a json object")
+            settings = self._build(file_overrides)
+        except (ValueError, ValidationError) as e:
+            logger.error(f"Invalid runtime settings in {self.path}, keeping current: {e}")
+            return False
+        self._file_overrides = file_overrides
+        self._apply(settings)
+        return True
+
+    async def update(self, changes: Dict[str, Any]) -> RuntimeSettings:
+        """合并修改并写回配置文件; 校验失败时抛出ValidationError, 配置不变"""
+        async with self._lock:
+            file_overrides = {**self._file_overrides, **changes}
+            settings = self._build(file_overrides)
+            await submit_task2event_loop(self._write, file_overrides)
+            self._file_overrides = file_overrides
+            self._mtime = self._file_mtime()
+            self._apply(settings)
+            return settings
+
+    def _write(self, data: Dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, indent=4, ensure_ascii=False))
+        os.replace(tmp_path, self.path)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(RUNTIME_SETTINGS_WATCH_INTERVAL_SECONDS)
+            if self._file_mtime() != self._mtime:
+                async with self._lock:
+                    self.load()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+runtime_settings = RuntimeSettingsManager()
+runtime_settings.load()
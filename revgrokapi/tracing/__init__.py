@@ -0,0 +1,15 @@
+from .exporters import finish_trace, recent_traces
+from .tracer import (Span, Trace, add_timing, current_trace, span, start_trace,
+                     traced)
+
+__all__ = [
+    "Span",
+    "Trace",
+    "add_timing",
+    "current_trace",
+    "finish_trace",
+    "recent_traces",
+    "span",
+    "start_trace",
+    "traced",
+]
@@ -0,0 +1,103 @@
+"""
+revgrokapi/tracing/exporters.py
+
+Where finished traces go: always into an in-process ring buffer of recent
+traces (queried by the admin endpoint for the slowest ones) and, when
+`TRACING_OTEL_EXPORT` is set and opentelemetry is installed, replayed as
+OpenTelemetry spans with their original timestamps.
+"""
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from revgrokapi.configs import TRACE_BUFFER_SIZE, TRACING_OTEL_EXPORT
+from revgrokapi.tracing.tracer import Trace
+
+
+class RecentTraceBuffer:
+    """最近N个请求的trace, 满了之后丢弃最旧的"""
+
+    def __init__(self, max_traces: int = TRACE_BUFFER_SIZE):
+        self._traces: deque[Trace] = deque(maxlen=max_traces)
+
+    def export(self, trace: Trace):
+        self._traces.append(trace)
+
+    def slowest(self, limit: int = 20, name: Optional[str] = None) -> List[Dict]:
+        traces = [t for t in self._traces if name is None or t.name == name]
+        traces.sort(key=lambda t: t.duration, reverse=True)
+        return [t.to_dict() for t in traces[:limit]]
+
+    def get(self, trace_id: str) -> Optional[Dict]:
+        for trace in self._traces:
+            if trace.trace_id == trace_id:
+                return trace.to_dict()
+        return None
+
+
+class OpenTelemetryExporter:
+    """把结束的trace按原始时间重放成OpenTelemetry span"""
+
+    def __init__(self):
+        from opentelemetry import trace as otel_trace
+
+        self._otel_trace = otel_trace
+        self._tracer = otel_trace.get_tracer("revgrokapi")
+
+    def export(self, trace: Trace):
+        # perf_counter是单调时钟, 换算成墙上时间(ns)
+        offset_ns = int((trace.started_at - trace.start) * 1e9)
+
+        def to_ns(perf_time: float) -> int:
+            return int(perf_time * 1e9) + offset_ns
+
+        root = self._tracer.start_span(
+            trace.name, start_time=to_ns(trace.start), attributes=_otel_attributes(trace.attributes)
+        )
+        otel_spans = {}
+        for span in trace.spans:
+            parent = otel_spans.get(id(span.parent), root)
+            context = self._otel_trace.set_span_in_context(parent)
+            otel_span = self._tracer.start_span(
+                span.name,
+                context=context,
+                start_time=to_ns(span.start),
+                attributes=_otel_attributes(span.attributes),
+            )
+            for name, offset in span.events:
+                otel_span.add_event(name, timestamp=to_ns(span.start + offset))
+            otel_spans[id(span)] = otel_span
+        for span in trace.spans:
+            otel_spans[id(span)].end(end_time=to_ns(span.end or trace.end))
+        root.end(end_time=to_ns(trace.end or time.perf_counter()))
+
+
+def _otel_attributes(attributes: Dict) -> Dict:
+    return {
+        key: value if isinstance(value, (str, bool, int, float)) else str(value)
+        for key, value in attributes.items()
+    }
+
+
+recent_traces = RecentTraceBuffer()
+_exporters = [recent_traces]
+
+if TRACING_OTEL_EXPORT:
+    try:
+        _exporters.append(OpenTelemetryExporter())
+    except ImportError:
+        logger.warning("TRACING_OTEL_EXPORT is set but opentelemetry is not installed")
+
+
+def finish_trace(trace: Optional[Trace]):
+    """结束trace并交给所有exporter, 重复调用无副作用"""
+    if trace is None or trace.end is not None:
+        return
+    trace.finish()
+    for exporter in _exporters:
+        try:
+            exporter.export(trace)
+        except Exception as e:
+            logger.error(f"Failed to export trace {trace.trace_id}: {e}")
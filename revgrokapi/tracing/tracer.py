@@ -0,0 +1,183 @@
+"""
+revgrokapi/tracing/tracer.py
+
+Minimal in-process request tracing. A Trace is bound to the current request via a
+contextvar; `span()` records nested timed sections into it and is a no-op when no
+trace is active, so library code can be instrumented unconditionally. Timings
+that are too fine grained for a span per occurrence (per-token transform, SSE
+write-out) are summed with `add_timing()`.
+"""
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+from revgrokapi.configs import TRACING_ENABLED
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Span:
+    __slots__ = ("name", "start", "end", "parent", "attributes", "events")
+
+    def __init__(self, name: str, start: float, parent: Optional["Span"], attributes):
+        self.name = name
+        self.start = start
+        self.end: Optional[float] = None
+        self.parent = parent
+        self.attributes: Dict[str, Any] = attributes
+        # (name, 相对span开始的秒数)
+        self.events: List[tuple] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add_event(self, name: str):
+        self.events.append((name, time.perf_counter() - self.start))
+
+
+class Trace:
+    def __init__(self, name: str, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attributes: Dict[str, Any] = attributes
+        self.spans: List[Span] = []
+        # 累加型的耗时, 见 add_timing
+        self.timings: Dict[str, float] = {}
+        self._open_spans: List[Span] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def start_span(self, name: str, attributes: Dict[str, Any]) -> Span:
+        parent = self._open_spans[-1] if self._open_spans else None
+        span = Span(name, time.perf_counter(), parent, attributes)
+        self.spans.append(span)
+        self._open_spans.append(span)
+        return span
+
+    def end_span(self, span: Span):
+        span.end = time.perf_counter()
+        # 按对象删除, 交错结束的span(例如gather中的并发上传)也不会弄乱父子关系
+        try:
+            self._open_spans.remove(span)
+        except ValueError:
+            pass
+
+    def add_timing(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+            for span in self._open_spans:
+                span.end = self.end
+            self._open_spans.clear()
+
+    def breakdown(self) -> Dict[str, float]:
+        """每个span名称(同名累加)以及累加型耗时, 单位毫秒"""
+        result: Dict[str, float] = {}
+        for span in self.spans:
+            result[span.name] = result.get(span.name, 0.0) + span.duration * 1000
+        for name, seconds in self.timings.items():
+            result[name] = result.get(name, 0.0) + seconds * 1000
+        return result
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头"""
+        entries = [
+            f"{name.replace('.', '_')};dur={duration:.1f}"
+            for name, duration in self.breakdown().items()
+        ]
+        entries.append(f"total;dur={self.duration * 1000:.1f}")
+        return ", ".join(entries)
+
+    def to_dict(self) -> Dict[str, Any]:
+        span_index = {id(span): index for index, span in enumerate(self.spans)}
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "breakdown_ms": {k: round(v, 3) for k, v in self.breakdown().items()},
+            "spans": [
+                {
+                    "name": span.name,
+                    "parent": (
+                        span_index.get(id(span.parent)) if span.parent is not None else None
+                    ),
+                    "offset_ms": round((span.start - self.start) * 1000, 3),
+                    "duration_ms": round(span.duration * 1000, 3),
+                    "attributes": span.attributes,
+                    "events": [
+                        {"name": name, "offset_ms": round(offset * 1000, 3)}
+                        for name, offset in span.events
+                    ],
+                }
+                for span in self.spans
+            ],
+        }
+
+
+def start_trace(name: str, **attributes) -> Optional[Trace]:
+    """为当前请求开始一个trace, 之后同一上下文中的span都会记录到其中"""
+    if not TRACING_ENABLED:
+        return None
+    trace = Trace(name, **attributes)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, attributes)
+    try:
+        yield current
+    except GeneratorExit:
+        # 包住yield的span, 消费方提前关闭生成器
+        current.set_attribute("closed", True)
+        raise
+    except BaseException as e:
+        current.set_attribute("error", repr(e)[:200])
+        raise
+    finally:
+        trace.end_span(current)
+
+
+def add_timing(name: str, seconds: float):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_timing(name, seconds)
+
+
+def traced(name: str):
+    """给协程函数加上span"""
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
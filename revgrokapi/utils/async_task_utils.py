@@ -1,11 +1,14 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
+from revgrokapi.configs import PROCESS_POOL_WORKERS
+
+_process_pool: ProcessPoolExecutor | None = None
+
 
 async def run_background_task(task):
-    with ThreadPoolExecutor() as pool:
-        await asyncio.get_event_loop().run_in_executor(pool, task)
+    await asyncio.get_running_loop().run_in_executor(None, task)
 
 
 #  submit a synchronous function to the event loop to make it asynchronous
@@ -15,3 +18,25 @@ async def submit_task2event_loop(func, *args, **kwargs):
     running_loop = asyncio.get_running_loop()
     partial_func = partial(func, *args, **kwargs)
     return await running_loop.run_in_executor(executor=None, func=partial_func)
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """cpu密集且持有GIL的任务(pdf解析等)共用的进程池, 第一次使用时才创建"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS)
+    return _process_pool
+
+
+async def submit_task2process_pool(func, *args, **kwargs):
+    """func及其参数需要可以pickle, 即模块级的函数"""
+    running_loop = asyncio.get_running_loop()
+    partial_func = partial(func, *args, **kwargs)
+    return await running_loop.run_in_executor(get_process_pool(), partial_func)
+
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
@@ -2,7 +2,8 @@ import asyncio
 from functools import wraps
 
 from loguru import logger
-from tqdm.asyncio import tqdm
+
+from revgrokapi.tracing import span
 
 REGISTER_MAY_RETRY = 1
 REGISTER_MAY_RETRY_RELOAD = 15  # in reload there are more retries
@@ -16,18 +17,35 @@ def remove_prefix(text, prefix):
     return text
 
 
+class NonRetryableError(Exception):
+    """重试也无法恢复的错误, async_retry不再重试, 直接给出错误"""
+
+
+def _resolve(value):
+    return value() if callable(value) else value
+
+
 def async_retry(retries=3, delay=1):
+    """retries/delay可以是返回数值的函数, 每次调用时读取, 用于运行时修改重试策略"""
+
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            for attempt in range(retries):
+            retries_ = _resolve(retries)
+            delay_ = _resolve(delay)
+            for attempt in range(retries_):
                 try:
-                    async for chunk in func(*args, **kwargs):
-                        yield chunk
+                    with span(f"{func.__name__}.attempt", attempt=attempt + 1):
+                        async for chunk in func(*args, **kwargs):
+                            yield chunk
+                    return
+                except NonRetryableError as e:
+                    logger.error(f"Not retrying: {str(e)}")
+                    yield "[ERROR] " + str(e)
                     return
                 except (RuntimeError, Exception) as e:
-                    if attempt == retries - 1:  # Last attempt
-                        logger.error(f"Failed after {retries} attempts: {str(e)}")
+                    if attempt == retries_ - 1:  # Last attempt
+                        logger.error(f"Failed after {retries_} attempts: {str(e)}")
                         error_prefix = "[ERROR] "  # 添加错误前缀
                         if isinstance(e, RuntimeError):
                             yield error_prefix + str(e)
@@ -38,7 +56,7 @@ def async_retry(retries=3, delay=1):
                             yield error_prefix + str(e)
                     else:
                         logger.warning(f"Attempt {attempt + 1} failed, retrying...")
-                        await asyncio.sleep(delay)
+                        await asyncio.sleep(delay_)
 
         return wrapper
 
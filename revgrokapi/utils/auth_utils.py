@@ -0,0 +1,36 @@
+import secrets
+from typing import Optional
+
+from fastapi import Header, HTTPException
+
+from revgrokapi.configs import POE_OPENAI_LIKE_API_KEY
+from revgrokapi.runtime_settings import runtime_settings
+
+
+def extract_bearer_api_key(authorization: Optional[str]) -> Optional[str]:
+    """从 'Bearer xxx' 格式的Authorization头中取出api key"""
+    if authorization and authorization.startswith("Bearer"):
+        return authorization.replace("Bearer", "").strip() or None
+    return None
+
+
+def admin_api_key() -> Optional[str]:
+    """当前的管理员key; 没有配置或和共享的租户key相同时返回None, 管理接口关闭"""
+    key = runtime_settings.current.admin_api_key
+    if not key or secrets.compare_digest(key, POE_OPENAI_LIKE_API_KEY):
+        return None
+    return key
+
+
+def is_admin_api_key(api_key: Optional[str]) -> bool:
+    key = admin_api_key()
+    return bool(api_key) and key is not None and secrets.compare_digest(api_key, key)
+
+
+async def verify_admin_api_key(authorization: str = Header(None)):
+    if admin_api_key() is None:
+        raise HTTPException(
+            status_code=403, detail="Admin API is disabled, set ADMIN_API_KEY to enable it"
+        )
+    if not is_admin_api_key(extract_bearer_api_key(authorization)):
+        raise HTTPException(status_code=401, detail="Invalid admin API key")
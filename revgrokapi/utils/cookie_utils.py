@@ -13,3 +13,12 @@ def extract_cookie_value(cookie_str, key):
         return value
     else:
         return None
+
+
+# sso=<值>, 可以是完整cookie字符串中的一项; 值不能为空或包含空白
+SSO_COOKIE_PATTERN = re.compile(r"(?:^|;)\s*sso=([^;\s]+)\s*(?:;|$)")
+
+
+def is_well_formed_sso_cookie(cookie_str: str) -> bool:
+    """导入时的格式检查, 不符合的cookie不需要探测就可以拒绝"""
+    return bool(cookie_str) and SSO_COOKIE_PATTERN.search(cookie_str) is not None
@@ -1,15 +1,28 @@
 import asyncio
-from io import BytesIO, StringIO
+import hashlib
+import os
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from io import BytesIO
 
-from docx import Document
 from fastapi import UploadFile
 from loguru import logger
-from pdfminer.high_level import extract_text_to_fp
-from pdfminer.layout import LAParams
 from pydantic import BaseModel
-from rev_claude.utils.async_task_utils import submit_task2event_loop
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
+from revgrokapi.configs import DOCUMENT_TEXT_CACHE_SIZE
+from revgrokapi.utils.async_task_utils import (submit_task2event_loop,
+                                               submit_task2process_pool)
+
+# 上传文件写入临时文件时每次读取的大小
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+PDF_MIME_TYPE = "application/pdf"
+DOCX_MIME_TYPE = (
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+)
+
 
 class DocumentConvertedResponse(BaseModel):
     file_name: str
@@ -18,46 +31,177 @@ class DocumentConvertedResponse(BaseModel):
     extracted_content: str
 
 
+# 以下解析函数在进程池中执行, 需要是模块级函数, 参数只传临时文件路径避免拷贝大文件
+def extract_text_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8", errors="replace")
+
+
+def extract_pdf_file(path: str) -> str:
+    from io import StringIO
+
+    from pdfminer.high_level import extract_text_to_fp
+    from pdfminer.layout import LAParams
+
+    output_buffer = StringIO()
+    with open(path, "rb") as f:
+        extract_text_to_fp(
+            inf=f, outfp=output_buffer, codec="utf-8", laparams=LAParams()
+        )
+    return output_buffer.getvalue()
+
+
+def extract_docx_file(path: str) -> str:
+    from docx import Document
+
+    doc = Document(path)
+    # 只处理段落中的文本, 表格/页眉页脚暂不处理
+    return "\n".join(paragraph.text for paragraph in doc.paragraphs if paragraph.text)
+
+
+def spool_to_temp_file(source) -> tuple[str, str, int]:
+    """把类文件对象分块写入临时文件, 同时计算sha256, 返回(路径, hash, 大小)"""
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(prefix="revgrok-doc-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := source.read(SPOOL_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, digest.hexdigest(), size
+
+
+class DocumentTextCache:
+    """按内容hash缓存解析出的文本, 有界LRU"""
+
+    def __init__(self, max_entries: int = DOCUMENT_TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, digest: str) -> str | None:
+        text = self._cache.get(digest)
+        if text is None:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(digest)
+        self.hits += 1
+        return text
+
+    def put(self, digest: str, text: str):
+        self._cache[digest] = text
+        self._cache.move_to_end(digest)
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+
+class ConversionStats:
+    """按格式统计解析次数、字节数和耗时"""
+
+    def __init__(self):
+        self._stats = defaultdict(lambda: {"files": 0, "bytes": 0, "seconds": 0.0})
+
+    def record(self, file_format: str, size: int, seconds: float):
+        stats = self._stats[file_format]
+        stats["files"] += 1
+        stats["bytes"] += size
+        stats["seconds"] += seconds
+
+    def to_dict(self) -> dict:
+        result = {}
+        for file_format, stats in self._stats.items():
+            seconds = stats["seconds"]
+            result[file_format] = {
+                **stats,
+                "mb_per_second": (
+                    round(stats["bytes"] / seconds / 1024 / 1024, 3) if seconds else None
+                ),
+                "files_per_second": (
+                    round(stats["files"] / seconds, 3) if seconds else None
+                ),
+            }
+        return result
+
+
+document_text_cache = DocumentTextCache()
+conversion_stats = ConversionStats()
+
+
 class DocumentConverter:
     def __init__(self, upload_file: UploadFile):
         self.upload_file = upload_file
 
-    async def convert(self):
-        file_name = self.upload_file.filename
-        file_type = self.upload_file.content_type
-        content = await self.upload_file.read()
-        file_size = len(content)
-        logger.debug(f"file_type: {file_type}")
-        if self.is_text_file():
-            extracted_content = await self.process_text(content)
-            return DocumentConvertedResponse(
-                file_name=file_name,
-                file_type=file_type,
-                file_size=file_size,
-                extracted_content=extracted_content,
-            )
-        # docx, pdf,
-        elif self.is_pdf_file():
-            extracted_content = await self.process_pdf(content)
-            return DocumentConvertedResponse(
-                file_name=file_name,
-                file_type=file_type,
-                file_size=file_size,
-                extracted_content=extracted_content,
+    @classmethod
+    def from_bytes(cls, file_name: str, file_type: str, content: bytes):
+        """用于openai请求中base64形式的文件"""
+        return cls(
+            StarletteUploadFile(
+                filename=file_name,
+                file=BytesIO(content),
+                headers={"content-type": file_type},
             )
+        )
 
-        elif self.is_docx_file():
-            extracted_content = await self.process_docx(content)
-            return DocumentConvertedResponse(
-                file_name=file_name,
-                file_type=file_type,
-                file_size=file_size,
-                extracted_content=extracted_content,
-            )
+    def file_format(self) -> str | None:
+        if self.is_pdf_file():
+            return "pdf"
+        if self.is_docx_file():
+            return "docx"
+        if self.is_text_file():
+            return "text"
+        return None
 
-        else:
+    async def convert(self) -> DocumentConvertedResponse | None:
+        file_name = self.upload_file.filename
+        file_type = self.upload_file.content_type or ""
+        file_format = self.file_format()
+        logger.debug(f"file_type: {file_type}")
+        if file_format is None:
             return None
 
+        # starlette的UploadFile超过1MB时已经落盘, 这里按块拷贝到自己的临时文件,
+        # 不把整个文件读进内存, 顺便算出内容hash
+        await self.upload_file.seek(0)
+        path, digest, file_size = await submit_task2event_loop(
+            spool_to_temp_file, self.upload_file.file
+        )
+        try:
+            extracted_content = document_text_cache.get(digest)
+            if extracted_content is None:
+                start = time.perf_counter()
+                extracted_content = await self.extract(file_format, path)
+                conversion_stats.record(
+                    file_format, file_size, time.perf_counter() - start
+                )
+                document_text_cache.put(digest, extracted_content)
+        finally:
+            await submit_task2event_loop(os.unlink, path)
+
+        return DocumentConvertedResponse(
+            file_name=file_name,
+            file_type=file_type,
+            file_size=file_size,
+            extracted_content=extracted_content,
+        )
+
+    @staticmethod
+    async def extract(file_format: str, path: str) -> str:
+        if file_format == "pdf":
+            return await submit_task2process_pool(extract_pdf_file, path)
+        if file_format == "docx":
+            return await submit_task2process_pool(extract_docx_file, path)
+        # 文本文件只需要解码, 不值得跨进程
+        return await submit_task2event_loop(extract_text_file, path)
+
     def is_text_file(self):
         # 检查内容类型是否为文本类型
         text_types = [
@@ -80,74 +224,19 @@ class DocumentConverter:
             "text/sgml",  # SGML 文档
             "application/sgml",  # SGML 应用程序类型
         ]
-
-        bool_in_list = self.upload_file.content_type in text_types
-        bool_start_with_txt = self.upload_file.content_type.startswith("text")
+        content_type = self.upload_file.content_type or ""
+        bool_in_list = content_type in text_types
+        bool_start_with_txt = content_type.startswith("text")
 
         return bool_in_list or bool_start_with_txt
 
     def is_pdf_file(self):
         # 检查文件是否为PDF
-        return self.upload_file.content_type == "application/pdf"
+        return self.upload_file.content_type == PDF_MIME_TYPE
 
     def is_docx_file(self):
         # 检查文件是否为DOCX
-        return (
-            self.upload_file.content_type
-            == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        )
-
-    def process_text_sync(self, content):
-        # 处理文本文件
-        return content.decode("utf-8")
-
-    async def process_text(self, content):
-        # 使用 run_in_threadpool 处理同步操作
-        extracted_text = await submit_task2event_loop(self.process_text_sync, content)
-        return extracted_text
-
-    def process_pdf_sync(self, content):
-        # 将二进制内容转换为类文件对象
-        pdf_content = BytesIO(content)
-
-        # 准备一个输出缓冲区来捕获文本
-        output_buffer = StringIO()
-
-        # 调用函数
-        extract_text_to_fp(
-            inf=pdf_content, outfp=output_buffer, codec="utf-8", laparams=LAParams()
-        )
-
-        # 从输出缓冲区中检索提取的文本
-        extracted_text = output_buffer.getvalue()
-        return extracted_text
-
-    async def process_pdf(self, content):
-        # 使用 run_in_threadpool 处理同步操作
-        extracted_text = await submit_task2event_loop(self.process_pdf_sync, content)
-        return extracted_text
-
-    def process_docx_sync(self, content):
-        # Convert the binary content to a file-like object
-        docx_file = BytesIO(content)
-
-        # Load the DOCX file with python-docx
-        doc = Document(docx_file)
-
-        # Extract text from each paragraph in the document
-        extracted_text = "\n".join(
-            paragraph.text for paragraph in doc.paragraphs if paragraph.text
-        )
-
-        # Optionally, handle more complex structures like tables, headers, footers if needed
-        # For simplicity, this example focuses only on text in paragraphs
-
-        return extracted_text
-
-    async def process_docx(self, content):
-        extracted_text = await submit_task2event_loop(self.process_docx_sync, content)
-
-        return extracted_text
+        return self.upload_file.content_type == DOCX_MIME_TYPE
 
 
 async def main():
@@ -163,21 +252,17 @@ async def main():
         "text/plain",
         "text/csv",
         "application/json",
-        "application/pdf",
-        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        PDF_MIME_TYPE,
+        DOCX_MIME_TYPE,
     ]
 
-    file_content_list = [open(file_path, "rb").read() for file_path in files_list]
-
     upload_file_list = [
         StarletteUploadFile(
             filename=file_path,
-            file=BytesIO(file_content),
+            file=open(file_path, "rb"),
             headers={"content-type": file_type},
         )
-        for file_path, file_content, file_type in zip(
-            files_list, file_content_list, files_type
-        )
+        for file_path, file_type in zip(files_list, files_type)
     ]
 
     # 初始化 DocumentConverter
@@ -185,10 +270,11 @@ async def main():
         DocumentConverter(upload_file) for upload_file in upload_file_list
     ]
 
-    for converter in converter_list:
-        result = await converter.convert()
+    results = await asyncio.gather(*[converter.convert() for converter in converter_list])
+    for result in results:
         # 处理转换后的结果，例如保存或打印
         print(result)
+    print(conversion_stats.to_dict())
 
 
 # 运行主函数
@@ -0,0 +1,69 @@
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from revgrokapi.configs import IMAGE_STORE_DIR, PUBLIC_BASE_URL
+
+IMAGE_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.(png|jpg|gif|webp|bin)$")
+
+IMAGE_MEDIA_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "bin": "application/octet-stream",
+}
+
+
+def guess_image_extension(raw: bytes) -> str:
+    """按文件头判断图片格式"""
+    if raw.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if raw.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if raw.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if raw[:4] == b"RIFF" and raw[8:12] == b"WEBP":
+        return "webp"
+    return "bin"
+
+
+def save_image_b64(image_b64: str, store_dir: Path = IMAGE_STORE_DIR) -> str:
+    """解码base64图片并按sha256保存, 返回文件名; 相同内容只写一次. 同步函数, 在线程池中调用"""
+    # 上游有时会带上 data:image/...;base64, 前缀
+    if image_b64.startswith("data:"):
+        image_b64 = image_b64[image_b64.index(",") + 1:]
+    try:
+        raw = base64.b64decode(image_b64, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"Invalid base64 image: {e}")
+    name = f"{hashlib.sha256(raw).hexdigest()}.{guess_image_extension(raw)}"
+    path = store_dir / name
+    if not path.exists():
+        store_dir.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再rename, 避免并发读到写了一半的图片
+        fd, tmp_path = tempfile.mkstemp(dir=store_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(raw)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return name
+
+
+def get_image_path(name: str, store_dir: Path = IMAGE_STORE_DIR) -> Path | None:
+    if not IMAGE_NAME_PATTERN.match(name):
+        return None
+    path = store_dir / name
+    return path if path.is_file() else None
+
+
+def build_image_url(base_url: str, name: str) -> str:
+    """图片的对外链接, 由 routers/image 提供"""
+    return f"{(PUBLIC_BASE_URL or base_url).rstrip('/')}/api/v1/images/{name}"
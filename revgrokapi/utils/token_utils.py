@@ -1,7 +1,6 @@
 from functools import lru_cache
 from typing import Dict, List
 
-import tiktoken
 from loguru import logger
 
 from revgrokapi.configs import DEFAULT_TOKENIZER
@@ -9,6 +8,9 @@ from revgrokapi.configs import DEFAULT_TOKENIZER
 
 @lru_cache
 def get_tokenizer():
+    # 第一次计算token时才导入, 不拖慢启动
+    import tiktoken
+
     return tiktoken.get_encoding(DEFAULT_TOKENIZER)
 
 
@@ -16,13 +18,28 @@ def get_token_length(prompt: str) -> int:
     return len(get_tokenizer().encode(prompt))
 
 
+_tokenizer_unavailable = False
+
+
+def count_tokens(prompt: str) -> int:
+    """计算token数, tokenizer加载失败(例如无法下载编码文件)时退化为按字符数估计"""
+    global _tokenizer_unavailable
+    if not _tokenizer_unavailable:
+        try:
+            return get_token_length(prompt)
+        except Exception as e:
+            logger.warning(f"Tokenizer unavailable, falling back to estimation: {e}")
+            _tokenizer_unavailable = True
+    return len(prompt) // 4 + 1 if prompt else 0
+
+
 def shorten_message_given_prompt_length(
     messages: List[Dict], token_limits: int
 ) -> List[Dict]:
     messages_str = "\n".join(
         [f"{message['role']}: {message['content']}" for message in messages]
     )
-    token_length = get_token_length(messages_str)
+    token_length = count_tokens(messages_str)
     # logger.debug(f"Token length: {token_length}")
     # logger.debug(f"Token limits: {token_limits}")
     if token_length <= token_limits:
@@ -52,7 +69,7 @@ def shorten_message_given_prompt_length(
                 for message in shortened_messages
             ]
         )
-        token_length = get_token_length(messages_str)
+        token_length = count_tokens(messages_str)
         if token_length <= token_limits:
             break
 